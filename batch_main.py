@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from main import (
+    create_pdf_image_to_markdown_manager,
+    get_additional_azure_openai_configs,
+    get_azure_openai_config,
+    get_storage_account_config,
+    print_page_deduplication_summary,
+)
+from pdf_image_to_markdown.managers.gateways.async_blob_storage_gateway import AsyncBlobStorageGateway
+from pdf_image_to_markdown.managers.gateways.azure_ad_token_provider import AzureAdTokenProvider
+from pdf_image_to_markdown.managers.gateways.local_file_storage_gateway import LocalFileStorageGateway
+from pdf_image_to_markdown.managers.models.batch_conversion_result import BatchConversionResult
+from pdf_image_to_markdown.managers.pdf_batch_conversion_manager import PdfBatchConversionManager
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Convert all PDF documents under a prefix of a blob container (or local folder) to markdown.")
+    parser.add_argument("--source-prefix", default="incoming/", help="Prefix under which the PDF documents to convert are found")
+    parser.add_argument("--output-prefix", default="markdown/", help="Prefix under which the markdown documents are uploaded")
+    parser.add_argument("--processed-prefix", default="processed/", help="Prefix the converted PDF documents are moved to")
+    parser.add_argument("--failed-prefix", default="failed/", help="Prefix the PDF documents that failed to convert are moved to")
+    parser.add_argument("--max-documents", type=int, default=2, help="Maximum number of documents converted concurrently")
+    parser.add_argument("--local-root", type=Path, help="Use this local folder instead of the blob container in BLOB_CONTAINER_URL")
+    parser.add_argument("--transfer-concurrency", type=int, default=4, help="Maximum number of parallel block transfers per blob")
+    return parser.parse_args()
+
+
+async def main() -> None:
+    start_time = time.perf_counter()
+    arguments: argparse.Namespace = parse_arguments()
+
+    # Get configuration settings from environment variables, a local folder needs no storage account
+    azure_open_ai_config = get_azure_openai_config()
+
+    # A single token cache for the OpenAI and blob clients, so the concurrent requests of both share its tokens. It is only
+    # created when Entra ID authentication is used, i.e. for the blob container or a deployment without an api key.
+    uses_azure_ad_authentication: bool = not arguments.local_root or any(
+        config.token_provider_url for config in [azure_open_ai_config, *get_additional_azure_openai_configs(azure_open_ai_config)]
+    )
+    azure_ad_token_provider: Optional[AzureAdTokenProvider] = AzureAdTokenProvider() if uses_azure_ad_authentication else None
+    pdf_image_to_markdown_manager = create_pdf_image_to_markdown_manager(azure_open_ai_config, azure_ad_token_provider)
+
+    storage_gateway: AsyncBlobStorageGateway | LocalFileStorageGateway = (
+        LocalFileStorageGateway(arguments.local_root)
+        if arguments.local_root
+        else AsyncBlobStorageGateway(get_storage_account_config(), max_concurrency=arguments.transfer_concurrency, credential=azure_ad_token_provider)
+    )
+
+    jobs_directory: Optional[str] = os.getenv("JOBS_DIRECTORY")
+    try:
+        async with storage_gateway:
+            pdf_batch_conversion_manager = PdfBatchConversionManager(storage_gateway, pdf_image_to_markdown_manager, arguments.max_documents)
+            result: BatchConversionResult = await pdf_batch_conversion_manager.convert_documents(
+                arguments.source_prefix,
+                arguments.output_prefix,
+                arguments.processed_prefix,
+                arguments.failed_prefix,
+                batch_size=int(os.getenv("BATCH_SIZE", "1")),
+                batch_token_budget=int(os.environ["BATCH_TOKEN_BUDGET"]) if os.getenv("BATCH_TOKEN_BUDGET") else None,
+                max_concurrency=int(os.getenv("MAX_CONCURRENCY", "1")),
+                render_workers=int(os.getenv("RENDER_WORKERS", "1")),
+                jobs_directory=Path(jobs_directory) if jobs_directory else None,
+                use_text_layer=os.getenv("USE_TEXT_LAYER", "false").lower() == "true",
+            )
+    finally:
+        await pdf_image_to_markdown_manager.close()
+        if azure_ad_token_provider is not None:
+            await azure_ad_token_provider.close()
+
+    for document_name, error in result.failed_documents.items():
+        print(f"Failed: {document_name}: {error}")
+    print_page_deduplication_summary(pdf_image_to_markdown_manager)
+
+    elapsed_time = time.perf_counter() - start_time
+    hours = int(elapsed_time // 3600)
+    minutes = int((elapsed_time % 3600) // 60)
+    seconds = elapsed_time % 60
+    print(f"Execution time: {hours}:{minutes:02}:{seconds:.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
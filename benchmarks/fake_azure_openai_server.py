@@ -0,0 +1,228 @@
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import time
+from dataclasses import dataclass
+
+from aiohttp import web
+
+# Markdown in the shape the vision model produces (custom markers, a heading and a table), repeated to reach the
+# configured response size
+RESPONSE_MARKDOWN_TEMPLATE: str = (
+    "[[ HEADER START ]]\nRequest for Proposal\n[[ HEADER END ]]\n"
+    "# Section {request_number}\n\n"
+    "The supplier shall provide the services described in this section.\n\n"
+    "| Item | Description | Quantity |\n|---|---|---|\n| 1 | Services | 10 |\n\n"
+)
+# Like Azure OpenAI, prompts are cached from 1024 tokens on, in increments of 128 tokens
+PROMPT_CACHE_MIN_TOKENS: int = 1024
+PROMPT_CACHE_INCREMENT_TOKENS: int = 128
+# What a (tiled) page image is billed as, rather than the size of its base64 data
+IMAGE_PROMPT_TOKENS: int = 765
+
+
+@dataclass
+class FakeAzureOpenAiServerConfig:
+    def __init__(
+        self,
+        latency_seconds: float = 1.0,
+        jitter_seconds: float = 0.25,
+        rate_limit_ratio: float = 0.0,
+        response_size: int = 2000,
+        retry_after_milliseconds: int = 500,
+        time_to_first_token_ratio: float = 0.1,
+        stream_chunk_size: int = 16,
+        server_error_ratio: float = 0.0,
+        slow_request_ratio: float = 0.0,
+        slow_request_latency_factor: float = 4.0,
+    ):
+        # Every completion takes latency_seconds +/- jitter_seconds (uniformly distributed)
+        self.latency_seconds: float = latency_seconds
+        self.jitter_seconds: float = jitter_seconds
+        # Share of the requests that are answered with a 429 instead
+        self.rate_limit_ratio: float = rate_limit_ratio
+        # Approximate number of characters in every completion
+        self.response_size: int = response_size
+        self.retry_after_milliseconds: int = retry_after_milliseconds
+        # Streamed completions send their first chunk after this share of the latency, and the remaining chunks
+        # (of stream_chunk_size characters) evenly spread over the rest of it
+        self.time_to_first_token_ratio: float = time_to_first_token_ratio
+        self.stream_chunk_size: int = stream_chunk_size
+        # Share of the requests that fail with a 500, as those of an unhealthy deployment do
+        self.server_error_ratio: float = server_error_ratio
+        # Share of the requests that take slow_request_latency_factor times the latency, the tail of a real deployment
+        self.slow_request_ratio: float = slow_request_ratio
+        self.slow_request_latency_factor: float = slow_request_latency_factor
+
+
+class FakeAzureOpenAiServer:
+    """
+    A local stand-in for an Azure OpenAI chat completions deployment, to benchmark the pipeline without spending
+    tokens. It runs in a process of its own so that its CPU time is not attributed to the pipeline.
+    """
+
+    def __init__(self, fake_server_config: FakeAzureOpenAiServerConfig) -> None:
+        self.config: FakeAzureOpenAiServerConfig = fake_server_config
+        self.port: int = self.__get_free_port()
+        self.process: multiprocessing.Process | None = None
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "FakeAzureOpenAiServer":
+        self.process = multiprocessing.Process(target=FakeAzureOpenAiServer._serve, args=(self.config, self.port), daemon=True)
+        self.process.start()
+        self.__wait_until_listening()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+
+    @staticmethod
+    def _serve(fake_server_config: FakeAzureOpenAiServerConfig, port: int) -> None:
+        request_count: int = 0
+        # The system messages seen so far, a request whose system message was seen before reports it as cached
+        cached_system_messages: set[str] = set()
+
+        async def create_chat_completion(request: web.Request) -> web.Response:
+            nonlocal request_count
+            request_count += 1
+            request_body: dict = await request.json()
+
+            if random.random() < fake_server_config.rate_limit_ratio:
+                return web.json_response(
+                    {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit."}},
+                    status=429,
+                    headers={"retry-after-ms": str(fake_server_config.retry_after_milliseconds)},
+                )
+            if random.random() < fake_server_config.server_error_ratio:
+                return web.json_response({"error": {"code": "InternalServerError", "message": "The server had an error."}}, status=500)
+
+            jitter_seconds: float = random.uniform(-fake_server_config.jitter_seconds, fake_server_config.jitter_seconds)
+            latency_seconds: float = max(fake_server_config.latency_seconds + jitter_seconds, 0)
+            if random.random() < fake_server_config.slow_request_ratio:
+                latency_seconds *= fake_server_config.slow_request_latency_factor
+
+            section: str = RESPONSE_MARKDOWN_TEMPLATE.format(request_number=request_count)
+            page_content: str = (section * (fake_server_config.response_size // len(section) + 1))[: fake_server_config.response_size]
+            # Requests with several page images get the markdown of every page, separated the way the batch prompt asks for
+            image_count: int = sum(
+                content_part.get("type") == "image_url"
+                for message in request_body["messages"]
+                if isinstance(message["content"], list)
+                for content_part in message["content"]
+            )
+            content: str = (
+                "".join(f"[[ PAGE {page_index} ]]\n{page_content}\n" for page_index in range(1, image_count + 1)) + "[[ END OF PAGES ]]"
+                if image_count > 1
+                else page_content
+            )
+            # A continuation request (with the completion so far sent back as an assistant message) gets the rest of it
+            if len(request_body["messages"]) > 2 and request_body["messages"][-2]["role"] == "assistant":
+                content = content[len(request_body["messages"][-2]["content"]) :]
+            # Like a real deployment, completions are cut off at max_tokens
+            finish_reason: str = "stop"
+            if request_body.get("max_tokens") and len(content) // 4 > request_body["max_tokens"]:
+                content, finish_reason = content[: request_body["max_tokens"] * 4], "length"
+            text_length: int = sum(
+                len(content_part.get("text", "")) if isinstance(content_part, dict) else len(content_part)
+                for message in request_body["messages"]
+                for content_part in (message["content"] if isinstance(message["content"], list) else [message["content"]])
+            )
+            prompt_tokens: int = text_length // 4 + image_count * IMAGE_PROMPT_TOKENS
+            system_message: str = next((message["content"] for message in request_body["messages"] if message["role"] == "system"), "")
+            system_message_tokens: int = len(system_message) // 4
+            cached_tokens: int = (
+                system_message_tokens // PROMPT_CACHE_INCREMENT_TOKENS * PROMPT_CACHE_INCREMENT_TOKENS
+                if system_message in cached_system_messages and system_message_tokens >= PROMPT_CACHE_MIN_TOKENS
+                else 0
+            )
+            cached_system_messages.add(system_message)
+            completion_id: str = f"chatcmpl-{request_count}"
+            completion_tokens: int = len(content) // 4
+            usage: dict[str, int | dict[str, int]] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            }
+            rate_limit_headers: dict[str, str] = {"x-ratelimit-remaining-requests": "1000", "x-ratelimit-remaining-tokens": "1000000"}
+
+            if request_body.get("stream"):
+                return await stream_chat_completion(request, completion_id, content, finish_reason, usage, latency_seconds, rate_limit_headers)
+
+            await asyncio.sleep(latency_seconds)
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "fake",
+                    "choices": [{"index": 0, "finish_reason": finish_reason, "message": {"role": "assistant", "content": content}}],
+                    "usage": usage,
+                },
+                headers=rate_limit_headers,
+            )
+
+        async def stream_chat_completion(  # noqa: PLR0913
+            request: web.Request,
+            completion_id: str,
+            content: str,
+            finish_reason: str,
+            usage: dict[str, int | dict[str, int]],
+            latency_seconds: float,
+            headers: dict[str, str],
+        ) -> web.StreamResponse:
+            response: web.StreamResponse = web.StreamResponse(headers={"content-type": "text/event-stream", **headers})
+            await response.prepare(request)
+
+            async def send_chunk(choices: list[dict], chunk_usage: dict[str, int | dict[str, int]] | None = None) -> None:
+                chunk: dict = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": "fake",
+                    "choices": choices,
+                    "usage": chunk_usage,
+                }
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+            chunk_size: int = fake_server_config.stream_chunk_size
+            content_chunks: list[str] = [content[chunk_start : chunk_start + chunk_size] for chunk_start in range(0, len(content), chunk_size)]
+            time_to_first_token: float = latency_seconds * fake_server_config.time_to_first_token_ratio
+            seconds_per_chunk: float = (latency_seconds - time_to_first_token) / max(len(content_chunks), 1)
+            await asyncio.sleep(time_to_first_token)
+            for chunk_index, content_chunk in enumerate(content_chunks):
+                if chunk_index:
+                    await asyncio.sleep(seconds_per_chunk)
+                await send_chunk([{"index": 0, "delta": {"role": "assistant", "content": content_chunk}, "finish_reason": None}])
+            await send_chunk([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+            await send_chunk([], usage)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+
+        application: web.Application = web.Application(client_max_size=64 * 1024 * 1024)
+        application.router.add_post("/openai/deployments/{deployment}/chat/completions", create_chat_completion)
+        web.run_app(application, host="127.0.0.1", port=port, print=None)
+
+    def __wait_until_listening(self, timeout_seconds: float = 10.0) -> None:
+        deadline: float = time.monotonic() + timeout_seconds
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError(f"The fake Azure OpenAI server did not start listening on port {self.port}")
+
+    @staticmethod
+    def __get_free_port() -> int:
+        with socket.socket() as listening_socket:
+            listening_socket.bind(("127.0.0.1", 0))
+            return listening_socket.getsockname()[1]
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of the custom marker cleanup on large markdown.
+
+The single-pass MarkdownCustomMarkesCleaner.clean_markers_and_extract_toc is timed against the previous two-pass
+implementation (kept below as the baseline) on synthetic multi-megabyte, whole-document markdown, and both are
+checked to produce the same result. Run it from the repository root:
+
+    python -m benchmarks.markdown_cleaner_benchmark --sizes 1 4 16 --repeat 5
+"""
+
+import argparse
+import random
+import statistics
+import time
+from typing import Callable, Optional
+
+from pdf_image_to_markdown.managers.processors.markdown_custom_markers_cleaner import MarkdownCustomMarkesCleaner
+
+SYNTHETIC_WORDS: list[str] = ["supplier", "shall", "provide", "contract", "services", "the", "of", "tender", "clause", "liability", "and", "to"]
+REMOVAL_MARKERS: list[str] = ["PAGE HEADER", "PAGE FOOTER", "WATERMARK"]
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the custom marker cleanup on large markdown.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4, 16], help="Sizes of the synthetic markdown in megabytes")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs of each implementation per size")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic markdown")
+    return parser.parse_args()
+
+
+def create_synthetic_markdown(size_megabytes: float, seed: int) -> str:
+    """Creates the markdown of a whole document: pages of text and tables, each with marker blocks to remove."""
+    random_generator: random.Random = random.Random(seed)
+    target_size: int = int(size_megabytes * 1024 * 1024)
+    page_chunks: list[str] = [
+        "[[TOC FROM CONTENT START]]\n" + "\n".join(f"- Section {index}" for index in range(1, 40)) + "\n[[TOC FROM CONTENT END]]\n"
+    ]
+    size: int = len(page_chunks[0])
+    page_number: int = 1
+    while size < target_size:
+        lines: list[str] = []
+        for marker in REMOVAL_MARKERS:
+            lines += [f"[[{marker} START]]", f"{marker.title()} of page {page_number}", f"[[{marker} END]]"]
+        if page_number % 25 == 1:
+            lines.append("## Table of Contents")
+        for paragraph_number in range(random_generator.randint(4, 12)):
+            lines.append(f"## Section {page_number}.{paragraph_number}" if paragraph_number % 4 == 0 else "")
+            lines.append(" ".join(random_generator.choices(SYNTHETIC_WORDS, k=random_generator.randint(20, 80))))
+        lines += ["| Clause | Liability |", "| --- | --- |"]
+        lines += [f"| {row} | {' '.join(random_generator.choices(SYNTHETIC_WORDS, k=6))} |" for row in range(random_generator.randint(3, 15))]
+        page_chunk: str = "\n".join(lines) + "\n"
+        page_chunks.append(page_chunk)
+        size += len(page_chunk)
+        page_number += 1
+    return "".join(page_chunks)
+
+
+def clean_markers_and_extract_toc_two_pass(markdown_string: str) -> tuple[str, Optional[list[str]]]:
+    """The previous implementation: the marker cleanup, then a second pass over its output for the extraction block."""
+    cleaned_markdown: str = MarkdownCustomMarkesCleaner.clean_up_markers(markdown_string)
+    output_lines: list[str] = []
+    extracted_lines: list[str] = []
+    is_inside_extraction_block: bool = False
+    extraction_block_found: bool = False
+    for current_line in cleaned_markdown.splitlines():
+        tag_info = MarkdownCustomMarkesCleaner._parse_tag(current_line.strip())
+        if tag_info and tag_info[0] == MarkdownCustomMarkesCleaner.EXTRACTION_MARKER_PREFIX:
+            is_inside_extraction_block = tag_info[1] == "START"
+            extraction_block_found = extraction_block_found or is_inside_extraction_block
+            continue
+        if is_inside_extraction_block:
+            extracted_lines.append(current_line)
+        else:
+            output_lines.append(current_line)
+    return "\n".join(output_lines), extracted_lines if extraction_block_found and extracted_lines else None
+
+
+def time_cleaner(cleaner: Callable[[str], tuple[str, Optional[list[str]]]], markdown: str, repeat: int) -> list[float]:
+    durations: list[float] = []
+    for _ in range(repeat):
+        start_time: float = time.perf_counter()
+        cleaner(markdown)
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def main() -> None:
+    arguments: argparse.Namespace = parse_arguments()
+    print(f"{'size MB':>8} {'two-pass ms':>12} {'single-pass ms':>15} {'MB/s':>8} {'speedup':>8}")
+    for size_megabytes in arguments.sizes:
+        markdown: str = create_synthetic_markdown(size_megabytes, arguments.seed)
+        if clean_markers_and_extract_toc_two_pass(markdown) != MarkdownCustomMarkesCleaner.clean_markers_and_extract_toc(markdown):
+            raise RuntimeError(f"The implementations disagree on the {size_megabytes} MB markdown")
+
+        two_pass_seconds: float = statistics.median(time_cleaner(clean_markers_and_extract_toc_two_pass, markdown, arguments.repeat))
+        single_pass_seconds: float = statistics.median(
+            time_cleaner(MarkdownCustomMarkesCleaner.clean_markers_and_extract_toc, markdown, arguments.repeat)
+        )
+        actual_megabytes: float = len(markdown) / (1024 * 1024)
+        print(
+            f"{actual_megabytes:>8.1f} {two_pass_seconds * 1000:>12.1f} {single_pass_seconds * 1000:>15.1f} "
+            f"{actual_megabytes / single_pass_seconds:>8.1f} {two_pass_seconds / single_pass_seconds:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Offline throughput benchmark of the PDF to markdown pipeline.
+
+Synthetic (scanned-like) PDFs of several page counts are converted by PdfImageToMarkdownManager against a local
+fake Azure OpenAI deployment, so rendering, encoding, scheduling and cleanup are measured without spending any
+tokens. Run it from the repository root:
+
+    python -m benchmarks.pipeline_benchmark --page-counts 10 50 --latency 1.5 --max-concurrency 8
+
+Every document is converted in a fresh process of its own, so the peak RSS reported for it is that of its conversion
+alone, not that of generating the documents, of the fake servers or of the conversions before it (Linux only).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import random
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import pypdfium2 as pdfium
+from PIL import Image, ImageDraw
+
+from benchmarks.fake_azure_openai_server import FakeAzureOpenAiServer, FakeAzureOpenAiServerConfig
+from pdf_image_to_markdown.managers.models.azure_openai_config import AzureOpenAiConfig
+from pdf_image_to_markdown.managers.models.conversion_report import ConversionReport
+from pdf_image_to_markdown.managers.models.request_hedging_config import RequestHedgingConfig
+from pdf_image_to_markdown.managers.pdf_image_to_markdown_manager import PdfImageToMarkdownManager
+
+SYNTHETIC_PAGE_SIZE: tuple[int, int] = (1224, 1584)
+SYNTHETIC_WORDS: list[str] = ["supplier", "shall", "provide", "contract", "services", "the", "of", "tender", "clause", "liability", "and", "to"]
+RENDER_WORKER_SAMPLING_SECONDS: float = 0.1
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the PDF to markdown pipeline against a fake Azure OpenAI deployment.")
+    parser.add_argument("--page-counts", type=int, nargs="+", default=[5, 20, 50], help="Page counts of the synthetic documents")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mean latency of a completion in seconds")
+    parser.add_argument("--jitter", type=float, default=0.25, help="Uniform jitter around the latency in seconds")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="Share of the requests answered with a 429")
+    parser.add_argument("--slow-request-ratio", type=float, default=0.0, help="Share of the requests taking 4x the latency")
+    parser.add_argument("--max-tokens", type=int, default=16384, help="max_tokens of the requests, longer completions are continued")
+    parser.add_argument("--adaptive-max-tokens", action="store_true", help="Estimate every request's max_tokens from its input")
+    parser.add_argument("--response-size", type=int, default=2000, help="Characters in every completion")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="Maximum number of pages converted concurrently")
+    parser.add_argument("--batch-size", type=int, default=1, help="Maximum number of pages converted with one request")
+    parser.add_argument("--batch-token-budget", type=int, help="Estimated tokens a request with several pages may use")
+    parser.add_argument("--render-workers", type=int, default=1, help="Number of processes rendering pages")
+    parser.add_argument("--requests-per-minute", type=int, help="Schedule requests client-side against this request quota")
+    parser.add_argument("--tokens-per-minute", type=int, help="Schedule requests client-side against this token quota")
+    parser.add_argument("--deployments", type=int, default=1, help="Number of fake deployments the requests are spread over")
+    parser.add_argument("--unhealthy-deployments", type=int, default=0, help="Number of the deployments failing every request with a 500")
+    parser.add_argument("--hedge-percentile", type=float, help="Hedge requests running longer than this percentile of the latencies")
+    parser.add_argument("--hedge-max-request-ratio", type=float, default=0.1, help="Maximum share of the requests that are hedged")
+    parser.add_argument("--stream-completions", action="store_true", help="Convert pages with streamed completions")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic documents and of the fake server's randomness")
+    parser.add_argument("--output", type=Path, help="Write the results (including the full conversion reports) to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's progress output")
+    return parser.parse_args()
+
+
+def create_synthetic_pdf(pdf_path: Path, page_count: int, seed: int) -> None:
+    """
+    Creates a PDF of scanned-looking text pages (an image per page, without a text layer). The pages are created
+    and appended to the document one at a time, so only one of them is ever held in memory.
+    """
+    random_generator: random.Random = random.Random(seed)
+    pdf_document: pdfium.PdfDocument = pdfium.PdfDocument.new()
+    for page_number in range(1, page_count + 1):
+        page: Image.Image = Image.new("RGB", SYNTHETIC_PAGE_SIZE, "white")
+        draw: ImageDraw.ImageDraw = ImageDraw.Draw(page)
+        draw.text((100, 80), f"SECTION {page_number}", fill="black")
+        for line_top in range(140, 1100, 22):
+            draw.text((100, line_top), " ".join(random_generator.choices(SYNTHETIC_WORDS, k=16)), fill="black")
+        for row_top in range(1150, 1450, 40):
+            draw.rectangle((100, row_top, 1124, row_top + 40), outline="black")
+            draw.line((500, row_top, 500, row_top + 40), fill="black")
+            draw.text((110, row_top + 12), random_generator.choice(SYNTHETIC_WORDS), fill="black")
+        draw.text((580, 1500), f"Page {page_number} of {page_count}", fill="black")
+
+        page_buffer: io.BytesIO = io.BytesIO()
+        page.save(page_buffer, format="PDF", resolution=144)
+        page_document: pdfium.PdfDocument = pdfium.PdfDocument(page_buffer.getvalue())
+        pdf_document.import_pages(page_document)
+        page_document.close()
+
+    pdf_document.save(pdf_path)
+    pdf_document.close()
+
+
+def get_percentile(values: list[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    sorted_values: list[float] = sorted(values)
+    return sorted_values[max(math.ceil(percentile / 100 * len(sorted_values)) - 1, 0)]
+
+
+def get_peak_rss_megabytes(process_id: int | str = "self") -> float | None:
+    """
+    Returns the high-water mark of the RSS of the process, None where /proc is not available. Unlike ru_maxrss it
+    does not start out at the peak RSS of the process it was started from.
+    """
+    try:
+        process_status: str = Path(f"/proc/{process_id}/status").read_text(encoding="utf-8")
+    except OSError:
+        return None
+    peak_rss_line: str | None = next((line for line in process_status.splitlines() if line.startswith("VmHWM:")), None)
+    return int(peak_rss_line.split()[1]) / 1024 if peak_rss_line is not None else None
+
+
+async def sample_render_worker_peak_rss(render_worker_peak_rss_megabytes: dict[int, float]) -> None:
+    # The render workers are the only processes the benchmark process starts, their peak RSS is read while they are running
+    while True:
+        for render_worker in multiprocessing.active_children():
+            peak_rss_megabytes: float | None = get_peak_rss_megabytes(render_worker.pid) if render_worker.pid is not None else None
+            if peak_rss_megabytes is not None:
+                render_worker_peak_rss_megabytes[render_worker.pid] = peak_rss_megabytes
+        await asyncio.sleep(RENDER_WORKER_SAMPLING_SECONDS)
+
+
+def run_benchmark_process(arguments: argparse.Namespace, endpoints: list[str], pdf_path: Path, page_count: int) -> dict[str, Any]:
+    """Converts the document in the fresh process this is called in, and measures the peak RSS of its conversion."""
+    # What the process uses before converting anything (the interpreter and the imported modules) is left out
+    baseline_rss_megabytes: float | None = get_peak_rss_megabytes()
+    start_time: float = time.perf_counter()
+    try:
+        benchmark_result: dict[str, Any] = asyncio.run(run_benchmark(arguments, endpoints, pdf_path, page_count))
+    except Exception as e:
+        # Not every exception can be unpickled in the parent process (openai's APIStatusError cannot), which would then
+        # only report a broken process pool, so the failure is sent back as the traceback of a RuntimeError
+        raise RuntimeError(f"The conversion of the {page_count} page document failed:\n{traceback.format_exc()}") from None
+    benchmark_result["wall_clock_seconds"] = round(time.perf_counter() - start_time, 3)
+    peak_rss_megabytes: float | None = get_peak_rss_megabytes()
+    if baseline_rss_megabytes is not None and peak_rss_megabytes is not None:
+        benchmark_result["peak_rss_megabytes"] |= {
+            "baseline": round(baseline_rss_megabytes, 1),
+            "pipeline": round(peak_rss_megabytes - baseline_rss_megabytes, 1),
+        }
+    return benchmark_result
+
+
+async def run_benchmark(arguments: argparse.Namespace, endpoints: list[str], pdf_path: Path, page_count: int) -> dict[str, Any]:
+    azure_openai_configs: list[AzureOpenAiConfig] = [
+        AzureOpenAiConfig(
+            endpoint,
+            "2024-10-21",
+            "fake-deployment",
+            "fake-api-key",
+            max_tokens=arguments.max_tokens,
+            requests_per_minute=arguments.requests_per_minute,
+            tokens_per_minute=arguments.tokens_per_minute,
+        )
+        for endpoint in endpoints
+    ]
+    # A new manager (and hence gateway) for every run, so nothing is carried over between runs
+    request_hedging_config: RequestHedgingConfig | None = (
+        RequestHedgingConfig(arguments.hedge_percentile, arguments.hedge_max_request_ratio) if arguments.hedge_percentile else None
+    )
+    pdf_image_to_markdown_manager: PdfImageToMarkdownManager = PdfImageToMarkdownManager(
+        azure_openai_configs[0],
+        stream_completions=arguments.stream_completions,
+        additional_azure_openai_configs=azure_openai_configs[1:],
+        request_hedging_config=request_hedging_config,
+        adaptive_max_tokens=arguments.adaptive_max_tokens,
+    )
+    telemetry_gateway = pdf_image_to_markdown_manager.telemetry_gateway
+
+    progress_output: contextlib.AbstractContextManager[Any] = (
+        contextlib.nullcontext() if arguments.verbose else contextlib.redirect_stdout(io.StringIO())
+    )
+    render_worker_peak_rss_megabytes: dict[int, float] = {}
+    render_worker_sampling_task: asyncio.Task[None] = asyncio.create_task(sample_render_worker_peak_rss(render_worker_peak_rss_megabytes))
+    try:
+        with progress_output, telemetry_gateway.measure_document(pdf_path.stem) as conversion_report:
+            await pdf_image_to_markdown_manager.get_markdown_for_pdf_source_using_page_images(
+                pdf_path,
+                pdf_path.stem,
+                batch_size=arguments.batch_size,
+                batch_token_budget=arguments.batch_token_budget,
+                max_concurrency=arguments.max_concurrency,
+                render_workers=arguments.render_workers,
+            )
+    finally:
+        render_worker_sampling_task.cancel()
+        await pdf_image_to_markdown_manager.close()
+
+    return get_benchmark_result(page_count, conversion_report, render_worker_peak_rss_megabytes)
+
+
+def get_benchmark_result(page_count: int, conversion_report: ConversionReport, render_worker_peak_rss_megabytes: dict[int, float]) -> dict[str, Any]:
+    page_latencies: list[float] = conversion_report.stage_durations.get("page", [])
+    return {
+        "page_count": page_count,
+        "elapsed_seconds": round(conversion_report.elapsed_seconds, 3),
+        "pages_per_second": round(page_count / conversion_report.elapsed_seconds, 3),
+        "time_to_first_markdown_seconds": conversion_report.to_dict()["time_to_first_markdown_seconds"],
+        "page_latency_p50_seconds": round(get_percentile(page_latencies, 50), 3),
+        "page_latency_p95_seconds": round(get_percentile(page_latencies, 95), 3),
+        # The pipeline's peak RSS is added by the benchmark process, the largest one of the render workers is reported
+        "peak_rss_megabytes": {
+            "render_worker": round(max(render_worker_peak_rss_megabytes.values()), 1) if render_worker_peak_rss_megabytes else None
+        },
+        "conversion_report": conversion_report.to_dict(),
+    }
+
+
+def print_benchmark_result(benchmark_result: dict[str, Any]) -> None:
+    peak_rss_megabytes: dict[str, float | None] = benchmark_result["peak_rss_megabytes"]
+    peak_rss: str = (
+        f"+{peak_rss_megabytes['pipeline']:.0f} MB over {peak_rss_megabytes['baseline']:.0f} MB" if "pipeline" in peak_rss_megabytes else "n/a"
+    )
+    if peak_rss_megabytes["render_worker"] is not None:
+        peak_rss += f" (render workers up to {peak_rss_megabytes['render_worker']:.0f} MB each)"
+    conversion_report: dict[str, Any] = benchmark_result["conversion_report"]
+    print(
+        f"{benchmark_result['page_count']:>5} pages: {benchmark_result['elapsed_seconds']:8.2f}s, "
+        f"{benchmark_result['pages_per_second']:6.2f} pages/s, page latency p50 {benchmark_result['page_latency_p50_seconds']:.2f}s "
+        f"p95 {benchmark_result['page_latency_p95_seconds']:.2f}s, peak RSS {peak_rss}, "
+        f"{conversion_report['llm_call_count']} LLM calls, {conversion_report['retry_count']} retries, "
+        f"{conversion_report['hedged_request_count']} hedged, {conversion_report['continuation_count']} continuations, "
+        f"{conversion_report['prompt_cache_hit_rate']:.0%} of the prompt tokens cached"
+    )
+    for stage, stage_report in conversion_report["stages"].items():
+        cpu_seconds: str = f", CPU {stage_report['cpu_seconds']:.3f}s" if "cpu_seconds" in stage_report else ""
+        print(
+            f"        {stage:<22} {stage_report['count']:>5}x  total {stage_report['total_seconds']:8.3f}s  "
+            f"mean {stage_report['mean_seconds']:.3f}s  max {stage_report['max_seconds']:.3f}s{cpu_seconds}"
+        )
+
+
+async def main() -> None:
+    arguments: argparse.Namespace = parse_arguments()
+    fake_server_configs: list[FakeAzureOpenAiServerConfig] = [
+        FakeAzureOpenAiServerConfig(
+            latency_seconds=arguments.latency,
+            jitter_seconds=arguments.jitter,
+            rate_limit_ratio=arguments.rate_limit_ratio,
+            slow_request_ratio=arguments.slow_request_ratio,
+            response_size=arguments.response_size,
+            # The unhealthy deployments are the first ones, which the requests are sent to first
+            server_error_ratio=1.0 if deployment_index < arguments.unhealthy_deployments else 0.0,
+        )
+        for deployment_index in range(arguments.deployments)
+    ]
+    random.seed(arguments.seed)
+
+    benchmark_results: list[dict[str, Any]] = []
+    with contextlib.ExitStack() as exit_stack:
+        temporary_directory: str = exit_stack.enter_context(tempfile.TemporaryDirectory())
+        fake_servers: list[FakeAzureOpenAiServer] = [
+            exit_stack.enter_context(FakeAzureOpenAiServer(fake_server_config)) for fake_server_config in fake_server_configs
+        ]
+        # Every document is converted in a spawned process, which starts out with none of the memory of this one, and
+        # is not reused for the next document
+        benchmark_executor: ProcessPoolExecutor = exit_stack.enter_context(
+            ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1)
+        )
+        for page_count in sorted(arguments.page_counts):
+            pdf_path: Path = Path(temporary_directory) / f"synthetic-{page_count}-pages.pdf"
+            create_synthetic_pdf(pdf_path, page_count, arguments.seed)
+            benchmark_result: dict[str, Any] = await asyncio.wrap_future(
+                benchmark_executor.submit(
+                    run_benchmark_process, arguments, [fake_server.endpoint for fake_server in fake_servers], pdf_path, page_count
+                )
+            )
+            print_benchmark_result(benchmark_result)
+            benchmark_results.append(benchmark_result)
+
+    if arguments.output:
+        benchmark_arguments: dict[str, Any] = vars(arguments) | {"output": str(arguments.output)}
+        arguments.output.write_text(json.dumps({"arguments": benchmark_arguments, "results": benchmark_results}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import time
 from pathlib import Path
@@ -7,16 +8,29 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from pdf_image_to_markdown.managers.gateways.azure_ad_token_provider import AzureAdTokenProvider
 from pdf_image_to_markdown.managers.models.azure_openai_config import AzureOpenAiConfig
+from pdf_image_to_markdown.managers.models.page_deduplication_config import PageDeduplicationConfig
+from pdf_image_to_markdown.managers.models.page_image_options import PageImageOptions
+from pdf_image_to_markdown.managers.models.request_hedging_config import RequestHedgingConfig
+from pdf_image_to_markdown.managers.models.response_cache_config import ResponseCacheConfig
 from pdf_image_to_markdown.managers.models.storage_account_config import StorageAccountConfig
 from pdf_image_to_markdown.managers.pdf_image_to_markdown_manager import PdfImageToMarkdownManager
 
 
 def get_configuration_settings() -> tuple[StorageAccountConfig, AzureOpenAiConfig]:
+    return get_storage_account_config(), get_azure_openai_config()
+
+
+def get_storage_account_config() -> StorageAccountConfig:
     # Azure Storage Configuration
     blob_container_url = os.getenv("BLOB_CONTAINER_URL")
     assert blob_container_url is not None, "BLOB_CONTAINER_URL environment variable is not set"
 
+    return StorageAccountConfig(blob_container_url, os.getenv("tokenProviderUrl"))
+
+
+def get_azure_openai_config() -> AzureOpenAiConfig:
     # Get Azure Open API related Configuration
     endpoint = os.getenv("OPENAI_ENDPOINT")
     assert endpoint is not None, "OPENAI_ENDPOINT environment variable is not set"
@@ -29,11 +43,112 @@ def get_configuration_settings() -> tuple[StorageAccountConfig, AzureOpenAiConfi
     # api_key or token_provider_url must be present
     api_key: Optional[str] = os.getenv("ACCESS_KEY")
     token_provider_url: Optional[str] = os.getenv("tokenProviderUrl")
-
-    azure_open_ai_config = AzureOpenAiConfig(endpoint, api_version, model_deployment_name, api_key, token_provider_url)
-    storage_account_config = StorageAccountConfig(blob_container_url, token_provider_url)
-
-    return storage_account_config, azure_open_ai_config
+    # Deployment quotas, used to schedule requests client-side instead of running into 429s
+    requests_per_minute: Optional[str] = os.getenv("REQUESTS_PER_MINUTE")
+    tokens_per_minute: Optional[str] = os.getenv("TOKENS_PER_MINUTE")
+
+    return AzureOpenAiConfig(
+        endpoint,
+        api_version,
+        model_deployment_name,
+        api_key,
+        token_provider_url,
+        requests_per_minute=int(requests_per_minute) if requests_per_minute else None,
+        tokens_per_minute=int(tokens_per_minute) if tokens_per_minute else None,
+    )
+
+
+def get_additional_azure_openai_configs(azure_open_ai_config: AzureOpenAiConfig) -> list[AzureOpenAiConfig]:
+    # Other deployments of the same model the requests are spread over, as a JSON list such as
+    # [{"endpoint": "https://...", "model_deployment_name": "gpt-4o", "api_key": "...", "tokens_per_minute": 450000}].
+    # The deployment name, API version and token provider url default to those of the main deployment.
+    additional_deployments: Optional[str] = os.getenv("ADDITIONAL_OPENAI_DEPLOYMENTS")
+    return [
+        AzureOpenAiConfig(
+            deployment["endpoint"],
+            deployment.get("api_version", azure_open_ai_config.api_version),
+            deployment.get("model_deployment_name", azure_open_ai_config.model_deployment_name),
+            deployment.get("api_key"),
+            None if deployment.get("api_key") else deployment.get("token_provider_url", azure_open_ai_config.token_provider_url),
+            max_tokens=azure_open_ai_config.max_tokens,
+            requests_per_minute=deployment.get("requests_per_minute"),
+            tokens_per_minute=deployment.get("tokens_per_minute"),
+        )
+        for deployment in (json.loads(additional_deployments) if additional_deployments else [])
+    ]
+
+
+def get_page_image_options() -> PageImageOptions:
+    # Page images default to 144 DPI PNGs. Lower DPIs, JPEG/WebP, grayscale and fitting the images to the vision
+    # model's tiles make every page (much) cheaper to encode and upload, at some cost in fidelity.
+    max_longest_side: Optional[str] = os.getenv("PAGE_IMAGE_MAX_LONGEST_SIDE")
+    return PageImageOptions(
+        dpi=int(os.getenv("PAGE_IMAGE_DPI", "144")),
+        max_longest_side=int(max_longest_side) if max_longest_side else None,
+        fit_to_vision_tiles=os.getenv("PAGE_IMAGE_FIT_TO_VISION_TILES", "false").lower() == "true",
+        grayscale_monochrome_pages=os.getenv("PAGE_IMAGE_GRAYSCALE", "false").lower() == "true",
+        image_format=os.getenv("PAGE_IMAGE_FORMAT", "PNG"),
+        quality=int(os.getenv("PAGE_IMAGE_QUALITY", "85")),
+        png_compress_level=int(os.getenv("PAGE_IMAGE_PNG_COMPRESS_LEVEL", "6")),
+        skip_blank_pages=os.getenv("SKIP_BLANK_PAGES", "false").lower() == "true",
+        crop_margins=os.getenv("CROP_PAGE_MARGINS", "false").lower() == "true",
+    )
+
+
+def create_pdf_image_to_markdown_manager(
+    azure_open_ai_config: AzureOpenAiConfig, azure_ad_token_provider: Optional[AzureAdTokenProvider] = None
+) -> PdfImageToMarkdownManager:
+    # Optional persistent cache of LLM responses, so re-runs of unchanged pages cost no tokens
+    response_cache_path: Optional[str] = os.getenv("RESPONSE_CACHE_PATH")
+    response_cache_config: Optional[ResponseCacheConfig] = ResponseCacheConfig(Path(response_cache_path)) if response_cache_path else None
+
+    # Only send pages whose markdown fails the local lint checks through the fix-up LLM call
+    skip_fixup_for_clean_pages: bool = os.getenv("SKIP_FIXUP_FOR_CLEAN_PAGES", "false").lower() == "true"
+
+    # Reuse the markdown of pages identical to ones converted before (within this run, or across runs with an index path)
+    page_index_path: Optional[str] = os.getenv("PAGE_INDEX_PATH")
+    page_deduplication_config: Optional[PageDeduplicationConfig] = (
+        PageDeduplicationConfig(Path(page_index_path) if page_index_path else None, int(os.getenv("PAGE_HASH_MAX_DISTANCE", "1")))
+        if os.getenv("DEDUPLICATE_PAGES", "false").lower() == "true"
+        else None
+    )
+
+    # Stream the vision completions, so markdown is cleaned up (and measured) as it is being generated. Their token usage is
+    # only reported with an OPENAI_API_VERSION from 2024-09-01 on.
+    stream_completions: bool = os.getenv("STREAM_COMPLETIONS", "false").lower() == "true"
+    # Send requests running longer than a percentile of the observed latencies a second time, using the first response
+    request_hedging_config: Optional[RequestHedgingConfig] = (
+        RequestHedgingConfig(float(os.getenv("HEDGE_LATENCY_PERCENTILE", "95")), float(os.getenv("HEDGE_MAX_REQUEST_RATIO", "0.1")))
+        if os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+        else None
+    )
+    # Estimate every request's max_tokens from its input instead of reserving the deployment's whole max_tokens against the quota
+    adaptive_max_tokens: bool = os.getenv("ADAPTIVE_MAX_TOKENS", "false").lower() == "true"
+    # Export per-stage spans and metrics through OpenTelemetry (when installed and configured)
+    enable_open_telemetry: bool = os.getenv("ENABLE_OPEN_TELEMETRY", "false").lower() == "true"
+
+    return PdfImageToMarkdownManager(
+        azure_open_ai_config,
+        response_cache_config,
+        skip_fixup_for_clean_pages,
+        get_page_image_options(),
+        page_deduplication_config,
+        enable_open_telemetry,
+        stream_completions,
+        azure_ad_token_provider,
+        get_additional_azure_openai_configs(azure_open_ai_config),
+        request_hedging_config,
+        adaptive_max_tokens,
+    )
+
+
+def print_page_deduplication_summary(pdf_image_to_markdown_manager: PdfImageToMarkdownManager) -> None:
+    page_deduplication_gateway = pdf_image_to_markdown_manager.page_deduplication_gateway
+    if page_deduplication_gateway is not None:
+        print(
+            f"Reused the markdown of {page_deduplication_gateway.duplicate_page_count} of {page_deduplication_gateway.page_count} "
+            f"pages ({page_deduplication_gateway.get_deduplication_ratio():.1%} deduplicated)"
+        )
 
 
 async def main() -> None:
@@ -41,16 +156,46 @@ async def main() -> None:
 
     # Get configuration settings from environment variables
     storage_account_config, azure_open_ai_config = get_configuration_settings()
-
-    pdf_image_to_markdown_manager = PdfImageToMarkdownManager(azure_open_ai_config)
+    pdf_image_to_markdown_manager = create_pdf_image_to_markdown_manager(azure_open_ai_config)
+
+    # Maximum number of pages being converted concurrently (and hence of in-flight LLM calls)
+    max_concurrency: int = int(os.getenv("MAX_CONCURRENCY", "1"))
+    # Maximum number of consecutive pages converted with one LLM call, and the estimated tokens such a call may use
+    batch_size: int = int(os.getenv("BATCH_SIZE", "1"))
+    batch_token_budget: Optional[str] = os.getenv("BATCH_TOKEN_BUDGET")
+    # Number of worker processes used to render and encode the PDF pages
+    render_workers: int = int(os.getenv("RENDER_WORKERS", "1"))
+    # Optional directory where per-page results are checkpointed so an interrupted conversion can be resumed
+    jobs_directory: Optional[str] = os.getenv("JOBS_DIRECTORY")
+    # Convert pages with a usable embedded text layer from their text instead of their image
+    use_text_layer: bool = os.getenv("USE_TEXT_LAYER", "false").lower() == "true"
 
     pdf_file_path_and_name: str = "Test Case RFx document.pdf"
-    markdown: str = await pdf_image_to_markdown_manager.get_markdown_for_pdf_document_using_page_images(pdf_file_path_and_name)
-    # markdown: str = await pdf_image_to_markdown_manager.get_markdown_for_pdf_document_using_plain_text(pdf_file_path_and_name)
-
-    markdown_file_path = pdf_file_path_and_name.replace(".pdf", ".md")
-    with Path(markdown_file_path).open("w", encoding="utf-8") as markdown_file:
-        markdown_file.write(markdown)
+    telemetry_gateway = pdf_image_to_markdown_manager.telemetry_gateway
+    try:
+        with telemetry_gateway.measure_document(Path(pdf_file_path_and_name).stem) as conversion_report:
+            markdown: str = await pdf_image_to_markdown_manager.get_markdown_for_pdf_document_using_page_images(
+                pdf_file_path_and_name,
+                batch_size=batch_size,
+                batch_token_budget=int(batch_token_budget) if batch_token_budget else None,
+                max_concurrency=max_concurrency,
+                render_workers=render_workers,
+                jobs_directory=Path(jobs_directory) if jobs_directory else None,
+                use_text_layer=use_text_layer,
+            )
+            # markdown: str = await pdf_image_to_markdown_manager.get_markdown_for_pdf_document_using_plain_text(pdf_file_path_and_name)
+
+            markdown_file_path = pdf_file_path_and_name.replace(".pdf", ".md")
+            with telemetry_gateway.measure("write_out"), Path(markdown_file_path).open("w", encoding="utf-8") as markdown_file:
+                markdown_file.write(markdown)
+    finally:
+        await pdf_image_to_markdown_manager.close()
+
+    print_page_deduplication_summary(pdf_image_to_markdown_manager)
+
+    # Where the time and the tokens of the conversion went, per stage
+    print(conversion_report)
+    Path(pdf_file_path_and_name.replace(".pdf", ".report.json")).write_text(conversion_report.to_json(), encoding="utf-8")
 
     end_time = time.perf_counter()
     elapsed_time = end_time - start_time
@@ -0,0 +1,124 @@
+import asyncio
+from pathlib import Path
+from types import TracebackType
+from typing import IO, Any, cast
+
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.identity.aio import DefaultAzureCredential
+from azure.storage.blob.aio import BlobClient, BlobServiceClient, StorageStreamDownloader
+
+from pdf_image_to_markdown.managers.exceptions.blob_move_file_exception import BlobMoveFileException
+from pdf_image_to_markdown.managers.gateways.blob_storage_gateway import BlobMoveFileEvent, FileInfo
+from pdf_image_to_markdown.managers.models.storage_account_config import StorageAccountConfig
+
+
+class AsyncBlobStorageGateway:
+    """
+    The asyncio counterpart of BlobStorageGateway, built on `azure.storage.blob.aio`, so transfers do not block
+    the event loop the LLM calls run on. A single service client (and so a single pooled HTTP session) is shared
+    by all operations, and large blobs are transferred in blocks, `max_concurrency` at a time.
+    """
+
+    def __init__(
+        self,
+        storage_account_config: StorageAccountConfig,
+        max_concurrency: int = 4,
+        block_size: int = 4 * 1024 * 1024,
+        credential: AsyncTokenCredential | None = None,
+    ) -> None:
+        self.container_name: str = storage_account_config.container_name
+        self.max_concurrency: int = max_concurrency
+        # A credential passed in (e.g. an AzureAdTokenProvider shared with the OpenAI client) is closed by its owner
+        self.owns_credential: bool = credential is None
+        self.credential: AsyncTokenCredential = credential or DefaultAzureCredential()
+        self.blob_service_client: BlobServiceClient = BlobServiceClient(
+            account_url=storage_account_config.blob_storage_endpoint,
+            credential=self.credential,
+            max_block_size=block_size,
+            max_single_put_size=block_size,
+            max_chunk_get_size=block_size,
+            max_single_get_size=block_size,
+        )
+        self.blob_container_client = self.blob_service_client.get_container_client(storage_account_config.container_name)
+
+    async def __aenter__(self) -> "AsyncBlobStorageGateway":
+        return self
+
+    async def __aexit__(self, exc_type: type[BaseException] | None, exc: BaseException | None, traceback: TracebackType | None) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        await self.blob_service_client.close()
+        if self.owns_credential:
+            await self.credential.close()
+
+    async def get_all_files_from_container(self, sub_container_path: str | None = None) -> list[FileInfo]:
+        files: list[FileInfo] = []
+        async for blob in self.blob_container_client.list_blobs(name_starts_with=sub_container_path):
+            file_info: FileInfo = FileInfo(
+                path=f"{Path(blob.name).parent}/",
+                path_and_name=blob.name,
+                file_name=Path(blob.name).name,
+                file_type=Path(blob.name).suffix[1:].upper(),
+            )
+            files.append(file_info)
+        return files
+
+    async def download_file_from_container(self, blob_name: str) -> bytes:
+        blob_client: BlobClient = self.blob_container_client.get_blob_client(blob_name)
+        storage_stream_downloader: StorageStreamDownloader[bytes] = await blob_client.download_blob(max_concurrency=self.max_concurrency)
+        return await storage_stream_downloader.readall()
+
+    async def download_file_to_stream(self, blob_name: str, stream: IO[bytes]) -> int:
+        """
+        Downloads a blob into a (seekable) stream, such as a temporary file, without ever holding the whole blob
+        in memory. Blocks are fetched `max_concurrency` at a time and written at their offsets as they arrive.
+
+        Returns:
+            The number of bytes downloaded.
+        """
+        blob_client: BlobClient = self.blob_container_client.get_blob_client(blob_name)
+        storage_stream_downloader: StorageStreamDownloader[bytes] = await blob_client.download_blob(max_concurrency=self.max_concurrency)
+        return await storage_stream_downloader.readinto(stream)
+
+    async def upload_file_to_container(self, file_path_and_name: str, file_bytes: bytes | IO[bytes], content_type: str) -> None:
+        blob_client: BlobClient = self.blob_container_client.get_blob_client(file_path_and_name)
+
+        options: dict[str, Any] = {}
+        if content_type:
+            options["content_type"] = content_type
+        if isinstance(file_bytes, bytes):
+            options["length"] = len(file_bytes)
+
+        await blob_client.upload_blob(
+            file_bytes, blob_type="BlockBlob", metadata=None, overwrite=True, max_concurrency=self.max_concurrency, **options
+        )
+
+    async def blob_exists(self, blob_name: str) -> bool:
+        blob_client: BlobClient = self.blob_container_client.get_blob_client(blob_name)
+        return await blob_client.exists()
+
+    async def move_file(self, source_blob_name: str, destination_blob_name: str, copy_status_poll_seconds: float = 1.0) -> None:
+        source_blob_client: BlobClient = self.blob_container_client.get_blob_client(source_blob_name)
+        destination_blob_client: BlobClient = self.blob_container_client.get_blob_client(destination_blob_name)
+
+        source_url: str = cast(str, source_blob_client.url)
+        copy_props: dict[str, Any] = await destination_blob_client.start_copy_from_url(source_url)
+        copy_status: str | None = copy_props["copy_status"]
+
+        # Copies within an account usually complete synchronously, larger ones are completed asynchronously
+        while copy_status == "pending":
+            await asyncio.sleep(copy_status_poll_seconds)
+            copy_status = (await destination_blob_client.get_blob_properties()).copy.status
+
+        if copy_status == "success":
+            await source_blob_client.delete_blob()
+            return
+        contextual_data: dict[str, Any] = {
+            "source_blob_name": source_blob_name,
+            "destination_blob_name": destination_blob_name,
+            "source_url": source_url,
+            "copy_status": copy_status,
+        }
+        message: str = f"Blob Copy operation failed with status: {copy_status}"
+        raise BlobMoveFileException(message, log_event=BlobMoveFileEvent.BlobMoveFileFailed, context_data=contextual_data)
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from collections.abc import Awaitable
+from types import TracebackType
+from typing import Any, Callable
+
+from azure.core.credentials import AccessToken
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.identity.aio import DefaultAzureCredential
+
+
+class AzureAdTokenProvider:
+    """
+    Caches Microsoft Entra ID (AAD) access tokens, so requests get their token without waiting for the
+    credential. The credential is asked for a new token ahead of the cached one's expiry, in the background,
+    and concurrent requests for a token that is not cached share a single call to the credential.
+
+    One provider is meant to be shared by all clients (OpenAI and blob storage) of a process. It is itself an
+    AsyncTokenCredential, so it can be passed as the `credential` of the Azure SDK's aio clients, and
+    `get_bearer_token_provider` adapts it to the `azure_ad_token_provider` of AsyncAzureOpenAI.
+    """
+
+    def __init__(self, credential: AsyncTokenCredential | None = None, refresh_margin_seconds: float = 300.0) -> None:
+        # The provider only closes the credential it created itself
+        self.owns_credential: bool = credential is None
+        self.credential: AsyncTokenCredential = credential or DefaultAzureCredential()
+        # Tokens expiring within this margin are refreshed. Until they are within a tenth of it, they are still handed
+        # out meanwhile.
+        self.refresh_margin_seconds: float = refresh_margin_seconds
+        self.access_tokens: dict[tuple[str, ...], AccessToken] = {}
+        self.refresh_tasks: dict[tuple[str, ...], asyncio.Task[AccessToken]] = {}
+
+    async def __aenter__(self) -> "AzureAdTokenProvider":
+        return self
+
+    async def __aexit__(self, exc_type: type[BaseException] | None, exc: BaseException | None, traceback: TracebackType | None) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        for refresh_task in self.refresh_tasks.values():
+            refresh_task.cancel()
+        self.refresh_tasks.clear()
+        if self.owns_credential:
+            await self.credential.close()
+
+    async def get_token(self, *scopes: str, claims: str | None = None, **kwargs: Any) -> AccessToken:
+        # A claims challenge asks for a token other than the cached one
+        if claims:
+            return await self.credential.get_token(*scopes, claims=claims, **kwargs)
+
+        access_token: AccessToken | None = self.access_tokens.get(scopes)
+        seconds_until_expiry: float = access_token.expires_on - time.time() if access_token is not None else 0.0
+        if access_token is not None and seconds_until_expiry > self.refresh_margin_seconds:
+            return access_token
+
+        refresh_task: asyncio.Task[AccessToken] = self.__get_refresh_task(scopes, kwargs)
+        # A token that is still valid for a while is handed out while it is being refreshed
+        if access_token is not None and seconds_until_expiry > self.refresh_margin_seconds / 10:
+            return access_token
+        return await asyncio.shield(refresh_task)
+
+    def get_bearer_token_provider(self, *scopes: str) -> Callable[[], Awaitable[str]]:
+        async def token_provider() -> str:
+            return (await self.get_token(*scopes)).token
+
+        return token_provider
+
+    def __get_refresh_task(self, scopes: tuple[str, ...], kwargs: dict[str, Any]) -> asyncio.Task[AccessToken]:
+        refresh_task: asyncio.Task[AccessToken] | None = self.refresh_tasks.get(scopes)
+        if refresh_task is None:
+            refresh_task = asyncio.create_task(self.__refresh_token(scopes, kwargs))
+            # A failed refresh in the background is retried by the next request, rather than reported as unhandled
+            refresh_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self.refresh_tasks[scopes] = refresh_task
+        return refresh_task
+
+    async def __refresh_token(self, scopes: tuple[str, ...], kwargs: dict[str, Any]) -> AccessToken:
+        try:
+            access_token: AccessToken = await self.credential.get_token(*scopes, **kwargs)
+            self.access_tokens[scopes] = access_token
+            return access_token
+        finally:
+            self.refresh_tasks.pop(scopes, None)
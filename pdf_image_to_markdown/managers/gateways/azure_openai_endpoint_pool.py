@@ -0,0 +1,192 @@
+import asyncio
+import time
+from collections.abc import Collection, Mapping
+from enum import Enum
+from urllib.parse import urlparse
+
+from openai import AsyncAzureOpenAI
+
+from pdf_image_to_markdown.managers.gateways.azure_openai_rate_limiter import AzureOpenAiRateLimiter
+from pdf_image_to_markdown.managers.models.azure_openai_config import AzureOpenAiConfig
+
+
+class CircuitState(Enum):
+    Closed = "closed"
+    Open = "open"
+    HalfOpen = "half-open"
+
+
+class AzureOpenAiEndpoint:
+    """A deployment of the pool, with its client, its optional rate limiter and what is known about its health."""
+
+    def __init__(self, config: AzureOpenAiConfig, client: AsyncAzureOpenAI, rate_limiter: AzureOpenAiRateLimiter | None) -> None:
+        self.config: AzureOpenAiConfig = config
+        self.client: AsyncAzureOpenAI = client
+        self.rate_limiter: AzureOpenAiRateLimiter | None = rate_limiter
+        self.name: str = f"{urlparse(config.endpoint).netloc}/{config.model_deployment_name}"
+        self.in_flight_count: int = 0
+        # Exponentially weighted moving averages of the latency of completed calls, and of failures (1) vs successes (0)
+        self.mean_latency_seconds: float | None = None
+        self.error_rate: float = 0.0
+        # The quota left in the deployment's current window, as last reported by its x-ratelimit-remaining-* headers
+        self.remaining_requests: int | None = None
+        self.remaining_tokens: int | None = None
+        self.quota_updated_at: float = 0.0
+        # Set by a 429's Retry-After
+        self.paused_until: float = 0.0
+        self.circuit_state: CircuitState = CircuitState.Closed
+        self.circuit_open_until: float = 0.0
+        self.consecutive_failure_count: int = 0
+        # The number of times in a row the circuit was opened, each time for longer
+        self.circuit_open_count: int = 0
+        self.is_trial_in_flight: bool = False
+
+
+class AzureOpenAiEndpointPool:
+    """
+    Spreads the requests over several Azure OpenAI deployments of the same model (e.g. in several regions, or
+    under several keys and subscriptions), so throughput is not capped by a single deployment's quota.
+
+    Every request goes to the deployment expected to complete it soonest, judging by its recent latency and
+    error rate, the requests already in flight on it and its remaining quota. A circuit breaker per deployment
+    ejects one that keeps failing (connection errors, 5xx) for a while, after which a single trial request
+    decides whether it is taken back. Throttled (429) deployments are skipped until their Retry-After passes.
+    """
+
+    LATENCY_SMOOTHING: float = 0.2
+    ERROR_RATE_SMOOTHING: float = 0.1
+    # How much a deployment's error rate counts against it, a deployment failing half its requests looks 3x slower
+    ERROR_RATE_PENALTY: float = 4.0
+    # Expected wait for a deployment whose reported quota is used up, scaled by the shortfall
+    QUOTA_EXHAUSTED_PENALTY_SECONDS: float = 30.0
+    # The remaining quota headers are for the current one-minute window
+    QUOTA_MAX_AGE_SECONDS: float = 60.0
+    DEFAULT_LATENCY_SECONDS: float = 1.0
+    CIRCUIT_FAILURE_THRESHOLD: int = 3
+    CIRCUIT_OPEN_SECONDS: float = 30.0
+    MAX_CIRCUIT_OPEN_SECONDS: float = 300.0
+
+    def __init__(self, endpoints: list[AzureOpenAiEndpoint]) -> None:
+        self.endpoints: list[AzureOpenAiEndpoint] = endpoints
+
+    async def acquire_endpoint(
+        self,
+        estimated_tokens: int,
+        excluded_endpoints: Collection[AzureOpenAiEndpoint] = (),
+        exhausted_endpoints: Collection[AzureOpenAiEndpoint] = (),
+    ) -> AzureOpenAiEndpoint:
+        """
+        Returns the deployment to send the request to, waiting while none can take it (all are paused or
+        ejected). `release_endpoint` must be called once the request is done. The excluded endpoints (e.g. the
+        ones a request already failed on) are only used when no other one is available, the exhausted ones (on
+        which it used up its retries) never are. A request with excluded endpoints is not made the trial request
+        of an ejected deployment while a healthy one is available.
+        """
+        usable_endpoints: list[AzureOpenAiEndpoint] = [endpoint for endpoint in self.endpoints if endpoint not in exhausted_endpoints]
+        while True:
+            now: float = time.monotonic()
+            available_endpoints: list[AzureOpenAiEndpoint] = [endpoint for endpoint in usable_endpoints if self.__is_available(endpoint, now)]
+            available_endpoints = [endpoint for endpoint in available_endpoints if endpoint not in excluded_endpoints] or available_endpoints
+            if excluded_endpoints:
+                available_endpoints = [
+                    endpoint for endpoint in available_endpoints if endpoint.circuit_state is CircuitState.Closed
+                ] or available_endpoints
+            if available_endpoints:
+                # A deployment whose ejection is over gets its trial request first, it would otherwise lose out to the
+                # healthy ones on its error rate, and never be taken back
+                endpoint: AzureOpenAiEndpoint = next(
+                    (endpoint for endpoint in available_endpoints if endpoint.circuit_state is CircuitState.HalfOpen),
+                    min(available_endpoints, key=lambda endpoint: self.__get_expected_seconds(endpoint, estimated_tokens, now)),
+                )
+                if endpoint.circuit_state is CircuitState.HalfOpen:
+                    endpoint.is_trial_in_flight = True
+                endpoint.in_flight_count += 1
+                return endpoint
+
+            available_at: float = min(max(endpoint.paused_until, endpoint.circuit_open_until) for endpoint in usable_endpoints)
+            # A half-open deployment becomes available when its trial request completes, which is polled for
+            await asyncio.sleep(min(max(available_at - now, 0.05), 1.0))
+
+    def release_endpoint(self, endpoint: AzureOpenAiEndpoint) -> None:
+        endpoint.in_flight_count -= 1
+        endpoint.is_trial_in_flight = False
+
+    def record_success(self, endpoint: AzureOpenAiEndpoint, headers: Mapping[str, str], latency_seconds: float | None) -> None:
+        """`latency_seconds` is None for streamed completions, whose calls return before the completion is done."""
+        if latency_seconds is not None:
+            endpoint.mean_latency_seconds = (
+                latency_seconds
+                if endpoint.mean_latency_seconds is None
+                else endpoint.mean_latency_seconds + self.LATENCY_SMOOTHING * (latency_seconds - endpoint.mean_latency_seconds)
+            )
+        endpoint.error_rate -= self.ERROR_RATE_SMOOTHING * endpoint.error_rate
+        endpoint.consecutive_failure_count = 0
+        if endpoint.circuit_state is not CircuitState.Closed:
+            print(f"Deployment {endpoint.name} is healthy again")
+        endpoint.circuit_state = CircuitState.Closed
+        endpoint.circuit_open_count = 0
+
+        remaining_requests: str | None = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens: str | None = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None and remaining_requests.isdigit():
+            endpoint.remaining_requests = int(remaining_requests)
+            endpoint.quota_updated_at = time.monotonic()
+        if remaining_tokens is not None and remaining_tokens.isdigit():
+            endpoint.remaining_tokens = int(remaining_tokens)
+            endpoint.quota_updated_at = time.monotonic()
+        if endpoint.rate_limiter is not None:
+            endpoint.rate_limiter.update_from_headers(headers)
+
+    def record_rate_limited(self, endpoint: AzureOpenAiEndpoint, headers: Mapping[str, str], default_seconds: float) -> None:
+        # Being throttled says nothing about the deployment's health, it is only skipped until it takes requests again
+        retry_after_seconds: float = AzureOpenAiRateLimiter.get_retry_after_seconds(headers, default_seconds)
+        endpoint.paused_until = max(endpoint.paused_until, time.monotonic() + retry_after_seconds)
+        endpoint.remaining_requests, endpoint.remaining_tokens = 0, 0
+        endpoint.quota_updated_at = time.monotonic()
+        if endpoint.rate_limiter is not None:
+            endpoint.rate_limiter.pause_from_headers(headers, default_seconds)
+
+    def record_failure(self, endpoint: AzureOpenAiEndpoint) -> None:
+        endpoint.error_rate += self.ERROR_RATE_SMOOTHING * (1.0 - endpoint.error_rate)
+        endpoint.consecutive_failure_count += 1
+        # A single deployment is never ejected, there would be nothing left to send the requests to
+        if len(self.endpoints) == 1:
+            return
+        # A failed trial request ejects the deployment again straight away, for longer
+        if endpoint.circuit_state is CircuitState.HalfOpen or endpoint.consecutive_failure_count >= self.CIRCUIT_FAILURE_THRESHOLD:
+            open_seconds: float = min(self.CIRCUIT_OPEN_SECONDS * 2**endpoint.circuit_open_count, self.MAX_CIRCUIT_OPEN_SECONDS)
+            endpoint.circuit_state = CircuitState.Open
+            endpoint.circuit_open_until = time.monotonic() + open_seconds
+            endpoint.circuit_open_count += 1
+            endpoint.consecutive_failure_count = 0
+            print(f"Ejected deployment {endpoint.name} for {open_seconds:.0f}s after repeated failures")
+
+    def __is_available(self, endpoint: AzureOpenAiEndpoint, now: float) -> bool:
+        if endpoint.paused_until > now:
+            return False
+        if endpoint.circuit_state is CircuitState.Open:
+            if endpoint.circuit_open_until > now:
+                return False
+            endpoint.circuit_state = CircuitState.HalfOpen
+        # A half-open deployment only gets a single trial request until it has proven to be healthy again
+        return endpoint.circuit_state is CircuitState.Closed or not endpoint.is_trial_in_flight
+
+    def __get_expected_seconds(self, endpoint: AzureOpenAiEndpoint, estimated_tokens: int, now: float) -> float:
+        # Deployments nothing is known about yet are assumed to be as fast as the ones that are known
+        known_latencies: list[float] = [endpoint.mean_latency_seconds for endpoint in self.endpoints if endpoint.mean_latency_seconds is not None]
+        latency_seconds: float = (
+            endpoint.mean_latency_seconds
+            if endpoint.mean_latency_seconds is not None
+            else (sum(known_latencies) / len(known_latencies) if known_latencies else self.DEFAULT_LATENCY_SECONDS)
+        )
+        # The requests in flight share the deployment's throughput, so a fast but busy deployment can lose out
+        expected_seconds: float = latency_seconds * (1 + endpoint.in_flight_count) * (1 + self.ERROR_RATE_PENALTY * endpoint.error_rate)
+
+        if endpoint.rate_limiter is not None:
+            expected_seconds += endpoint.rate_limiter.get_seconds_until_admitted(estimated_tokens)
+        elif now - endpoint.quota_updated_at < self.QUOTA_MAX_AGE_SECONDS:
+            if endpoint.remaining_requests is not None and endpoint.remaining_requests < 1:
+                expected_seconds += self.QUOTA_EXHAUSTED_PENALTY_SECONDS
+            elif endpoint.remaining_tokens is not None and endpoint.remaining_tokens < estimated_tokens:
+                expected_seconds += self.QUOTA_EXHAUSTED_PENALTY_SECONDS * (1 - endpoint.remaining_tokens / estimated_tokens)
+        return expected_seconds
@@ -0,0 +1,176 @@
+import asyncio
+import base64
+import io
+import math
+import time
+from collections.abc import Mapping
+from typing import Any
+
+from openai.types.chat import ChatCompletionMessageParam
+from PIL import Image
+
+
+class TokenBucket:
+    def __init__(self, capacity_per_minute: int) -> None:
+        self.capacity: float = float(capacity_per_minute)
+        self.refill_per_second: float = capacity_per_minute / 60.0
+        self.available: float = self.capacity
+        self.updated_at: float = time.monotonic()
+
+    def seconds_until_available(self, amount: float) -> float:
+        self.__refill()
+        # A single request larger than the whole bucket can never fit, so it only waits for a full bucket
+        shortfall: float = min(amount, self.capacity) - self.available
+        return max(shortfall, 0.0) / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        self.__refill()
+        self.available -= amount
+
+    def limit_to(self, remaining: float) -> None:
+        # The service's view of the quota also accounts for other clients of the same deployment, so it can
+        # only ever lower what this client believes to be available
+        self.__refill()
+        self.available = min(self.available, remaining)
+
+    def __refill(self) -> None:
+        now: float = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+
+class AzureOpenAiRateLimiter:
+    """
+    Client-side scheduler that keeps requests to an Azure OpenAI deployment within its requests-per-minute
+    and tokens-per-minute quotas, instead of relying on 429 responses and retries.
+
+    Every request reserves its estimated token cost (prompt, image tiles and max_tokens, which is what Azure
+    counts against the quota when admitting a request) before it is sent. The buckets are corrected from the
+    `x-ratelimit-remaining-*` response headers, and a `Retry-After` pauses all requests.
+    """
+
+    # Constants of the vision models' "high detail" image token accounting
+    IMAGE_BASE_TOKENS: int = 85
+    IMAGE_TILE_TOKENS: int = 170
+    IMAGE_TILE_SIZE: int = 512
+    CHARACTERS_PER_TOKEN: int = 4
+    # The length of the start of a base64 image read for its size (a multiple of 4, so it decodes on its own)
+    IMAGE_HEADER_BASE64_LENGTH: int = 4096
+
+    def __init__(self, requests_per_minute: int | None, tokens_per_minute: int | None) -> None:
+        self.request_bucket: TokenBucket | None = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket: TokenBucket | None = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until: float = 0.0
+        # Waiters are admitted one at a time, in arrival order, so a large request is not starved by small ones
+        self.lock: asyncio.Lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int) -> None:
+        async with self.lock:
+            while (wait_seconds := self.get_seconds_until_admitted(estimated_tokens)) > 0:
+                await asyncio.sleep(wait_seconds)
+
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(estimated_tokens)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        remaining_requests: str | None = headers.get("x-ratelimit-remaining-requests")
+        if self.request_bucket is not None and remaining_requests is not None and remaining_requests.isdigit():
+            self.request_bucket.limit_to(float(remaining_requests))
+
+        remaining_tokens: str | None = headers.get("x-ratelimit-remaining-tokens")
+        if self.token_bucket is not None and remaining_tokens is not None and remaining_tokens.isdigit():
+            self.token_bucket.limit_to(float(remaining_tokens))
+
+    def pause_from_headers(self, headers: Mapping[str, str], default_seconds: float) -> float:
+        retry_after_seconds: float = AzureOpenAiRateLimiter.get_retry_after_seconds(headers, default_seconds)
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after_seconds)
+        return retry_after_seconds
+
+    @staticmethod
+    def get_retry_after_seconds(headers: Mapping[str, str], default_seconds: float) -> float:
+        retry_after_ms: str | None = headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            try:
+                return float(retry_after_ms) / 1000.0
+            except ValueError:
+                pass
+        retry_after: str | None = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return default_seconds
+
+    @staticmethod
+    def estimate_request_tokens(messages: list[ChatCompletionMessageParam], max_tokens: int) -> int:
+        prompt_tokens: int = 0
+        for message in messages:
+            content: Any = message.get("content")
+            if isinstance(content, str):
+                prompt_tokens += math.ceil(len(content) / AzureOpenAiRateLimiter.CHARACTERS_PER_TOKEN)
+                continue
+            for content_part in content or []:
+                if content_part["type"] == "text":
+                    prompt_tokens += math.ceil(len(content_part["text"]) / AzureOpenAiRateLimiter.CHARACTERS_PER_TOKEN)
+                elif content_part["type"] == "image_url":
+                    prompt_tokens += AzureOpenAiRateLimiter.estimate_image_tokens(content_part["image_url"]["url"])
+        return prompt_tokens + max_tokens
+
+    @staticmethod
+    def estimate_image_tokens(image_data_uri: str) -> int:
+        # Only the start of the image is decoded, to read its size from its header. The whole image is only decoded
+        # when its header does not fit in that (e.g. a JPEG with large metadata).
+        image_base64: str = image_data_uri.partition(",")[2]
+        image_size: tuple[int, int] | None = AzureOpenAiRateLimiter.__get_image_size(
+            base64.b64decode(image_base64[: AzureOpenAiRateLimiter.IMAGE_HEADER_BASE64_LENGTH])
+        )
+        if image_size is None:
+            image_size = Image.open(io.BytesIO(base64.b64decode(image_base64))).size
+        return AzureOpenAiRateLimiter.estimate_image_size_tokens(*image_size)
+
+    @staticmethod
+    def __get_image_size(image_header: bytes) -> tuple[int, int] | None:
+        # Pillow reads all of a WebP image to open it, so the size of those is read from their first chunk instead
+        if image_header[:4] == b"RIFF" and image_header[8:12] == b"WEBP":
+            return AzureOpenAiRateLimiter.__get_webp_size(image_header)
+        try:
+            return Image.open(io.BytesIO(image_header)).size
+        except OSError:
+            return None
+
+    @staticmethod
+    def __get_webp_size(image_header: bytes) -> tuple[int, int] | None:
+        chunk_type: bytes = image_header[12:16]
+        if chunk_type == b"VP8X":
+            # The canvas size, stored minus one in 24 bits each
+            return int.from_bytes(image_header[24:27], "little") + 1, int.from_bytes(image_header[27:30], "little") + 1
+        if chunk_type == b"VP8L":
+            # Lossless, stored minus one in 14 bits each after the signature byte
+            size_bits: int = int.from_bytes(image_header[21:25], "little")
+            return (size_bits & 0x3FFF) + 1, ((size_bits >> 14) & 0x3FFF) + 1
+        if chunk_type == b"VP8 ":
+            # Lossy, in 14 bits each after the frame tag and start code
+            return int.from_bytes(image_header[26:28], "little") & 0x3FFF, int.from_bytes(image_header[28:30], "little") & 0x3FFF
+        return None
+
+    @staticmethod
+    def estimate_image_size_tokens(width: float, height: float) -> int:
+        # The image is scaled to fit within 2048x2048, then so that its shortest side is at most 768, and
+        # billed per 512x512 tile
+        fit_scale: float = min(1.0, 2048 / max(width, height))
+        width, height = width * fit_scale, height * fit_scale
+        shortest_side_scale: float = min(1.0, 768 / min(width, height))
+        width, height = width * shortest_side_scale, height * shortest_side_scale
+        tiles: int = math.ceil(width / AzureOpenAiRateLimiter.IMAGE_TILE_SIZE) * math.ceil(height / AzureOpenAiRateLimiter.IMAGE_TILE_SIZE)
+        return AzureOpenAiRateLimiter.IMAGE_BASE_TOKENS + AzureOpenAiRateLimiter.IMAGE_TILE_TOKENS * tiles
+
+    def get_seconds_until_admitted(self, estimated_tokens: int) -> float:
+        wait_seconds: float = self.paused_until - time.monotonic()
+        if self.request_bucket is not None:
+            wait_seconds = max(wait_seconds, self.request_bucket.seconds_until_available(1))
+        if self.token_bucket is not None:
+            wait_seconds = max(wait_seconds, self.token_bucket.seconds_until_available(estimated_tokens))
+        return wait_seconds
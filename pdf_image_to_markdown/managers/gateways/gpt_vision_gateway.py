@@ -1,128 +1,505 @@
+import asyncio
 import base64
+import json
+import time
+from collections.abc import AsyncIterator
 from pathlib import Path
-from typing import Callable
+from typing import Awaitable, Callable
 
-from azure.identity import DefaultAzureCredential
-from openai import AsyncAzureOpenAI
-from openai.types.chat import ChatCompletion, ChatCompletionMessageParam, ChatCompletionUserMessageParam
+from openai import APIConnectionError, AsyncAzureOpenAI, AsyncStream, InternalServerError, RateLimitError
+from openai._legacy_response import LegacyAPIResponse
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionAssistantMessageParam,
+    ChatCompletionChunk,
+    ChatCompletionMessageParam,
+    ChatCompletionSystemMessageParam,
+    ChatCompletionUserMessageParam,
+)
+from openai.types.completion_usage import CompletionUsage
 from openai.types.chat.chat_completion_content_part_image_param import ChatCompletionContentPartImageParam
 from openai.types.chat.chat_completion_content_part_param import ChatCompletionContentPartParam
 from openai.types.chat.chat_completion_content_part_text_param import ChatCompletionContentPartTextParam
 
+from pdf_image_to_markdown.managers.gateways.azure_ad_token_provider import AzureAdTokenProvider
+from pdf_image_to_markdown.managers.gateways.azure_openai_endpoint_pool import AzureOpenAiEndpoint, AzureOpenAiEndpointPool
+from pdf_image_to_markdown.managers.gateways.azure_openai_rate_limiter import AzureOpenAiRateLimiter
+from pdf_image_to_markdown.managers.gateways.request_hedging_policy import RequestHedgingPolicy
+from pdf_image_to_markdown.managers.gateways.response_cache_gateway import ResponseCacheGateway
+from pdf_image_to_markdown.managers.gateways.telemetry_gateway import TelemetryGateway
 from pdf_image_to_markdown.managers.models.azure_openai_config import AzureOpenAiConfig
+from pdf_image_to_markdown.managers.models.request_hedging_config import RequestHedgingConfig
+from pdf_image_to_markdown.managers.processors.markdown_continuation_stitcher import MarkdownContinuationStitcher
+
+# A page image is either an in-memory encoded image (PNG/JPEG/WebP bytes) or the path of an image file on disk
+ImageSource = bytes | memoryview | Path
 
 
 class GptVisionGateway:
-    def __init__(self, azure_openai_config: AzureOpenAiConfig, image_to_markdown_prompt: str) -> None:
+    # A completion cut off at max_tokens is continued by sending it back with this prompt, at most this many times
+    CONTINUATION_PROMPT: str = (
+        "Your previous response was cut off because it reached the maximum response length. Continue it exactly where it "
+        "stopped, starting with the very next character. Do not repeat any of it, and do not add any introduction or commentary."
+    )
+    MAX_CONTINUATION_COUNT: int = 4
+    # The first API version whose streamed completions report their usage (in a final chunk) when asked to with
+    # stream_options, earlier versions reject the parameter
+    STREAM_USAGE_MIN_API_VERSION: str = "2024-09-01"
+
+    def __init__(
+        self,
+        azure_openai_config: AzureOpenAiConfig,
+        image_to_markdown_prompt: str,
+        response_cache: ResponseCacheGateway | None = None,
+        telemetry_gateway: TelemetryGateway | None = None,
+        azure_ad_token_provider: AzureAdTokenProvider | None = None,
+        additional_azure_openai_configs: list[AzureOpenAiConfig] | None = None,
+        request_hedging_config: RequestHedgingConfig | None = None,
+    ) -> None:
+        """
+        Args:
+            additional_azure_openai_configs: Other deployments of the same model (e.g. in other regions, or under
+                other keys) the requests are spread over along with the one of `azure_openai_config`, which also
+                provides the max_tokens and the deployment name the responses are cached under.
+            request_hedging_config: When set, requests that are slow compared to similar ones are sent a second
+                time (to another deployment when there is one) and the first response is used. Streamed
+                completions are not hedged.
+        """
         self.config: AzureOpenAiConfig = azure_openai_config
         self.image_to_markdown_prompt: str = image_to_markdown_prompt
         self.max_tokens: int = azure_openai_config.max_tokens
+        self.temperature: float = 0.0
         self.model_deployment_name: str = azure_openai_config.model_deployment_name
-        self.client: AsyncAzureOpenAI = self.__create_client(azure_openai_config)
+        self.response_cache: ResponseCacheGateway | None = response_cache
+        self.telemetry_gateway: TelemetryGateway = telemetry_gateway or TelemetryGateway()
+        self.request_hedging_policy: RequestHedgingPolicy | None = (
+            RequestHedgingPolicy(request_hedging_config) if request_hedging_config is not None else None
+        )
+        azure_openai_configs: list[AzureOpenAiConfig] = [azure_openai_config, *(additional_azure_openai_configs or [])]
+        # All the deployments using Entra ID authentication share the cached tokens. A token provider passed in is closed by
+        # its owner, the gateway only closes the one it created itself.
+        self.owned_azure_ad_token_provider: AzureAdTokenProvider | None = None
+        if azure_ad_token_provider is None and any(config.token_provider_url for config in azure_openai_configs):
+            azure_ad_token_provider = self.owned_azure_ad_token_provider = AzureAdTokenProvider()
+        self.endpoint_pool: AzureOpenAiEndpointPool = AzureOpenAiEndpointPool(
+            [self.__create_endpoint(config, len(azure_openai_configs) > 1, azure_ad_token_provider) for config in azure_openai_configs]
+        )
+
+    async def close(self) -> None:
+        for endpoint in self.endpoint_pool.endpoints:
+            await endpoint.client.close()
+        if self.owned_azure_ad_token_provider is not None:
+            await self.owned_azure_ad_token_provider.close()
 
-    def __create_client(self, config: AzureOpenAiConfig) -> AsyncAzureOpenAI:
-        if config.token_provider_url:
-            credential: DefaultAzureCredential = DefaultAzureCredential()
-            token_provider: Callable[[], str] = self.__get_bearer_token_provider(credential, config.token_provider_url)
+    def __create_endpoint(
+        self, config: AzureOpenAiConfig, is_pooled: bool, azure_ad_token_provider: AzureAdTokenProvider | None
+    ) -> AzureOpenAiEndpoint:
+        rate_limiter: AzureOpenAiRateLimiter | None = (
+            AzureOpenAiRateLimiter(config.requests_per_minute, config.tokens_per_minute)
+            if config.requests_per_minute or config.tokens_per_minute
+            else None
+        )
+        # With a rate limiter or other deployments the gateway retries failed requests itself, so every retry goes
+        # through the limiter rather than around it, and can go to another deployment
+        max_retries: int = 0 if rate_limiter is not None or is_pooled else config.max_retries
+        return AzureOpenAiEndpoint(config, self.__create_client(config, max_retries, azure_ad_token_provider), rate_limiter)
+
+    @staticmethod
+    def __create_client(config: AzureOpenAiConfig, max_retries: int, azure_ad_token_provider: AzureAdTokenProvider | None) -> AsyncAzureOpenAI:
+        if config.token_provider_url and azure_ad_token_provider is not None:
+            # Tokens are cached and refreshed ahead of expiry, getting one does not block the event loop
+            token_provider: Callable[[], Awaitable[str]] = azure_ad_token_provider.get_bearer_token_provider(config.token_provider_url)
             return AsyncAzureOpenAI(
                 api_version=config.api_version,
                 azure_endpoint=config.endpoint,
                 azure_ad_token_provider=token_provider,
+                max_retries=max_retries,
             )
         return AsyncAzureOpenAI(
             api_version=config.api_version,
             azure_endpoint=config.endpoint,
             api_key=config.api_key,
+            max_retries=max_retries,
         )
 
-    def __get_bearer_token_provider(self, credential: DefaultAzureCredential, token_provider_url: str) -> Callable[[], str]:
-        def token_provider() -> str:
-            return credential.get_token(token_provider_url).token
-
-        return token_provider
-
-    def __encode_image_to_base64_uri(self, image_path: Path) -> str:
-        suffix: str = image_path.suffix.lower()
-        mime_type: str = "image/png" if suffix == ".png" else "image/jpeg"
-        with image_path.open("rb") as file:
-            encoded: bytes = base64.b64encode(file.read())
-        return f"data:{mime_type};base64,{encoded.decode('utf-8')}"
-
-    async def get_markdown_for_text(self, document_text: str, pdf_text_to_markdown_prompt_with_state: str) -> str:
-        response: ChatCompletion = await self.client.chat.completions.create(
-            model=self.model_deployment_name,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"{pdf_text_to_markdown_prompt_with_state}\n\n{document_text}",
-                }
-            ],
-            max_tokens=self.max_tokens,
-            temperature=0.0,
-        )
+    def __encode_image_to_base64_uri(self, image: ImageSource) -> str:
+        if isinstance(image, Path):
+            suffix: str = image.suffix.lower()
+            mime_type: str = "image/png" if suffix == ".png" else "image/jpeg"
+            with image.open("rb") as file:
+                encoded: bytes = base64.b64encode(file.read())
+            return f"data:{mime_type};base64,{encoded.decode('utf-8')}"
 
-        return response.choices[0].message.content or ""
-
-    async def fixup_and_clean_markdown(self, markdown_of_pages: str, markdown_fixup_clean_prompt: str) -> str:
-        response: ChatCompletion = await self.client.chat.completions.create(
-            model=self.model_deployment_name,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"{markdown_fixup_clean_prompt}\n\n{markdown_of_pages}",
-                }
-            ],
-            max_tokens=self.max_tokens,
-            temperature=0.0,
-        )
+        # In-memory buffers are base64-encoded in place, no copy or temporary file is made
+        encoded = base64.b64encode(image)
+        return f"data:{self.__get_image_mime_type(image)};base64,{encoded.decode('ascii')}"
+
+    @staticmethod
+    def __get_image_mime_type(image: bytes | memoryview) -> str:
+        signature: bytes = bytes(image[:12])
+        if signature.startswith(b"\x89PNG"):
+            return "image/png"
+        if signature.startswith(b"RIFF") and signature[8:12] == b"WEBP":
+            return "image/webp"
+        return "image/jpeg"
 
-        return response.choices[0].message.content or ""
+    # The prompts go into a system message of their own, ahead of the page's text or image, rather than being
+    # concatenated with them. The prompt is then the same leading bytes of every request, which Azure OpenAI
+    # serves from its prompt cache (at a discount and with less latency) once it has seen them.
+    #
+    # The max_tokens of a request defaults to the deployment's. A smaller one, estimated from the request's input,
+    # reserves less of the deployment's tokens-per-minute quota. A completion that outgrows it is continued with the
+    # deployment's max_tokens.
 
-    async def get_markdown_for_pages(self, image_paths: list[Path]) -> str:
-        text_part: ChatCompletionContentPartTextParam = {"type": "text", "text": self.image_to_markdown_prompt}
+    async def get_markdown_for_text(self, document_text: str, pdf_text_to_markdown_prompt_with_state: str, max_tokens: int | None = None) -> str:
+        messages: list[ChatCompletionMessageParam] = [
+            self.__create_system_message(pdf_text_to_markdown_prompt_with_state),
+            {
+                "role": "user",
+                "content": document_text,
+            },
+        ]
 
+        return await self.__get_chat_completion_content(messages, "text_call", max_tokens)
+
+    async def fixup_and_clean_markdown(self, markdown_of_pages: str, markdown_fixup_clean_prompt: str, max_tokens: int | None = None) -> str:
+        messages: list[ChatCompletionMessageParam] = [
+            self.__create_system_message(markdown_fixup_clean_prompt),
+            {
+                "role": "user",
+                "content": markdown_of_pages,
+            },
+        ]
+
+        return await self.__get_chat_completion_content(messages, "fixup_call", max_tokens)
+
+    async def get_markdown_for_pages(self, images: list[ImageSource], pages_prompt: str | None = None, max_tokens: int | None = None) -> str:
+        """
+        The pages are sent with the single page prompt as the system message, so it is cached along with that of
+        single pages. Instructions specific to the pages (e.g. how to separate them) go into the user message.
+        """
         content_parts: list[ChatCompletionContentPartParam] = []
-        content_parts.append(text_part)
+        if pages_prompt:
+            text_part: ChatCompletionContentPartTextParam = {"type": "text", "text": pages_prompt}
+            content_parts.append(text_part)
 
-        for image_path in image_paths:
+        for image in images:
             image_part: ChatCompletionContentPartImageParam = {
                 "type": "image_url",
-                "image_url": {"url": self.__encode_image_to_base64_uri(image_path)},
+                "image_url": {"url": self.__encode_image_to_base64_uri(image)},
             }
             content_parts.append(image_part)
 
         user_message: ChatCompletionUserMessageParam = {"role": "user", "content": content_parts}
 
-        messages: list[ChatCompletionMessageParam] = [user_message]
+        messages: list[ChatCompletionMessageParam] = [self.__create_system_message(self.image_to_markdown_prompt), user_message]
 
-        response: ChatCompletion = await self.client.chat.completions.create(
-            model=self.model_deployment_name,
-            messages=messages,
-            max_tokens=self.max_tokens,
-            temperature=0.0,
-        )
+        return await self.__get_chat_completion_content(messages, "vision_call", max_tokens)
+
+    async def get_markdown_for_page(self, image: ImageSource, max_tokens: int | None = None) -> str:
+        return await self.__get_chat_completion_content(self.__create_page_messages(image), "vision_call", max_tokens)
 
-        return response.choices[0].message.content or ""
+    async def stream_markdown_for_page(self, image: ImageSource, max_tokens: int | None = None) -> AsyncIterator[str]:
+        """
+        Yields the markdown of the page in chunks as it is being generated, rather than once the whole
+        completion (of up to max_tokens) is done.
+        """
+        async for content_chunk in self.__stream_chat_completion_content(self.__create_page_messages(image), "vision_call", max_tokens):
+            yield content_chunk
 
-    async def get_markdown_for_page(self, image_path_and_name: Path) -> str:
-        image_uri: str = self.__encode_image_to_base64_uri(image_path_and_name)
+    def __create_page_messages(self, image: ImageSource) -> list[ChatCompletionMessageParam]:
+        image_uri: str = self.__encode_image_to_base64_uri(image)
 
-        text_part: ChatCompletionContentPartTextParam = {"type": "text", "text": self.image_to_markdown_prompt}
         image_part: ChatCompletionContentPartImageParam = {"type": "image_url", "image_url": {"url": image_uri}}
 
         content_parts: list[ChatCompletionContentPartParam] = []
-        content_parts.append(text_part)
         content_parts.append(image_part)
 
         user_message: ChatCompletionUserMessageParam = {"role": "user", "content": content_parts}
 
-        messages: list[ChatCompletionMessageParam] = [user_message]
+        messages: list[ChatCompletionMessageParam] = [self.__create_system_message(self.image_to_markdown_prompt), user_message]
 
-        response: ChatCompletion = await self.client.chat.completions.create(
-            model=self.model_deployment_name,
-            messages=messages,
-            max_tokens=self.max_tokens,
-            temperature=0.0,
+        return messages
+
+    @staticmethod
+    def __create_system_message(prompt: str) -> ChatCompletionSystemMessageParam:
+        return {"role": "system", "content": prompt}
+
+    def __create_cache_key(self, messages: list[ChatCompletionMessageParam]) -> str:
+        # The messages carry the prompt and the page image (as a data URI) or text, so together with the
+        # deployment and the sampling parameters they fully determine the response. Only complete responses are
+        # cached, so those do not depend on the max_tokens of the request, only on that of the deployment.
+        return ResponseCacheGateway.create_key(
+            self.model_deployment_name, self.max_tokens, self.temperature, json.dumps(messages, ensure_ascii=False)
         )
 
-        return response.choices[0].message.content or ""
+    async def __get_chat_completion_content(self, messages: list[ChatCompletionMessageParam], stage: str, max_tokens: int | None) -> str:
+        cache_key: str | None = None
+        if self.response_cache is not None:
+            cache_key = self.__create_cache_key(messages)
+            cached_content: str | None = await self.response_cache.get(cache_key)
+            if cached_content is not None:
+                self.telemetry_gateway.record_cached_response()
+                return cached_content
+
+        content: str = ""
+        finish_reason: str | None = None
+        request_messages: list[ChatCompletionMessageParam] = messages
+        request_max_tokens: int = max_tokens or self.max_tokens
+        continuation_count: int = 0
+        # The duration of the call includes waiting for the rate limiter, retrying and continuing a cut off completion, which
+        # are also recorded on their own
+        with self.telemetry_gateway.measure(stage):
+            while True:
+                response: ChatCompletion = (
+                    await self.__create_hedged_chat_completion(request_messages, request_max_tokens, self.request_hedging_policy, stage)
+                    if self.request_hedging_policy is not None
+                    else await self.__create_chat_completion(request_messages, request_max_tokens)
+                )
+                if response.usage is not None:
+                    self.__record_usage(response.usage)
+                content = MarkdownContinuationStitcher.stitch(content, response.choices[0].message.content or "")
+                finish_reason = response.choices[0].finish_reason
+                if finish_reason != "length" or continuation_count >= self.MAX_CONTINUATION_COUNT:
+                    break
+                continuation_count += 1
+                self.telemetry_gateway.record_continuation()
+                request_messages = self.__create_continuation_messages(messages, content)
+                # A completion that outgrew its estimated max_tokens gets the deployment's for the rest of it
+                request_max_tokens = self.max_tokens
+
+        # Truncated or filtered responses are not cached so that a re-run gets another chance at them
+        if self.response_cache is not None and cache_key is not None and finish_reason == "stop":
+            await self.response_cache.put(cache_key, content)
+
+        return content
+
+    async def __stream_chat_completion_content(
+        self, messages: list[ChatCompletionMessageParam], stage: str, max_tokens: int | None
+    ) -> AsyncIterator[str]:
+        cache_key: str | None = None
+        if self.response_cache is not None:
+            cache_key = self.__create_cache_key(messages)
+            cached_content: str | None = await self.response_cache.get(cache_key)
+            if cached_content is not None:
+                self.telemetry_gateway.record_cached_response()
+                yield cached_content
+                return
+
+        content_chunks: list[str] = []
+        finish_reason: str | None = None
+        request_messages: list[ChatCompletionMessageParam] = messages
+        request_max_tokens: int = max_tokens or self.max_tokens
+        continuation_count: int = 0
+        with self.telemetry_gateway.measure(stage):
+            while True:
+                finish_reason = None
+                # The start of a continuation is held back until it is known how much of it repeats the content so far
+                held_back_content: str | None = "" if continuation_count else None
+                stream: AsyncStream[ChatCompletionChunk] = await self.__create_chat_completion(request_messages, request_max_tokens, stream=True)
+                async for chunk in stream:
+                    # With include_usage the last chunk carries the usage and no choices, Azure also sends a first
+                    # chunk with only the prompt filter results
+                    if chunk.usage is not None:
+                        self.__record_usage(chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    finish_reason = chunk.choices[0].finish_reason or finish_reason
+                    content_chunk: str | None = chunk.choices[0].delta.content
+                    if not content_chunk:
+                        continue
+                    if held_back_content is not None:
+                        held_back_content += content_chunk
+                        if len(held_back_content) <= MarkdownContinuationStitcher.MAX_OVERLAP_LENGTH:
+                            continue
+                        content_chunk = MarkdownContinuationStitcher.get_continuation_without_overlap("".join(content_chunks), held_back_content)
+                        held_back_content = None
+                    if content_chunk:
+                        content_chunks.append(content_chunk)
+                        yield content_chunk
+
+                # A continuation shorter than the overlap looked for
+                if held_back_content:
+                    content_chunk = MarkdownContinuationStitcher.get_continuation_without_overlap("".join(content_chunks), held_back_content)
+                    if content_chunk:
+                        content_chunks.append(content_chunk)
+                        yield content_chunk
+
+                if finish_reason != "length" or continuation_count >= self.MAX_CONTINUATION_COUNT:
+                    break
+                continuation_count += 1
+                self.telemetry_gateway.record_continuation()
+                request_messages = self.__create_continuation_messages(messages, "".join(content_chunks))
+                request_max_tokens = self.max_tokens
+
+        if self.response_cache is not None and cache_key is not None and finish_reason == "stop":
+            await self.response_cache.put(cache_key, "".join(content_chunks))
+
+    def __create_continuation_messages(self, messages: list[ChatCompletionMessageParam], content: str) -> list[ChatCompletionMessageParam]:
+        # The original messages stay the leading part of the request, so they are served from the prompt cache
+        assistant_message: ChatCompletionAssistantMessageParam = {"role": "assistant", "content": content}
+        user_message: ChatCompletionUserMessageParam = {"role": "user", "content": self.CONTINUATION_PROMPT}
+        return [*messages, assistant_message, user_message]
+
+    def __record_usage(self, usage: CompletionUsage) -> None:
+        # The part of the prompt that was served from the prompt cache, not reported by every API version
+        cached_tokens: int = (usage.prompt_tokens_details.cached_tokens or 0) if usage.prompt_tokens_details is not None else 0
+        self.telemetry_gateway.record_usage(usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+
+    async def __create_hedged_chat_completion(
+        self, messages: list[ChatCompletionMessageParam], max_tokens: int, request_hedging_policy: RequestHedgingPolicy, stage: str
+    ) -> ChatCompletion:
+        # The latency of a request grows with the number of page images it carries, so those are tracked apart
+        image_count: int = sum(
+            content_part["type"] == "image_url"
+            for message in messages
+            if isinstance(message.get("content"), list)
+            for content_part in message["content"]
+        )
+        request_kind: str = f"{stage}/{image_count}"
+        request_hedging_policy.record_request()
+        # The endpoint each request was last sent to, and when. A request is only sent once the rate limiter and an endpoint
+        # let it, the time it waits for them is not counted in its latency.
+        request_dispatches: dict[asyncio.Task | None, tuple[AzureOpenAiEndpoint, float]] = {}
+        request_dispatched: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+        def record_dispatch(endpoint: AzureOpenAiEndpoint, dispatch_time: float) -> None:
+            request_dispatches[asyncio.current_task()] = (endpoint, dispatch_time)
+            if not request_dispatched.done():
+                request_dispatched.set_result(None)
+
+        request_task: asyncio.Task[ChatCompletion] = asyncio.create_task(
+            self.__create_chat_completion(messages, max_tokens, on_dispatch=record_dispatch)
+        )
+        pending_tasks: set[asyncio.Task[ChatCompletion]] = {request_task}
+        try:
+            hedge_delay_seconds: float | None = request_hedging_policy.get_hedge_delay_seconds(request_kind)
+            if hedge_delay_seconds is not None:
+                # The hedge delay starts once the request is sent, a copy of a request still waiting to be sent would only wait too
+                await asyncio.wait({request_task, request_dispatched}, return_when=asyncio.FIRST_COMPLETED)
+                if not request_task.done():
+                    dispatch_time: float = request_dispatches[request_task][1]
+                    done_tasks, pending_tasks = await asyncio.wait(
+                        pending_tasks, timeout=max(dispatch_time + hedge_delay_seconds - time.perf_counter(), 0.0)
+                    )
+                    if not done_tasks and request_hedging_policy.try_hedge():
+                        self.telemetry_gateway.record_hedged_request()
+                        excluded_endpoint: AzureOpenAiEndpoint = request_dispatches[request_task][0]
+                        pending_tasks.add(
+                            asyncio.create_task(
+                                self.__create_chat_completion(messages, max_tokens, excluded_endpoint=excluded_endpoint, on_dispatch=record_dispatch)
+                            )
+                        )
+                    else:
+                        pending_tasks |= done_tasks
+
+            while True:
+                done_tasks, pending_tasks = await asyncio.wait(pending_tasks, return_when=asyncio.FIRST_COMPLETED)
+                completed_task: asyncio.Task[ChatCompletion] | None = next(
+                    (task for task in done_tasks if not task.cancelled() and task.exception() is None), None
+                )
+                # When the first request to complete failed, the other one still gets its chance
+                if completed_task is not None or not pending_tasks:
+                    response: ChatCompletion = (completed_task or done_tasks.pop()).result()
+                    latency_seconds: float = time.perf_counter() - request_dispatches[completed_task][1]
+                    break
+        finally:
+            # The slower request is cancelled, which closes its connection so the deployment stops generating it
+            for pending_task in pending_tasks:
+                pending_task.cancel()
+            await asyncio.gather(*pending_tasks, return_exceptions=True)
+
+        request_hedging_policy.record_latency(request_kind, latency_seconds)
+        return response
+
+    async def __create_chat_completion(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        max_tokens: int,
+        stream: bool = False,
+        excluded_endpoint: AzureOpenAiEndpoint | None = None,
+        on_dispatch: Callable[[AzureOpenAiEndpoint, float], None] | None = None,
+    ) -> ChatCompletion | AsyncStream[ChatCompletionChunk]:
+        """
+        Args:
+            excluded_endpoint: An endpoint the request is only sent to when no other one is available.
+            on_dispatch: When given, called with the endpoint and the time (of time.perf_counter) whenever the request is sent.
+        """
+        endpoints: list[AzureOpenAiEndpoint] = self.endpoint_pool.endpoints
+        if len(endpoints) == 1 and endpoints[0].rate_limiter is None:
+            if on_dispatch is not None:
+                on_dispatch(endpoints[0], time.perf_counter())
+            return await endpoints[0].client.chat.completions.create(
+                model=endpoints[0].config.model_deployment_name,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=self.temperature,
+                **self.__get_stream_arguments(endpoints[0].config, stream),
+            )
+
+        estimated_tokens: int = AzureOpenAiRateLimiter.estimate_request_tokens(messages, max_tokens)
+        # The number of times the request failed on each deployment, and how long it backs off before it is sent to one
+        # again. Every deployment allows max_retries retries of its own, the request fails once all of them are used up.
+        failure_counts: dict[AzureOpenAiEndpoint, int] = {}
+        backoff_seconds: dict[AzureOpenAiEndpoint, float] = {}
+        while True:
+            excluded_endpoints: list[AzureOpenAiEndpoint] = [*failure_counts, *([excluded_endpoint] if excluded_endpoint is not None else [])]
+            exhausted_endpoints: list[AzureOpenAiEndpoint] = [
+                endpoint for endpoint, failure_count in failure_counts.items() if failure_count > endpoint.config.max_retries
+            ]
+            with self.telemetry_gateway.measure("rate_limit_wait"):
+                endpoint: AzureOpenAiEndpoint = await self.endpoint_pool.acquire_endpoint(estimated_tokens, excluded_endpoints, exhausted_endpoints)
+            try:
+                # A request that failed is retried on another deployment straight away, it only backs off when there is none
+                if endpoint in backoff_seconds:
+                    await asyncio.sleep(backoff_seconds[endpoint])
+                if endpoint.rate_limiter is not None:
+                    with self.telemetry_gateway.measure("rate_limit_wait"):
+                        await endpoint.rate_limiter.acquire(estimated_tokens)
+                start_time: float = time.perf_counter()
+                if on_dispatch is not None:
+                    on_dispatch(endpoint, start_time)
+                raw_response: LegacyAPIResponse[ChatCompletion | AsyncStream[ChatCompletionChunk]] = (
+                    await endpoint.client.chat.completions.with_raw_response.create(
+                        model=endpoint.config.model_deployment_name,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=self.temperature,
+                        **self.__get_stream_arguments(endpoint.config, stream),
+                    )
+                )
+            except RateLimitError as e:
+                failure_counts[endpoint] = failure_counts.get(endpoint, 0) + 1
+                # Every request queued for the deployment waits out the Retry-After, not just this one
+                self.endpoint_pool.record_rate_limited(endpoint, e.response.headers, default_seconds=2.0 ** (failure_counts[endpoint] - 1))
+                if self.__is_retry_budget_used_up(failure_counts):
+                    raise
+                self.telemetry_gateway.record_retry()
+                backoff_seconds[endpoint] = 0.0
+            except (APIConnectionError, InternalServerError):
+                failure_counts[endpoint] = failure_counts.get(endpoint, 0) + 1
+                self.endpoint_pool.record_failure(endpoint)
+                if self.__is_retry_budget_used_up(failure_counts):
+                    raise
+                self.telemetry_gateway.record_retry()
+                backoff_seconds[endpoint] = min(2.0 ** (failure_counts[endpoint] - 1), 30.0)
+            else:
+                # A streamed call returns once the response starts, so its duration is not the completion's latency
+                latency_seconds: float | None = None if stream else time.perf_counter() - start_time
+                self.endpoint_pool.record_success(endpoint, raw_response.headers, latency_seconds)
+                return raw_response.parse()
+            finally:
+                self.endpoint_pool.release_endpoint(endpoint)
+
+    def __is_retry_budget_used_up(self, failure_counts: dict[AzureOpenAiEndpoint, int]) -> bool:
+        return all(failure_counts.get(endpoint, 0) > endpoint.config.max_retries for endpoint in self.endpoint_pool.endpoints)
+
+    @staticmethod
+    def __get_stream_arguments(config: AzureOpenAiConfig, stream: bool) -> dict:
+        if not stream:
+            return {}
+        # The usage of a streamed completion is only reported when asked for. With older API versions the streamed
+        # completions' tokens go unreported instead.
+        if config.api_version[:10] < GptVisionGateway.STREAM_USAGE_MIN_API_VERSION:
+            return {"stream": True}
+        return {"stream": True, "stream_options": {"include_usage": True}}
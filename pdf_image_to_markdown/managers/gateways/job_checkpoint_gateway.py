@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+from enum import Enum
+from pathlib import Path
+
+from pdf_image_to_markdown.managers.processors.pdf_document_page_image_extractor import PdfSource
+
+
+class JobCheckpointStage(Enum):
+    RawMarkdown = "raw"
+    MarkdownWithoutMarkers = "without-markers"
+    FixedupMarkdown = "fixed"
+    TocFromContent = "toc"
+
+
+class JobCheckpointGateway:
+    """
+    Persists the per-page results of a document conversion to a job directory keyed by the hash of the
+    document, so a conversion that is interrupted (a crash, a 429 storm) can be restarted and only re-issue
+    the requests for the pages that had not completed yet.
+
+    Each stage of a page (or batch of pages) is stored in its own file. Files are written atomically, so a
+    file that exists always holds a complete result. Hashing the document and the file I/O run on worker
+    threads, so they do not stall the requests in flight on the event loop.
+    """
+
+    def __init__(self, jobs_directory: Path, document_hash: str) -> None:
+        self.document_hash: str = document_hash
+        self.job_directory: Path = jobs_directory / self.document_hash
+        self.job_directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    async def create(jobs_directory: Path, pdf_source: PdfSource) -> "JobCheckpointGateway":
+        document_hash: str = await asyncio.to_thread(JobCheckpointGateway.__get_document_hash, pdf_source)
+        return await asyncio.to_thread(JobCheckpointGateway, jobs_directory, document_hash)
+
+    async def read_stage(self, first_page_number: int, last_page_number: int, stage: JobCheckpointStage) -> str | None:
+        return await asyncio.to_thread(self.__read_stage, first_page_number, last_page_number, stage)
+
+    async def write_stage(self, first_page_number: int, last_page_number: int, stage: JobCheckpointStage, content: str) -> None:
+        await asyncio.to_thread(self.__write_stage, first_page_number, last_page_number, stage, content)
+
+    async def read_toc_from_content(self, first_page_number: int, last_page_number: int) -> list[str] | None:
+        toc_json: str | None = await self.read_stage(first_page_number, last_page_number, JobCheckpointStage.TocFromContent)
+        return json.loads(toc_json) if toc_json is not None else None
+
+    async def write_toc_from_content(self, first_page_number: int, last_page_number: int, toc_from_content: list[str] | None) -> None:
+        await self.write_stage(first_page_number, last_page_number, JobCheckpointStage.TocFromContent, json.dumps(toc_from_content))
+
+    def __read_stage(self, first_page_number: int, last_page_number: int, stage: JobCheckpointStage) -> str | None:
+        stage_path: Path = self.__get_stage_path(first_page_number, last_page_number, stage)
+        if not stage_path.exists():
+            return None
+        return stage_path.read_text(encoding="utf-8")
+
+    def __write_stage(self, first_page_number: int, last_page_number: int, stage: JobCheckpointStage, content: str) -> None:
+        stage_path: Path = self.__get_stage_path(first_page_number, last_page_number, stage)
+        # Every write has a temporary file of its own, so concurrent runs on the same document never move one another's
+        # half-written file into place
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=self.job_directory, prefix=f"{stage_path.name}.", suffix=".tmp", delete=False
+        ) as temporary_file:
+            temporary_file.write(content)
+        os.replace(temporary_file.name, stage_path)
+
+    @staticmethod
+    def __get_document_hash(pdf_source: PdfSource) -> str:
+        if isinstance(pdf_source, bytes):
+            return hashlib.sha256(pdf_source).hexdigest()
+
+        sha256 = hashlib.sha256()
+        with pdf_source.open("rb") as pdf_file:
+            while chunk := pdf_file.read(1024 * 1024):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def __get_stage_path(self, first_page_number: int, last_page_number: int, stage: JobCheckpointStage) -> Path:
+        # The page range is part of the name so results are not reused if the run's batch size changes
+        extension: str = "json" if stage is JobCheckpointStage.TocFromContent else "md"
+        return self.job_directory / f"pages-{first_page_number:04d}-{last_page_number:04d}.{stage.value}.{extension}"
@@ -0,0 +1,84 @@
+import asyncio
+import shutil
+from pathlib import Path
+from types import TracebackType
+from typing import IO
+
+from pdf_image_to_markdown.managers.gateways.blob_storage_gateway import FileInfo
+
+
+class LocalFileStorageGateway:
+    """
+    A local filesystem stand-in for AsyncBlobStorageGateway with the same methods, where a root directory plays
+    the part of the blob container and blob names are paths relative to it. Useful to run batch conversions
+    over local folders and to exercise them without a storage account. File operations run on worker threads.
+    """
+
+    def __init__(self, root_directory: Path) -> None:
+        self.root_directory: Path = root_directory
+        self.root_directory.mkdir(parents=True, exist_ok=True)
+
+    async def __aenter__(self) -> "LocalFileStorageGateway":
+        return self
+
+    async def __aexit__(self, exc_type: type[BaseException] | None, exc: BaseException | None, traceback: TracebackType | None) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        pass
+
+    async def get_all_files_from_container(self, sub_container_path: str | None = None) -> list[FileInfo]:
+        return await asyncio.to_thread(self.__get_all_files_from_container, sub_container_path)
+
+    async def download_file_from_container(self, blob_name: str) -> bytes:
+        return await asyncio.to_thread((self.root_directory / blob_name).read_bytes)
+
+    async def download_file_to_stream(self, blob_name: str, stream: IO[bytes]) -> int:
+        return await asyncio.to_thread(self.__copy_file_to_stream, self.root_directory / blob_name, stream)
+
+    async def upload_file_to_container(self, file_path_and_name: str, file_bytes: bytes | IO[bytes], content_type: str) -> None:
+        await asyncio.to_thread(self.__write_file, self.root_directory / file_path_and_name, file_bytes)
+
+    async def blob_exists(self, blob_name: str) -> bool:
+        return await asyncio.to_thread((self.root_directory / blob_name).is_file)
+
+    async def move_file(self, source_blob_name: str, destination_blob_name: str) -> None:
+        await asyncio.to_thread(self.__move_file, self.root_directory / source_blob_name, self.root_directory / destination_blob_name)
+
+    def __get_all_files_from_container(self, sub_container_path: str | None) -> list[FileInfo]:
+        files: list[FileInfo] = []
+        for file_path in sorted(self.root_directory.rglob("*")):
+            if not file_path.is_file():
+                continue
+            blob_name: str = file_path.relative_to(self.root_directory).as_posix()
+            if sub_container_path and not blob_name.startswith(sub_container_path):
+                continue
+
+            file_info: FileInfo = FileInfo(
+                path=f"{Path(blob_name).parent}/",
+                path_and_name=blob_name,
+                file_name=Path(blob_name).name,
+                file_type=Path(blob_name).suffix[1:].upper(),
+            )
+            files.append(file_info)
+        return files
+
+    @staticmethod
+    def __copy_file_to_stream(file_path: Path, stream: IO[bytes]) -> int:
+        with file_path.open("rb") as source_file:
+            shutil.copyfileobj(source_file, stream)
+        return file_path.stat().st_size
+
+    @staticmethod
+    def __write_file(file_path: Path, file_bytes: bytes | IO[bytes]) -> None:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(file_bytes, bytes):
+            file_path.write_bytes(file_bytes)
+            return
+        with file_path.open("wb") as destination_file:
+            shutil.copyfileobj(file_bytes, destination_file)
+
+    @staticmethod
+    def __move_file(source_path: Path, destination_path: Path) -> None:
+        destination_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(source_path, destination_path)
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import sqlite3
+import threading
+
+from pdf_image_to_markdown.managers.models.page_deduplication_config import PageDeduplicationConfig
+from pdf_image_to_markdown.managers.models.page_hash import PageHash
+from pdf_image_to_markdown.managers.processors.page_image_hasher import PageImageHasher
+
+# The finished markdown of a page and the table of contents extracted from it (markdown is None for pages
+# without meaningful content)
+PageMarkdown = tuple[str | None, list[str] | None]
+
+
+class PageDeduplicationGateway:
+    """
+    Finds pages that are identical, or nearly so, to a page converted earlier, so that their markdown is
+    reused instead of being requested again.
+
+    Pages converted in the current run are matched in memory, including pages that are still being converted
+    (the duplicate waits for their result). With a database path, finished pages are also kept in a SQLite
+    index of page hash -> markdown, so boilerplate pages are only ever converted once across a corpus.
+    Entries are scoped by a conversion key (deployment, prompts), so changing either does not reuse markdown
+    produced by the previous ones.
+    """
+
+    PHASH_BAND_COUNT: int = 4
+    PHASH_BAND_BITS: int = 16
+
+    def __init__(self, page_deduplication_config: PageDeduplicationConfig, conversion_key: str) -> None:
+        self.max_hash_distance: int = page_deduplication_config.max_hash_distance
+        self.conversion_key: str = conversion_key
+        self.run_pages: list[tuple[PageHash, asyncio.Future[PageMarkdown | None]]] = []
+        self.page_count: int = 0
+        self.duplicate_page_count: int = 0
+
+        self.lock: threading.Lock = threading.Lock()
+        self.connection: sqlite3.Connection | None = None
+        if page_deduplication_config.database_path is not None:
+            page_deduplication_config.database_path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(page_deduplication_config.database_path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS pages (conversion_key TEXT NOT NULL, phash TEXT NOT NULL, dhash TEXT NOT NULL, "
+                "band0 INTEGER NOT NULL, band1 INTEGER NOT NULL, band2 INTEGER NOT NULL, band3 INTEGER NOT NULL, "
+                "markdown TEXT, toc TEXT, PRIMARY KEY (conversion_key, phash, dhash))"
+            )
+            for band_index in range(self.PHASH_BAND_COUNT):
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS pages_band{band_index} ON pages (conversion_key, band{band_index})")
+            self.connection.commit()
+
+    async def find_duplicate(self, page_hash: PageHash) -> PageMarkdown | None:
+        """
+        Returns the markdown of an earlier page that is the same as this one. Otherwise the page is reserved
+        and None is returned, in which case `complete` (or `abandon`) must be called once it is converted, so
+        that duplicates of it waiting in the meantime get its markdown.
+        """
+        return await self.get_duplicate(page_hash, self.reserve_page(page_hash))
+
+    def reserve_page(self, page_hash: PageHash) -> asyncio.Future[PageMarkdown | None] | None:
+        """
+        The first, synchronous, half of `find_duplicate`: returns the (pending) markdown of a page of this run that
+        is the same as this one, otherwise reserves this page and returns None. Several pages converted together
+        are reserved in page order this way, so a page only ever waits for pages before it.
+        """
+        self.page_count += 1
+        for run_page_hash, run_page_future in self.run_pages:
+            if PageImageHasher.is_same_page(page_hash, run_page_hash, self.max_hash_distance):
+                return run_page_future
+
+        # The page is reserved before the index is consulted, so concurrent duplicates wait for it
+        self.run_pages.append((page_hash, asyncio.get_running_loop().create_future()))
+        return None
+
+    async def get_duplicate(self, page_hash: PageHash, run_page_future: asyncio.Future[PageMarkdown | None] | None) -> PageMarkdown | None:
+        """
+        The second half of `find_duplicate`, given what `reserve_page` returned for the page. When it fails or is
+        cancelled, the page's reservation is abandoned, so its duplicates do not wait for it forever.
+        """
+        try:
+            if run_page_future is not None:
+                # A failed conversion of the earlier page yields None, and this page is converted after all
+                run_page_markdown: PageMarkdown | None = await asyncio.shield(run_page_future)
+                if run_page_markdown is not None:
+                    self.duplicate_page_count += 1
+                    return run_page_markdown
+                self.run_pages.append((page_hash, asyncio.get_running_loop().create_future()))
+
+            indexed_page_markdown: PageMarkdown | None = await asyncio.to_thread(self.__find_indexed_page, page_hash) if self.connection else None
+        except BaseException:
+            self.abandon(page_hash)
+            raise
+
+        if indexed_page_markdown is not None:
+            self.__get_run_page_future(page_hash).set_result(indexed_page_markdown)
+            self.duplicate_page_count += 1
+            return indexed_page_markdown
+
+        return None
+
+    async def complete(self, page_hash: PageHash, page_markdown: PageMarkdown) -> None:
+        self.__get_run_page_future(page_hash).set_result(page_markdown)
+        if self.connection is not None:
+            await asyncio.to_thread(self.__index_page, page_hash, page_markdown)
+
+    def abandon(self, page_hash: PageHash) -> None:
+        # A page without a reservation (it waited for an earlier page, or its reservation was already abandoned) has none to abandon
+        page_future: asyncio.Future[PageMarkdown | None] | None = next(
+            (run_page_future for run_page_hash, run_page_future in self.run_pages if run_page_hash is page_hash), None
+        )
+        if page_future is None:
+            return
+        page_future.set_result(None)
+        self.run_pages = [(run_page_hash, run_page_future) for run_page_hash, run_page_future in self.run_pages if run_page_future is not page_future]
+
+    def get_deduplication_ratio(self) -> float:
+        return self.duplicate_page_count / self.page_count if self.page_count else 0.0
+
+    def close(self) -> None:
+        if self.connection is not None:
+            with self.lock:
+                self.connection.close()
+
+    def __get_run_page_future(self, page_hash: PageHash) -> asyncio.Future[PageMarkdown | None]:
+        return next(run_page_future for run_page_hash, run_page_future in self.run_pages if run_page_hash is page_hash)
+
+    def __get_phash_bands(self, phash: int) -> list[int]:
+        band_mask: int = (1 << self.PHASH_BAND_BITS) - 1
+        return [(phash >> (band_index * self.PHASH_BAND_BITS)) & band_mask for band_index in range(self.PHASH_BAND_COUNT)]
+
+    def __find_indexed_page(self, page_hash: PageHash) -> PageMarkdown | None:
+        # Hashes within a distance of 3 bits have at least one of the four bands in common, so the candidates
+        # are found through the band indexes and then compared in full
+        bands: list[int] = self.__get_phash_bands(page_hash.phash)
+        band_conditions: str = " OR ".join(f"band{band_index} = ?" for band_index in range(self.PHASH_BAND_COUNT))
+        with self.lock:
+            assert self.connection is not None
+            rows: list[tuple[str, str, str | None, str | None]] = self.connection.execute(
+                f"SELECT phash, dhash, markdown, toc FROM pages WHERE conversion_key = ? AND ({band_conditions})", (self.conversion_key, *bands)
+            ).fetchall()
+
+        for phash, dhash, markdown, toc in rows:
+            if PageImageHasher.is_same_page(page_hash, PageHash(int(phash, 16), int(dhash, 16)), self.max_hash_distance):
+                return markdown, json.loads(toc) if toc is not None else None
+        return None
+
+    def __index_page(self, page_hash: PageHash, page_markdown: PageMarkdown) -> None:
+        markdown, toc = page_markdown
+        with self.lock:
+            assert self.connection is not None
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages (conversion_key, phash, dhash, band0, band1, band2, band3, markdown, toc) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.conversion_key,
+                    f"{page_hash.phash:016x}",
+                    f"{page_hash.dhash:064x}",
+                    *self.__get_phash_bands(page_hash.phash),
+                    markdown,
+                    json.dumps(toc) if toc is not None else None,
+                ),
+            )
+            self.connection.commit()
@@ -0,0 +1,45 @@
+import math
+from collections import deque
+
+from pdf_image_to_markdown.managers.models.request_hedging_config import RequestHedgingConfig
+
+
+class RequestHedgingPolicy:
+    """
+    Decides when a slow request is hedged, i.e. sent a second time so that whichever response comes first is used.
+    A few requests take several times the median latency, and since the pages of a document are assembled in
+    order, those outliers decide when the document is done.
+
+    The latencies are tracked per kind of request (e.g. the vision call of a single page vs of several pages), a
+    request is hedged once it has been running for longer than the configured percentile of those of its kind.
+    """
+
+    # Only the most recent latencies count, so the percentile follows the deployments' load
+    LATENCY_WINDOW_SIZE: int = 200
+
+    def __init__(self, request_hedging_config: RequestHedgingConfig) -> None:
+        self.config: RequestHedgingConfig = request_hedging_config
+        self.latencies: dict[str, deque[float]] = {}
+        self.request_count: int = 0
+        self.hedged_request_count: int = 0
+
+    def get_hedge_delay_seconds(self, request_kind: str) -> float | None:
+        """Returns how long a request of the kind runs before it is hedged, None when too few have completed to tell."""
+        latencies: deque[float] | None = self.latencies.get(request_kind)
+        if latencies is None or len(latencies) < self.config.min_latency_samples:
+            return None
+        sorted_latencies: list[float] = sorted(latencies)
+        return sorted_latencies[max(math.ceil(self.config.latency_percentile / 100 * len(sorted_latencies)) - 1, 0)]
+
+    def record_request(self) -> None:
+        self.request_count += 1
+
+    def try_hedge(self) -> bool:
+        """Returns whether a request may be hedged, counting it as hedged when it may."""
+        if self.hedged_request_count + 1 > self.config.max_hedged_request_ratio * self.request_count:
+            return False
+        self.hedged_request_count += 1
+        return True
+
+    def record_latency(self, request_kind: str, seconds: float) -> None:
+        self.latencies.setdefault(request_kind, deque(maxlen=self.LATENCY_WINDOW_SIZE)).append(seconds)
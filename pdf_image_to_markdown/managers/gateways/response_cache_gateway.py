@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+
+from pdf_image_to_markdown.managers.models.response_cache_config import ResponseCacheConfig
+
+
+class ResponseCacheGateway:
+    """
+    A persistent, content-addressed store of LLM responses backed by a local SQLite database.
+
+    Entries are keyed by a hash of everything that determines a response (deployment, prompt, page image or
+    text, max_tokens and temperature), so unchanged pages are served from the cache when a document is
+    re-run. When the stored responses exceed the configured size the least recently used entries are evicted.
+    """
+
+    def __init__(self, response_cache_config: ResponseCacheConfig) -> None:
+        self.max_size_bytes: int = response_cache_config.max_size_bytes
+        response_cache_config.database_path.parent.mkdir(parents=True, exist_ok=True)
+        # The connection is shared by the worker threads the async methods run on, hence the lock
+        self.lock: threading.Lock = threading.Lock()
+        self.connection: sqlite3.Connection = sqlite3.connect(response_cache_config.database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_accessed REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_accessed ON responses (last_accessed)")
+        self.connection.commit()
+        self.total_size_bytes: int = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def create_key(*key_parts: str | bytes | memoryview | int | float) -> str:
+        sha256 = hashlib.sha256()
+        for key_part in key_parts:
+            key_part_bytes: bytes | memoryview = key_part if isinstance(key_part, (bytes, memoryview)) else str(key_part).encode("utf-8")
+            # Length-prefix every part so that ("ab", "c") and ("a", "bc") produce different keys
+            sha256.update(len(key_part_bytes).to_bytes(8, "little"))
+            sha256.update(key_part_bytes)
+        return sha256.hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        return await asyncio.to_thread(self.__get, key)
+
+    async def put(self, key: str, value: str) -> None:
+        await asyncio.to_thread(self.__put, key, value)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+    def __get(self, key: str) -> str | None:
+        with self.lock:
+            row: tuple[str] | None = self.connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_accessed = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def __put(self, key: str, value: str) -> None:
+        size: int = len(value.encode("utf-8"))
+        with self.lock:
+            existing_row: tuple[int] | None = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if existing_row is not None:
+                self.total_size_bytes -= existing_row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_accessed) VALUES (?, ?, ?, ?)", (key, value, size, time.time())
+            )
+            self.total_size_bytes += size
+            self.__evict_least_recently_used()
+            self.connection.commit()
+
+    def __evict_least_recently_used(self) -> None:
+        while self.total_size_bytes > self.max_size_bytes:
+            rows: list[tuple[str, int]] = self.connection.execute("SELECT key, size FROM responses ORDER BY last_accessed LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_size_bytes <= self.max_size_bytes:
+                    break
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_size_bytes -= size
@@ -0,0 +1,136 @@
+import time
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any
+
+from pdf_image_to_markdown.managers.models.conversion_report import ConversionReport
+
+try:
+    from opentelemetry import metrics, trace
+except ImportError:  # OpenTelemetry is optional, without it only the conversion reports are produced
+    metrics = None
+    trace = None
+
+# The report of the document being converted. asyncio tasks inherit the context they were created in, so the
+# pages of concurrently converted documents are attributed to the right report, including by the gateways
+# that are shared between documents.
+_current_conversion_report: ContextVar[ConversionReport | None] = ContextVar("current_conversion_report", default=None)
+
+
+class TelemetryGateway:
+    """
+    Records where the time and the tokens of every document conversion go: per-stage durations, LLM token
+    usage, cached responses and retries. The measurements are collected into a ConversionReport per document
+    and, when enabled and installed, exported as OpenTelemetry spans and metrics as well.
+    """
+
+    INSTRUMENTATION_NAME: str = "pdf_image_to_markdown"
+
+    def __init__(self, enable_open_telemetry: bool = False) -> None:
+        self.tracer: Any = None
+        self.stage_duration_histogram: Any = None
+        self.token_counter: Any = None
+        if enable_open_telemetry:
+            if trace is None or metrics is None:
+                print("OpenTelemetry is not installed, spans and metrics will not be exported")
+            else:
+                # Exporters are configured by the host application (or opentelemetry-instrument)
+                self.tracer = trace.get_tracer(self.INSTRUMENTATION_NAME)
+                meter = metrics.get_meter(self.INSTRUMENTATION_NAME)
+                self.stage_duration_histogram = meter.create_histogram(
+                    f"{self.INSTRUMENTATION_NAME}.stage.duration", unit="s", description="Duration of a pipeline stage"
+                )
+                self.token_counter = meter.create_counter(f"{self.INSTRUMENTATION_NAME}.tokens", unit="{token}", description="LLM tokens used")
+
+    @contextmanager
+    def measure_document(self, document_name: str) -> Iterator[ConversionReport]:
+        """
+        Collects everything measured within the block into the report of the document. When a document is
+        already being measured (e.g. the caller also measures writing out the results), its report is reused.
+        """
+        current_conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if current_conversion_report is not None:
+            yield current_conversion_report
+            return
+
+        conversion_report: ConversionReport = ConversionReport(document_name, start_time=time.perf_counter())
+        context_token = _current_conversion_report.set(conversion_report)
+        try:
+            with self.__start_span("convert_document", {"document.name": document_name}):
+                yield conversion_report
+        finally:
+            conversion_report.elapsed_seconds = time.perf_counter() - conversion_report.start_time
+            _current_conversion_report.reset(context_token)
+
+    @contextmanager
+    def measure(self, stage: str, measure_cpu_time: bool = False) -> Iterator[None]:
+        """
+        Records the duration of the block. The CPU time of the current thread is recorded as well when asked
+        for, which only makes sense for blocks that do not await (other tasks would run in the meantime).
+        """
+        start_time: float = time.perf_counter()
+        start_cpu_time: float = time.thread_time()
+        try:
+            with self.__start_span(stage):
+                yield
+        finally:
+            self.record_duration(stage, time.perf_counter() - start_time)
+            if measure_cpu_time:
+                self.record_cpu_time(stage, time.thread_time() - start_cpu_time)
+
+    def record_duration(self, stage: str, seconds: float) -> None:
+        """Records a stage that was timed elsewhere, e.g. page rendering in a worker process."""
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None:
+            conversion_report.add_stage_duration(stage, seconds)
+        if self.stage_duration_histogram is not None:
+            self.stage_duration_histogram.record(seconds, {"stage": stage})
+
+    def record_cpu_time(self, stage: str, seconds: float) -> None:
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None:
+            conversion_report.add_stage_cpu_time(stage, seconds)
+
+    def record_first_markdown(self, seconds: float) -> None:
+        """Records how long it took from the start of a streamed completion until its first cleaned markdown."""
+        self.record_duration("time_to_first_markdown", seconds)
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None and conversion_report.time_to_first_markdown_seconds is None:
+            conversion_report.time_to_first_markdown_seconds = time.perf_counter() - conversion_report.start_time
+
+    def record_usage(self, prompt_tokens: int, completion_tokens: int, cached_prompt_tokens: int = 0) -> None:
+        """`cached_prompt_tokens` is the part of the `prompt_tokens` that was served from the provider's prompt cache."""
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None:
+            conversion_report.llm_call_count += 1
+            conversion_report.prompt_tokens += prompt_tokens
+            conversion_report.cached_prompt_tokens += cached_prompt_tokens
+            conversion_report.completion_tokens += completion_tokens
+        if self.token_counter is not None:
+            self.token_counter.add(prompt_tokens, {"token.type": "prompt"})
+            self.token_counter.add(cached_prompt_tokens, {"token.type": "cached_prompt"})
+            self.token_counter.add(completion_tokens, {"token.type": "completion"})
+
+    def record_cached_response(self) -> None:
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None:
+            conversion_report.cached_response_count += 1
+
+    def record_retry(self) -> None:
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None:
+            conversion_report.retry_count += 1
+
+    def record_hedged_request(self) -> None:
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None:
+            conversion_report.hedged_request_count += 1
+
+    def record_continuation(self) -> None:
+        conversion_report: ConversionReport | None = _current_conversion_report.get()
+        if conversion_report is not None:
+            conversion_report.continuation_count += 1
+
+    def __start_span(self, name: str, attributes: dict[str, str] | None = None) -> AbstractContextManager[Any]:
+        return self.tracer.start_as_current_span(name, attributes=attributes) if self.tracer is not None else nullcontext()
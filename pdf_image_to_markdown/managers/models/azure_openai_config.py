@@ -12,6 +12,9 @@ class AzureOpenAiConfig:
         api_key: Optional[str],
         token_provider_url: Optional[str] = None,
         max_tokens: int = 16384,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 2,
     ):
         self.endpoint: str = endpoint
         self.api_version: str = api_version
@@ -19,3 +22,9 @@ class AzureOpenAiConfig:
         self.api_key: Optional[str] = api_key
         self.token_provider_url: Optional[str] = token_provider_url
         self.max_tokens: int = max_tokens
+        # Deployment quotas. When either is set, requests are scheduled client-side to stay within them.
+        self.requests_per_minute: Optional[int] = requests_per_minute
+        self.tokens_per_minute: Optional[int] = tokens_per_minute
+        # Retries of a failed request, by the openai SDK or (with a rate limiter or several deployments) by the gateway, which
+        # allows this many retries on every deployment. The default is the SDK's own.
+        self.max_retries: int = max_retries
@@ -0,0 +1,10 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class BatchConversionResult:
+    converted_documents: list[str] = field(default_factory=list)
+    failed_documents: dict[str, str] = field(default_factory=dict)
+
+    def __str__(self):
+        return f"Converted: {len(self.converted_documents)}, Failed: {len(self.failed_documents)}"
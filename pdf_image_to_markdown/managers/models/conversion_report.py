@@ -0,0 +1,77 @@
+import json
+from dataclasses import dataclass, field
+from typing import Any
+
+
+@dataclass
+class ConversionReport:
+    document_name: str
+    stage_durations: dict[str, list[float]] = field(default_factory=dict)
+    # Only recorded for the stages that run synchronously (on a single thread), for which it is meaningful
+    stage_cpu_seconds: dict[str, float] = field(default_factory=dict)
+    prompt_tokens: int = 0
+    # The part of the prompt tokens served from the provider's prompt cache
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+    llm_call_count: int = 0
+    cached_response_count: int = 0
+    retry_count: int = 0
+    # Slow requests that were sent a second time, the first response of the two was used
+    hedged_request_count: int = 0
+    # Requests continuing a completion that was cut off at max_tokens
+    continuation_count: int = 0
+    elapsed_seconds: float = 0.0
+    # From the start of the conversion until the first cleaned markdown of any page was available (streaming only)
+    time_to_first_markdown_seconds: float | None = None
+    start_time: float = field(default=0.0, repr=False)
+
+    def add_stage_duration(self, stage: str, seconds: float) -> None:
+        self.stage_durations.setdefault(stage, []).append(seconds)
+
+    def add_stage_cpu_time(self, stage: str, seconds: float) -> None:
+        self.stage_cpu_seconds[stage] = self.stage_cpu_seconds.get(stage, 0.0) + seconds
+
+    def get_prompt_cache_hit_rate(self) -> float:
+        return self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "document_name": self.document_name,
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+            "time_to_first_markdown_seconds": (
+                round(self.time_to_first_markdown_seconds, 3) if self.time_to_first_markdown_seconds is not None else None
+            ),
+            "llm_call_count": self.llm_call_count,
+            "cached_response_count": self.cached_response_count,
+            "retry_count": self.retry_count,
+            "hedged_request_count": self.hedged_request_count,
+            "continuation_count": self.continuation_count,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "prompt_cache_hit_rate": round(self.get_prompt_cache_hit_rate(), 4),
+            "completion_tokens": self.completion_tokens,
+            # Stages run concurrently, so their totals add up to more than the elapsed time
+            "stages": {
+                stage: {
+                    "count": len(durations),
+                    "total_seconds": round(sum(durations), 3),
+                    "mean_seconds": round(sum(durations) / len(durations), 3),
+                    "max_seconds": round(max(durations), 3),
+                    **({"cpu_seconds": round(self.stage_cpu_seconds[stage], 3)} if stage in self.stage_cpu_seconds else {}),
+                }
+                for stage, durations in sorted(self.stage_durations.items(), key=lambda item: sum(item[1]), reverse=True)
+            },
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def __str__(self):
+        slowest_stage: str = max(self.stage_durations, key=lambda stage: sum(self.stage_durations[stage]), default="none")
+        return (
+            f"{self.document_name}: {self.elapsed_seconds:.1f}s, {self.llm_call_count} LLM calls ({self.cached_response_count} cached, "
+            f"{self.retry_count} retries, {self.hedged_request_count} hedged, {self.continuation_count} continuations), "
+            f"{self.prompt_tokens} prompt ({self.get_prompt_cache_hit_rate():.0%} from the prompt cache) / "
+            f"{self.completion_tokens} completion tokens, "
+            f"most time spent in {slowest_stage}"
+        )
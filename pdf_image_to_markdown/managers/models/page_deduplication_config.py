@@ -0,0 +1,20 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar, Optional
+
+
+@dataclass
+class PageDeduplicationConfig:
+    # The index finds candidates by exact matches on four 16-bit bands of the perceptual hash, which is
+    # guaranteed to find every hash within a distance of 3 bits
+    MAX_SUPPORTED_HASH_DISTANCE: ClassVar[int] = 3
+
+    def __init__(self, database_path: Optional[Path] = None, max_hash_distance: int = 1):
+        if not 0 <= max_hash_distance <= self.MAX_SUPPORTED_HASH_DISTANCE:
+            raise ValueError(f"max_hash_distance must be between 0 and {self.MAX_SUPPORTED_HASH_DISTANCE}, got {max_hash_distance}.")
+
+        # Index of page hashes to finished markdown shared across runs (and documents), pages are only
+        # deduplicated within the current run without one
+        self.database_path: Optional[Path] = database_path
+        # Number of differing perceptual hash bits up to which two pages are considered the same page
+        self.max_hash_distance: int = max_hash_distance
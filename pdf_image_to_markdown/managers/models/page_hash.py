@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class PageHash:
+    def __init__(self, phash: int, dhash: int):
+        # 64-bit DCT based perceptual hash of the page
+        self.phash: int = phash
+        # 256-bit difference (gradient) hash of the page
+        self.dhash: int = dhash
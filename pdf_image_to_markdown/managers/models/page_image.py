@@ -0,0 +1,38 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from pdf_image_to_markdown.managers.models.page_hash import PageHash
+
+
+@dataclass
+class PageImage:
+    def __init__(
+        self,
+        page_number: int,
+        image_bytes: Optional[bytes],
+        page_hash: Optional[PageHash] = None,
+        render_seconds: float = 0.0,
+        encode_seconds: float = 0.0,
+        render_cpu_seconds: float = 0.0,
+        encode_cpu_seconds: float = 0.0,
+        width: int = 0,
+        height: int = 0,
+        ink_area: Optional[float] = None,
+    ):
+        self.page_number: int = page_number
+        # None for blank pages, when those are skipped
+        self.image_bytes: Optional[bytes] = image_bytes
+        # Only computed when asked for, to find duplicate pages
+        self.page_hash: Optional[PageHash] = page_hash
+        # Time spent rendering (including blank page detection and cropping) and encoding the page, measured
+        # where the page was rendered, which may be another process
+        self.render_seconds: float = render_seconds
+        self.encode_seconds: float = encode_seconds
+        self.render_cpu_seconds: float = render_cpu_seconds
+        self.encode_cpu_seconds: float = encode_cpu_seconds
+        # Size of the encoded image in pixels, from which its prompt tokens are estimated
+        self.width: int = width
+        self.height: int = height
+        # Area of the page covered by ink in square points, only measured when asked for, to estimate the length
+        # of the page's markdown
+        self.ink_area: Optional[float] = ink_area
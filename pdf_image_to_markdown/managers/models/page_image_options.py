@@ -0,0 +1,40 @@
+from dataclasses import dataclass
+from typing import ClassVar, Optional
+
+
+@dataclass
+class PageImageOptions:
+    SUPPORTED_IMAGE_FORMATS: ClassVar[tuple[str, ...]] = ("PNG", "JPEG", "WEBP")
+
+    def __init__(  # noqa: PLR0913
+        self,
+        dpi: int = 144,
+        max_longest_side: Optional[int] = None,
+        fit_to_vision_tiles: bool = False,
+        grayscale_monochrome_pages: bool = False,
+        image_format: str = "PNG",
+        quality: int = 85,
+        png_compress_level: int = 6,
+        skip_blank_pages: bool = False,
+        crop_margins: bool = False,
+    ):
+        if image_format.upper() not in self.SUPPORTED_IMAGE_FORMATS:
+            raise ValueError(f"Unsupported page image format: {image_format}. Supported formats are {', '.join(self.SUPPORTED_IMAGE_FORMATS)}.")
+
+        # Rendering resolution, 72 DPI is one pixel per PDF point (the original fixed scale of 2 is 144 DPI)
+        self.dpi: int = dpi
+        # Upper bound on the longest side of the image in pixels, the page is rendered at a lower DPI if needed
+        self.max_longest_side: Optional[int] = max_longest_side
+        # Never render more pixels than the vision model keeps after it scales the image to fit its tiles
+        self.fit_to_vision_tiles: bool = fit_to_vision_tiles
+        # Encode pages without any color as single channel grayscale images
+        self.grayscale_monochrome_pages: bool = grayscale_monochrome_pages
+        self.image_format: str = image_format.upper()
+        # JPEG/WebP quality (1-100)
+        self.quality: int = quality
+        # PNG zlib compression level (0-9)
+        self.png_compress_level: int = png_compress_level
+        # Drop pages without any content (blank or only a separator rule) before they are sent to the model
+        self.skip_blank_pages: bool = skip_blank_pages
+        # Crop the empty margins around the page content, so the model gets fewer and denser tiles
+        self.crop_margins: bool = crop_margins
@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class RequestHedgingConfig:
+    def __init__(self, latency_percentile: float = 95.0, max_hedged_request_ratio: float = 0.1, min_latency_samples: int = 20):
+        if not 50.0 <= latency_percentile < 100.0:
+            raise ValueError(f"latency_percentile must be at least 50 and below 100, got {latency_percentile}.")
+        if not 0.0 < max_hedged_request_ratio <= 1.0:
+            raise ValueError(f"max_hedged_request_ratio must be above 0 and at most 1, got {max_hedged_request_ratio}.")
+
+        # A request still running after this percentile of the latencies observed for similar requests is hedged
+        self.latency_percentile: float = latency_percentile
+        # Caps the extra spend: at most this share of the requests is sent a second time
+        self.max_hedged_request_ratio: float = max_hedged_request_ratio
+        # Requests are not hedged until this many similar requests have completed, the percentile means little before
+        self.min_latency_samples: int = min_latency_samples
@@ -0,0 +1,9 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass
+class ResponseCacheConfig:
+    def __init__(self, database_path: Path, max_size_bytes: int = 1024 * 1024 * 1024):
+        self.database_path: Path = database_path
+        self.max_size_bytes: int = max_size_bytes
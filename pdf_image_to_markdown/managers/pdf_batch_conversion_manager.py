@@ -0,0 +1,135 @@
+import asyncio
+import tempfile
+from pathlib import Path
+
+from pdf_image_to_markdown.managers.exceptions.application_base_exception import ApplicationBaseException
+from pdf_image_to_markdown.managers.gateways.async_blob_storage_gateway import AsyncBlobStorageGateway
+from pdf_image_to_markdown.managers.gateways.blob_storage_gateway import FileInfo
+from pdf_image_to_markdown.managers.gateways.local_file_storage_gateway import LocalFileStorageGateway
+from pdf_image_to_markdown.managers.models.batch_conversion_result import BatchConversionResult
+from pdf_image_to_markdown.managers.models.conversion_report import ConversionReport
+from pdf_image_to_markdown.managers.pdf_image_to_markdown_manager import PdfImageToMarkdownManager
+
+
+class PdfBatchConversionManager:
+    """
+    Converts every PDF under a prefix of a storage container to markdown, several documents at a time. The
+    markdown of each document is uploaded under the output prefix and the source PDF is moved under the
+    processed prefix, or the failed prefix if its conversion failed, so a container can be worked through
+    incrementally and re-running a batch only picks up the documents that are still waiting.
+    """
+
+    def __init__(
+        self,
+        storage_gateway: AsyncBlobStorageGateway | LocalFileStorageGateway,
+        pdf_image_to_markdown_manager: PdfImageToMarkdownManager,
+        max_concurrent_documents: int = 2,
+    ) -> None:
+        self.storage_gateway: AsyncBlobStorageGateway | LocalFileStorageGateway = storage_gateway
+        self.pdf_image_to_markdown_manager: PdfImageToMarkdownManager = pdf_image_to_markdown_manager
+        self.max_concurrent_documents: int = max_concurrent_documents
+
+    async def convert_documents(  # noqa: PLR0913
+        self,
+        source_prefix: str,
+        output_prefix: str,
+        processed_prefix: str,
+        failed_prefix: str,
+        batch_size: int = 1,
+        batch_token_budget: int | None = None,
+        max_concurrency: int = 1,
+        render_workers: int = 1,
+        jobs_directory: Path | None = None,
+        use_text_layer: bool = False,
+    ) -> BatchConversionResult:
+        files: list[FileInfo] = await self.storage_gateway.get_all_files_from_container(source_prefix)
+        pdf_files: list[FileInfo] = [file_info for file_info in files if file_info.file_type == "PDF"]
+        print(f"Found {len(pdf_files)} PDF documents under '{source_prefix}'")
+
+        result: BatchConversionResult = BatchConversionResult()
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(self.max_concurrent_documents)
+
+        async def convert_document(file_info: FileInfo) -> None:
+            async with semaphore:
+                await self._convert_document(
+                    file_info,
+                    source_prefix,
+                    output_prefix,
+                    processed_prefix,
+                    failed_prefix,
+                    result,
+                    batch_size=batch_size,
+                    batch_token_budget=batch_token_budget,
+                    max_concurrency=max_concurrency,
+                    render_workers=render_workers,
+                    jobs_directory=jobs_directory,
+                    use_text_layer=use_text_layer,
+                )
+
+        await asyncio.gather(*(convert_document(file_info) for file_info in pdf_files))
+        print(f"Batch conversion completed. {result}")
+        return result
+
+    async def _convert_document(  # noqa: PLR0913
+        self,
+        file_info: FileInfo,
+        source_prefix: str,
+        output_prefix: str,
+        processed_prefix: str,
+        failed_prefix: str,
+        result: BatchConversionResult,
+        batch_size: int,
+        batch_token_budget: int | None,
+        max_concurrency: int,
+        render_workers: int,
+        jobs_directory: Path | None,
+        use_text_layer: bool,
+    ) -> None:
+        relative_blob_name: str = file_info.path_and_name.removeprefix(source_prefix)
+        telemetry_gateway = self.pdf_image_to_markdown_manager.telemetry_gateway
+        try:
+            conversion_report: ConversionReport
+            with telemetry_gateway.measure_document(file_info.path_and_name) as conversion_report:
+                # The PDF is streamed into a temporary file that the renderer reads pages from on demand, so large
+                # documents are never held in memory as a whole
+                with tempfile.TemporaryDirectory() as temporary_directory:
+                    pdf_path: Path = Path(temporary_directory) / file_info.file_name
+                    with telemetry_gateway.measure("download"), pdf_path.open("wb") as pdf_file:
+                        await self.storage_gateway.download_file_to_stream(file_info.path_and_name, pdf_file)
+
+                    markdown: str = await self.pdf_image_to_markdown_manager.get_markdown_for_pdf_source_using_page_images(
+                        pdf_path,
+                        pdf_path.stem,
+                        batch_size=batch_size,
+                        batch_token_budget=batch_token_budget,
+                        max_concurrency=max_concurrency,
+                        render_workers=render_workers,
+                        jobs_directory=jobs_directory,
+                        use_text_layer=use_text_layer,
+                    )
+
+                markdown_blob_name: str = f"{output_prefix}{Path(relative_blob_name).with_suffix('.md').as_posix()}"
+                with telemetry_gateway.measure("write_out"):
+                    await self.storage_gateway.upload_file_to_container(
+                        markdown_blob_name, markdown.encode("utf-8"), "text/markdown; charset=utf-8"
+                    )
+
+            # The report of every converted document is uploaded next to its markdown
+            print(conversion_report)
+            await self.storage_gateway.upload_file_to_container(
+                f"{output_prefix}{Path(relative_blob_name).with_suffix('.report.json').as_posix()}",
+                conversion_report.to_json().encode("utf-8"),
+                "application/json",
+            )
+            await self.storage_gateway.move_file(file_info.path_and_name, f"{processed_prefix}{relative_blob_name}")
+            result.converted_documents.append(file_info.path_and_name)
+            print(f"Converted {file_info.path_and_name} to {markdown_blob_name}")
+        except Exception as e:
+            message: str = f"Failed to convert {file_info.path_and_name}"
+            result.failed_documents[file_info.path_and_name] = str(e)
+            print(f"{message}\n{ApplicationBaseException.get_exception_details(e, message)}")
+            try:
+                await self.storage_gateway.move_file(file_info.path_and_name, f"{failed_prefix}{relative_blob_name}")
+            except Exception as move_exception:
+                message = f"Failed to move {file_info.path_and_name} to '{failed_prefix}'"
+                print(f"{message}\n{ApplicationBaseException.get_exception_details(move_exception, message)}")
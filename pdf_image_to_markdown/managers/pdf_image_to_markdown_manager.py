@@ -1,20 +1,102 @@
-import tempfile
+import asyncio
+import contextlib
+import time
+from collections.abc import AsyncIterator
 from pathlib import Path
+
+from pdf_image_to_markdown.managers.gateways.azure_ad_token_provider import AzureAdTokenProvider
+from pdf_image_to_markdown.managers.gateways.azure_openai_rate_limiter import AzureOpenAiRateLimiter
 from pdf_image_to_markdown.managers.gateways.gpt_vision_gateway import GptVisionGateway
+from pdf_image_to_markdown.managers.gateways.job_checkpoint_gateway import JobCheckpointGateway, JobCheckpointStage
+from pdf_image_to_markdown.managers.gateways.page_deduplication_gateway import PageDeduplicationGateway, PageMarkdown
+from pdf_image_to_markdown.managers.gateways.response_cache_gateway import ResponseCacheGateway
+from pdf_image_to_markdown.managers.gateways.telemetry_gateway import TelemetryGateway
 from pdf_image_to_markdown.managers.models.azure_openai_config import AzureOpenAiConfig
-from pdf_image_to_markdown.managers.processors.markdown_custom_markers_cleaner import MarkdownCustomMarkesCleaner
+from pdf_image_to_markdown.managers.models.page_deduplication_config import PageDeduplicationConfig
+from pdf_image_to_markdown.managers.models.page_image import PageImage
+from pdf_image_to_markdown.managers.models.page_image_options import PageImageOptions
+from pdf_image_to_markdown.managers.models.request_hedging_config import RequestHedgingConfig
+from pdf_image_to_markdown.managers.models.response_cache_config import ResponseCacheConfig
+from pdf_image_to_markdown.managers.processors.completion_token_estimator import CompletionTokenEstimator
+from pdf_image_to_markdown.managers.processors.markdown_custom_markers_cleaner import MarkdownCustomMarkesCleaner, MarkdownCustomMarkersStreamCleaner
+from pdf_image_to_markdown.managers.processors.markdown_lint_checker import MarkdownLintChecker
+from pdf_image_to_markdown.managers.processors.markdown_page_splitter import MarkdownPageSplitter
+from pdf_image_to_markdown.managers.processors.page_image_hasher import PageImageHasher
 from pdf_image_to_markdown.managers.processors.plaintext_to_markdown_prompt_result_processor import PlaintextToMarkdownPromptResultProcessor
-from pdf_image_to_markdown.managers.processors.pdf_document_page_image_extractor import PdfDocumentPageImageExtractor
+from pdf_image_to_markdown.managers.processors.pdf_document_page_image_extractor import PdfDocumentPageImageExtractor, PdfSource
+from pdf_image_to_markdown.managers.processors.pdf_document_page_text_classifier import PdfDocumentPageTextClassifier
 import io
 
 
 class PdfImageToMarkdownManager:
-    def __init__(self, azure_openai_config: AzureOpenAiConfig) -> None:
+    # Rough size of the markdown of a page, used with the size of its image to fit pages into a batch's token budget
+    ESTIMATED_COMPLETION_TOKENS_PER_PAGE: int = 1000
+
+    def __init__(
+        self,
+        azure_openai_config: AzureOpenAiConfig,
+        response_cache_config: ResponseCacheConfig | None = None,
+        skip_fixup_for_clean_pages: bool = False,
+        page_image_options: PageImageOptions | None = None,
+        page_deduplication_config: PageDeduplicationConfig | None = None,
+        enable_open_telemetry: bool = False,
+        stream_completions: bool = False,
+        azure_ad_token_provider: AzureAdTokenProvider | None = None,
+        additional_azure_openai_configs: list[AzureOpenAiConfig] | None = None,
+        request_hedging_config: RequestHedgingConfig | None = None,
+        adaptive_max_tokens: bool = False,
+    ) -> None:
         self.pdf_image_to_markdown_prompt: str = self._get_system_prompt("pdf_image_to_markdown_prompt_v3")
+        # Sent along with the images when several pages are converted with one request
+        self.pdf_image_to_markdown_batch_prompt: str = self._get_system_prompt("pdf_image_to_markdown_batch_prompt")
         self.pdf_text_to_markdown_prompt: str = self._get_system_prompt("simple_markdown_prompt")
         self.markdown_fixup_clean_prompt: str = self._get_system_prompt("markdown_fixup_clean_prompt_v2")
         self.azure_openai_config: AzureOpenAiConfig = azure_openai_config
-        self.gpt_vision_gateway: GptVisionGateway = GptVisionGateway(azure_openai_config, self.pdf_image_to_markdown_prompt)
+        # When set, only pages whose vision output fails the local markdown lint checks get the fix-up LLM call
+        self.skip_fixup_for_clean_pages: bool = skip_fixup_for_clean_pages
+        # Resolution, encoding and downscaling of the page images sent to the vision model
+        self.page_image_options: PageImageOptions = page_image_options or PageImageOptions()
+        self.response_cache: ResponseCacheGateway | None = ResponseCacheGateway(response_cache_config) if response_cache_config else None
+        # When set, every request's max_tokens is estimated from its input (the ink on the page, the text or markdown) rather
+        # than the deployment's max_tokens, so requests reserve less of the tokens-per-minute quota and more fit in flight
+        self.adaptive_max_tokens: bool = adaptive_max_tokens
+        # When set, page images are converted with streamed completions whose markers are cleaned up as they arrive
+        self.stream_completions: bool = stream_completions
+        # Per-document timings and token usage, optionally exported as OpenTelemetry spans and metrics
+        self.telemetry_gateway: TelemetryGateway = TelemetryGateway(enable_open_telemetry)
+        # The token provider can be shared with the other clients of the process (e.g. blob storage). The requests are
+        # spread over the additional deployments (of the same model) along with the one of azure_openai_config. When
+        # hedging is configured, requests that are slow compared to similar ones are sent a second time.
+        self.gpt_vision_gateway: GptVisionGateway = GptVisionGateway(
+            azure_openai_config,
+            self.pdf_image_to_markdown_prompt,
+            self.response_cache,
+            self.telemetry_gateway,
+            azure_ad_token_provider,
+            additional_azure_openai_configs,
+            request_hedging_config,
+        )
+        # When set, pages that are (nearly) identical to a page converted earlier reuse its markdown
+        self.page_deduplication_gateway: PageDeduplicationGateway | None = (
+            PageDeduplicationGateway(
+                page_deduplication_config,
+                ResponseCacheGateway.create_key(
+                    azure_openai_config.model_deployment_name,
+                    self.pdf_image_to_markdown_prompt,
+                    self.markdown_fixup_clean_prompt,
+                    self.skip_fixup_for_clean_pages,
+                ),
+            )
+            if page_deduplication_config
+            else None
+        )
+
+    async def close(self) -> None:
+        await self.gpt_vision_gateway.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        if self.page_deduplication_gateway is not None:
+            self.page_deduplication_gateway.close()
 
     def _get_system_prompt(self, prompt_file_name: str) -> str:
         current_file: Path = Path(__file__).resolve()
@@ -23,75 +105,500 @@ class PdfImageToMarkdownManager:
         with open(f"{full_path}.md", encoding="utf-8") as f:
             return f.read()
 
-    async def get_markdown_for_pdf_document_using_page_images(self, pdf_path: str, batch_size: int = 1) -> str:
-        print("Convert PDF document pages to images")
-        pdf_bytes: bytes = Path(pdf_path).read_bytes()
-        png_images: list[bytes] = PdfDocumentPageImageExtractor.extract_images(pdf_bytes)
-        image_paths: list[Path] = []
-        temp_dir: str = tempfile.mkdtemp()
-        pdf_file_name: str = Path(pdf_path).stem
+    async def get_markdown_for_pdf_document_using_page_images(
+        self,
+        pdf_path: str,
+        batch_size: int = 1,
+        batch_token_budget: int | None = None,
+        max_concurrency: int = 1,
+        render_workers: int = 1,
+        page_images_directory: Path | None = None,
+        jobs_directory: Path | None = None,
+        use_text_layer: bool = False,
+    ) -> str:
+        return await self.get_markdown_for_pdf_source_using_page_images(
+            Path(pdf_path),
+            Path(pdf_path).stem,
+            batch_size=batch_size,
+            batch_token_budget=batch_token_budget,
+            max_concurrency=max_concurrency,
+            render_workers=render_workers,
+            page_images_directory=page_images_directory,
+            jobs_directory=jobs_directory,
+            use_text_layer=use_text_layer,
+        )
 
-        for page_number, png_bytes in enumerate(png_images):
-            image_path: Path = Path(temp_dir) / f"{pdf_file_name}_{page_number + 1}.png"
-            with open(image_path, "wb") as image_file:
-                image_file.write(png_bytes)
-            image_paths.append(image_path)
+    async def get_markdown_for_pdf_source_using_page_images(
+        self,
+        pdf_source: PdfSource,
+        pdf_file_name: str,
+        batch_size: int = 1,
+        batch_token_budget: int | None = None,
+        max_concurrency: int = 1,
+        render_workers: int = 1,
+        page_images_directory: Path | None = None,
+        jobs_directory: Path | None = None,
+        use_text_layer: bool = False,
+    ) -> str:
+        """
+        With a `batch_size` above 1, up to that many consecutive page images are converted with one request, as
+        long as their estimated tokens (page images and markdown) fit within `batch_token_budget`, which defaults
+        to the deployment's max_tokens. Fewer, larger requests repeat the prompt less often for short pages.
+        """
+        # Everything measured while the pages of the document are converted is attributed to its report
+        with self.telemetry_gateway.measure_document(pdf_file_name):
+            total_pages: int = PdfDocumentPageImageExtractor.get_page_count(pdf_source)
+            toc_from_content: dict[int, list[str]] = {}
 
-        print(f"Converted: {len(image_paths)} PDF document pages to images")
+            # With a jobs directory, every page's results are checkpointed there, so a restarted conversion of the
+            # same document skips the pages that already completed and only re-issues the missing requests
+            checkpoint: JobCheckpointGateway | None = (
+                await JobCheckpointGateway.create(jobs_directory, pdf_source) if jobs_directory is not None else None
+            )
 
-        markdown_pages: list[str] = []
-        total_pages: int = len(image_paths)
-        toc_from_content: dict[int, list[str]] = {}
+            # In hybrid mode, pages with a usable embedded text layer are converted from their text and only the
+            # remaining (scanned) pages are rasterized and sent to the vision model
+            text_layer_pages: dict[int, str] = (
+                await asyncio.to_thread(PdfDocumentPageTextClassifier.get_text_layer_pages, pdf_source) if use_text_layer else {}
+            )
 
-        for batch_start in range(0, total_pages, batch_size):
-            batch_end: int = min(batch_start + batch_size, total_pages)
-            current_batch: list[Path] = image_paths[batch_start:batch_end]
+            print(f"Converting {total_pages} pages of {pdf_file_name} ({len(text_layer_pages)} from their text layer)")
 
-            if len(current_batch) > 1:
-                batch_markdown: str = await self.gpt_vision_gateway.get_markdown_for_pages(current_batch)
-                with Path(f"batch-markdown{batch_start + 1}.md").open("w", encoding="utf-8") as batch_markdown_file:
-                    batch_markdown_file.write(batch_markdown)
+            # Page images are sent to the model straight from memory. They are only written to disk when a
+            # directory to keep them in has been asked for (e.g. to inspect what the model was given).
+            if page_images_directory is not None:
+                page_images_directory.mkdir(parents=True, exist_ok=True)
 
-                fixedup_markdown: str = await self.gpt_vision_gateway.fixup_and_clean_markdown(batch_markdown, self.markdown_fixup_clean_prompt)
-                with Path(f"batch-markdown-fixed{batch_start + 1}.md").open("w", encoding="utf-8") as batch_markdown_file:
-                    batch_markdown_file.write(fixedup_markdown)
+            # Each batch of pages runs vision -> marker cleanup -> fix-up as an independent task, started as soon as
+            # its pages have been rendered. A semaphore slot is acquired *before* a task is started, so the number of
+            # batches in flight is bounded (and with it the number of concurrent requests against the deployment,
+            # since a batch only ever has one LLM call outstanding) and rendering cannot run arbitrarily far ahead.
+            semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+            batch_tasks: list[asyncio.Task[list[PageMarkdown]]] = []
+            batch_starts: list[int] = []
 
-                markdown_pages.append(fixedup_markdown)
-            else:
-                initial_markdown_string: str = await self.gpt_vision_gateway.get_markdown_for_page(current_batch[0])
-                with Path(f"batch-markdown-initial{batch_start + 1}.md").open("w", encoding="utf-8") as batch_markdown_file:
-                    batch_markdown_file.write(initial_markdown_string)
+            # As soon as one batch fails (or rendering does), the task group cancels the batches still in flight and
+            # stops starting new ones, so no more tokens are spent on a document that has already failed
+            try:
+                async with asyncio.TaskGroup() as task_group, contextlib.aclosing(
+                    self._iter_page_batches(
+                        pdf_source,
+                        total_pages,
+                        text_layer_pages,
+                        batch_size,
+                        batch_token_budget or self.azure_openai_config.max_tokens,
+                        render_workers,
+                        page_images_directory,
+                        pdf_file_name,
+                    )
+                ) as page_batches:
+                    async for batch_start, current_batch in page_batches:
+                        with self.telemetry_gateway.measure("queue_wait"):
+                            await semaphore.acquire()
+                        batch_tasks.append(
+                            task_group.create_task(self._get_markdown_for_batch(semaphore, current_batch, batch_start, total_pages, checkpoint))
+                        )
+                        batch_starts.append(batch_start)
+            except BaseExceptionGroup as exception_group:
+                # Callers get the error that failed the document rather than a group of it, the other batches were cancelled
+                raise exception_group.exceptions[0] from None
+
+            # The results are taken in the order the batches were started, so the document is assembled in page order
+            # regardless of the order in which the batches completed.
+            batch_results: list[list[PageMarkdown]] = [batch_task.result() for batch_task in batch_tasks]
+            markdown_pages: list[str] = []
+            for batch_start, batch_page_markdowns in zip(batch_starts, batch_results):
+                for page_number, (page_markdown, toc_from_page_content) in enumerate(batch_page_markdowns, batch_start + 1):
+                    if page_markdown is None:
+                        continue
+                    if toc_from_page_content:
+                        toc_from_content[page_number] = toc_from_page_content
+                    markdown_pages.append(page_markdown)
+
+            return "".join(markdown_pages)
+
+    async def _iter_page_batches(
+        self,
+        pdf_source: PdfSource,
+        total_pages: int,
+        text_layer_pages: dict[int, str],
+        batch_size: int,
+        batch_token_budget: int,
+        render_workers: int,
+        page_images_directory: Path | None,
+        pdf_file_name: str,
+    ) -> AsyncIterator[tuple[int, list[PageImage] | str]]:
+        """
+        Yields `(batch_start, batch)` in page order, where a batch is either the images of up to `batch_size`
+        consecutive rendered pages within the token budget, or the text of a single page converted from its text
+        layer. Blank pages are left out altogether.
+        """
+        image_page_numbers: list[int] = [page_number for page_number in range(1, total_pages + 1) if page_number not in text_layer_pages]
+        next_page_number: int = 1
+        current_batch: list[PageImage] = []
+        estimated_batch_tokens: int = 0
+        image_byte_count: int = 0
+        blank_page_numbers: list[int] = []
+
+        async for page_image in PdfDocumentPageImageExtractor.stream_images(
+            pdf_source,
+            render_workers,
+            page_numbers=image_page_numbers,
+            page_image_options=self.page_image_options,
+            compute_page_hashes=self.page_deduplication_gateway is not None,
+            measure_ink=self.adaptive_max_tokens,
+        ):
+            page_number: int = page_image.page_number
+            self.telemetry_gateway.record_duration("render", page_image.render_seconds)
+            self.telemetry_gateway.record_cpu_time("render", page_image.render_cpu_seconds)
+            # Text layer pages in between end the current batch, batches only hold consecutive pages
+            if next_page_number < page_number:
+                if current_batch:
+                    yield current_batch[0].page_number - 1, current_batch
+                    current_batch, estimated_batch_tokens = [], 0
+                for text_page_number in range(next_page_number, page_number):
+                    yield text_page_number - 1, text_layer_pages[text_page_number]
+
+            # Blank pages are dropped before any request is made for them, and end the current batch as well
+            if page_image.image_bytes is None:
+                blank_page_numbers.append(page_number)
+                if current_batch:
+                    yield current_batch[0].page_number - 1, current_batch
+                    current_batch, estimated_batch_tokens = [], 0
+                next_page_number = page_number + 1
+                continue
+
+            self.telemetry_gateway.record_duration("encode", page_image.encode_seconds)
+            self.telemetry_gateway.record_cpu_time("encode", page_image.encode_cpu_seconds)
+            image_byte_count += len(page_image.image_bytes)
+            if page_images_directory is not None:
+                image_extension: str = self.page_image_options.image_format.lower()
+                (page_images_directory / f"{pdf_file_name}_{page_number}.{image_extension}").write_bytes(page_image.image_bytes)
+
+            # A page that would take the batch over its token budget starts the next one, as does a duplicate of a
+            # page in the batch (the duplicate would wait for the markdown of the request it is part of)
+            estimated_page_tokens: int = self._estimate_page_tokens(page_image)
+            is_over_budget: bool = estimated_batch_tokens + estimated_page_tokens > batch_token_budget
+            if current_batch and (is_over_budget or self._has_same_page(current_batch, page_image)):
+                yield current_batch[0].page_number - 1, current_batch
+                current_batch, estimated_batch_tokens = [], 0
+
+            current_batch.append(page_image)
+            estimated_batch_tokens += estimated_page_tokens
+            next_page_number = page_number + 1
+            if len(current_batch) == batch_size:
+                yield current_batch[0].page_number - 1, current_batch
+                current_batch, estimated_batch_tokens = [], 0
 
-                markdown_string_without_markers: str = MarkdownCustomMarkesCleaner.clean_up_markers(initial_markdown_string)
+        if current_batch:
+            yield current_batch[0].page_number - 1, current_batch
 
-                if not MarkdownCustomMarkesCleaner.has_maaningful_content(markdown_string_without_markers):
+        rendered_page_count: int = len(image_page_numbers) - len(blank_page_numbers)
+        if rendered_page_count:
+            print(
+                f"Rendered {rendered_page_count} page images of {pdf_file_name} as {self.page_image_options.image_format}: "
+                f"{image_byte_count / 1024:,.0f} KB in total, {image_byte_count / rendered_page_count / 1024:,.0f} KB per page"
+            )
+        if blank_page_numbers:
+            print(f"Skipped {len(blank_page_numbers)} blank pages of {pdf_file_name}: {', '.join(map(str, blank_page_numbers))}")
+
+        for text_page_number in range(next_page_number, total_pages + 1):
+            yield text_page_number - 1, text_layer_pages[text_page_number]
+
+    def _estimate_page_tokens(self, page_image: PageImage) -> int:
+        estimated_completion_tokens: int = (
+            CompletionTokenEstimator.estimate_page_image_tokens(page_image.ink_area)
+            if page_image.ink_area is not None
+            else self.ESTIMATED_COMPLETION_TOKENS_PER_PAGE
+        )
+        return AzureOpenAiRateLimiter.estimate_image_size_tokens(page_image.width, page_image.height) + estimated_completion_tokens
+
+    def _get_page_images_max_tokens(self, page_images: list[PageImage]) -> int | None:
+        """Returns the max_tokens of the vision request for the pages, None for the deployment's own."""
+        # The ink is only measured with adaptive max_tokens
+        if any(page_image.ink_area is None for page_image in page_images):
+            return None
+        estimated_tokens: int = sum(CompletionTokenEstimator.estimate_page_image_tokens(page_image.ink_area or 0.0) for page_image in page_images)
+        return CompletionTokenEstimator.get_max_tokens(estimated_tokens, self.azure_openai_config.max_tokens)
+
+    def _has_same_page(self, page_images: list[PageImage], page_image: PageImage) -> bool:
+        if self.page_deduplication_gateway is None or page_image.page_hash is None:
+            return False
+        max_hash_distance: int = self.page_deduplication_gateway.max_hash_distance
+        return any(
+            PageImageHasher.is_same_page(page_image.page_hash, batch_page_image.page_hash, max_hash_distance)
+            for batch_page_image in page_images
+            if batch_page_image.page_hash is not None
+        )
+
+    async def _get_markdown_for_batch(
+        self,
+        semaphore: asyncio.Semaphore,
+        current_batch: list[PageImage] | str,
+        batch_start: int,
+        total_pages: int,
+        checkpoint: JobCheckpointGateway | None,
+    ) -> list[PageMarkdown]:
+        # The semaphore slot was acquired by the caller before this task was started. The "page" stage is the
+        # latency of a batch from the moment it got its slot until its markdown is ready.
+        try:
+            result: list[PageMarkdown]
+            with self.telemetry_gateway.measure("page"):
+                if isinstance(current_batch, str):
+                    result = [await self._get_markdown_for_page(current_batch, batch_start, checkpoint)]
+                elif len(current_batch) > 1:
+                    result = await self._get_markdown_for_page_images(current_batch, checkpoint)
+                else:
+                    result = [await self._get_markdown_for_page_image(current_batch[0], batch_start, checkpoint)]
+        finally:
+            semaphore.release()
+
+        batch_end: int = batch_start + (1 if isinstance(current_batch, str) else len(current_batch))
+        print(f"Completed processing pages {batch_start + 1} to {batch_end} of {total_pages}")
+        return result
+
+    async def _get_markdown_for_page_images(self, page_images: list[PageImage], checkpoint: JobCheckpointGateway | None) -> list[PageMarkdown]:
+        """
+        Converts a batch of consecutive pages, sending the ones that are not duplicates of earlier pages to the
+        model together.
+        """
+        page_markdowns: dict[int, PageMarkdown] = {}
+        page_deduplication_gateway: PageDeduplicationGateway | None = self.page_deduplication_gateway
+        # All pages of the batch are reserved before anything is awaited, so batches reserve their pages in page
+        # order and never wait for each other's pages both ways
+        run_page_futures: list[tuple[PageImage, asyncio.Future[PageMarkdown | None] | None]] = (
+            [
+                (page_image, page_deduplication_gateway.reserve_page(page_image.page_hash))
+                for page_image in page_images
+                if page_image.page_hash is not None
+            ]
+            if page_deduplication_gateway is not None
+            else []
+        )
+        # The pages reserved by this batch, whose duplicates are waiting for their markdown
+        reserved_page_images: list[PageImage] = [page_image for page_image, run_page_future in run_page_futures if run_page_future is None]
+
+        try:
+            for page_image, run_page_future in run_page_futures:
+                assert page_deduplication_gateway is not None and page_image.page_hash is not None
+                duplicate_page_markdown: PageMarkdown | None = await page_deduplication_gateway.get_duplicate(page_image.page_hash, run_page_future)
+                if duplicate_page_markdown is None:
+                    if run_page_future is not None:
+                        reserved_page_images.append(page_image)
                     continue
+                if run_page_future is None:
+                    # Found in the index, which completed the page's reservation
+                    reserved_page_images.remove(page_image)
+                print(f"Reusing the markdown of an identical page for page {page_image.page_number}")
+                page_markdowns[page_image.page_number] = duplicate_page_markdown
+
+            converted_page_images: list[PageImage] = [page_image for page_image in page_images if page_image.page_number not in page_markdowns]
+            converted_page_markdowns: list[PageMarkdown] = await self._get_markdown_for_pages(converted_page_images, checkpoint)
+            page_markdowns.update(zip((page_image.page_number for page_image in converted_page_images), converted_page_markdowns))
+        except BaseException:
+            if page_deduplication_gateway is not None:
+                for page_image in reserved_page_images:
+                    assert page_image.page_hash is not None
+                    page_deduplication_gateway.abandon(page_image.page_hash)
+            raise
+
+        if page_deduplication_gateway is not None:
+            for page_image in reserved_page_images:
+                assert page_image.page_hash is not None
+                await page_deduplication_gateway.complete(page_image.page_hash, page_markdowns[page_image.page_number])
+
+        return [page_markdowns[page_image.page_number] for page_image in page_images]
+
+    async def _get_markdown_for_pages(self, page_images: list[PageImage], checkpoint: JobCheckpointGateway | None) -> list[PageMarkdown]:
+        # Pages that completed in an earlier run are not sent again, even when this run's batches are made up differently
+        # (e.g. with another token budget), and no request is made at all when every page of the batch completed
+        page_markdowns: dict[int, PageMarkdown] = {}
+        for page_image in page_images:
+            checkpointed_page_markdown: PageMarkdown | None = await self._read_page_markdown_checkpoint(page_image.page_number, checkpoint)
+            if checkpointed_page_markdown is not None:
+                page_markdowns[page_image.page_number] = checkpointed_page_markdown
+
+        unfinished_page_images: list[PageImage] = [page_image for page_image in page_images if page_image.page_number not in page_markdowns]
+        if unfinished_page_images:
+            unfinished_page_markdowns: list[PageMarkdown] = await self._request_markdown_for_pages(unfinished_page_images, checkpoint)
+            page_markdowns.update(zip((page_image.page_number for page_image in unfinished_page_images), unfinished_page_markdowns))
+
+        return [page_markdowns[page_image.page_number] for page_image in page_images]
+
+    async def _request_markdown_for_pages(self, page_images: list[PageImage], checkpoint: JobCheckpointGateway | None) -> list[PageMarkdown]:
+        """
+        Converts the pages with one vision request. The markdown is split back into pages, which then go
+        through the same marker cleanup, fix-up and TOC extraction as single pages. When it cannot be split (the
+        response is missing pages or was truncated), the pages are converted one by one instead.
+        """
+        if len(page_images) <= 1:
+            return [
+                await self._get_markdown_for_page(
+                    page_image.image_bytes, page_image.page_number - 1, checkpoint, self._get_page_images_max_tokens([page_image])
+                )
+                for page_image in page_images
+            ]
+
+        first_page_number: int = page_images[0].page_number
+        last_page_number: int = page_images[-1].page_number
+        batch_markdown: str | None = (
+            await checkpoint.read_stage(first_page_number, last_page_number, JobCheckpointStage.RawMarkdown) if checkpoint is not None else None
+        )
+        if batch_markdown is None:
+            batch_prompt: str = self.pdf_image_to_markdown_batch_prompt.replace("{page_count}", str(len(page_images)))
+            batch_markdown = await self.gpt_vision_gateway.get_markdown_for_pages(
+                [page_image.image_bytes for page_image in page_images if page_image.image_bytes is not None],
+                batch_prompt,
+                self._get_page_images_max_tokens(page_images),
+            )
+            if checkpoint is not None:
+                await checkpoint.write_stage(first_page_number, last_page_number, JobCheckpointStage.RawMarkdown, batch_markdown)
+
+        page_raw_markdowns: list[str] | None = MarkdownPageSplitter.split_pages(batch_markdown, len(page_images))
+        if page_raw_markdowns is None:
+            print(f"Could not split the markdown of pages {first_page_number} to {last_page_number} into pages, converting them one by one")
+            # One at a time, so the batch still only ever has one request outstanding
+            return [
+                await self._get_markdown_for_page(
+                    page_image.image_bytes, page_image.page_number - 1, checkpoint, self._get_page_images_max_tokens([page_image])
+                )
+                for page_image in page_images
+            ]
+
+        return [
+            await self._get_fixedup_page_markdown(page_raw_markdown, None, page_image.page_number, checkpoint)
+            for page_image, page_raw_markdown in zip(page_images, page_raw_markdowns)
+        ]
+
+    async def _get_markdown_for_page_image(self, page_image: PageImage, batch_start: int, checkpoint: JobCheckpointGateway | None) -> PageMarkdown:
+        assert page_image.image_bytes is not None
+        max_tokens: int | None = self._get_page_images_max_tokens([page_image])
+        if self.page_deduplication_gateway is None or page_image.page_hash is None:
+            return await self._get_markdown_for_page(page_image.image_bytes, batch_start, checkpoint, max_tokens)
+
+        duplicate_page_markdown: PageMarkdown | None = await self.page_deduplication_gateway.find_duplicate(page_image.page_hash)
+        if duplicate_page_markdown is not None:
+            print(f"Reusing the markdown of an identical page for page {page_image.page_number}")
+            return duplicate_page_markdown
+
+        try:
+            page_markdown: PageMarkdown = await self._get_markdown_for_page(page_image.image_bytes, batch_start, checkpoint, max_tokens)
+        except BaseException:
+            # Duplicates waiting for this page are converted themselves instead
+            self.page_deduplication_gateway.abandon(page_image.page_hash)
+            raise
+
+        await self.page_deduplication_gateway.complete(page_image.page_hash, page_markdown)
+        return page_markdown
+
+    async def _get_markdown_for_page(
+        self, page_content: bytes | str, batch_start: int, checkpoint: JobCheckpointGateway | None, max_tokens: int | None = None
+    ) -> PageMarkdown:
+        """`max_tokens` is that of the vision request for a page image, text layer pages estimate their own."""
+        page_number: int = batch_start + 1
+        checkpointed_page_markdown: PageMarkdown | None = await self._read_page_markdown_checkpoint(page_number, checkpoint)
+        if checkpointed_page_markdown is not None:
+            return checkpointed_page_markdown
+
+        initial_markdown_string: str | None = (
+            await checkpoint.read_stage(page_number, page_number, JobCheckpointStage.RawMarkdown) if checkpoint is not None else None
+        )
+        markdown_string_without_markers: str | None = None
+        if initial_markdown_string is None:
+            # Page content is either the rendered page image or, for text layer pages, the page's extracted text
+            if isinstance(page_content, str):
+                text_max_tokens: int | None = (
+                    CompletionTokenEstimator.get_max_tokens(
+                        CompletionTokenEstimator.estimate_text_tokens(page_content), self.azure_openai_config.max_tokens
+                    )
+                    if self.adaptive_max_tokens
+                    else None
+                )
+                initial_markdown_string = await self.gpt_vision_gateway.get_markdown_for_text(
+                    page_content, self.pdf_text_to_markdown_prompt, text_max_tokens
+                )
+            elif self.stream_completions:
+                initial_markdown_string, markdown_string_without_markers = await self._stream_markdown_for_page(page_content, max_tokens)
+            else:
+                initial_markdown_string = await self.gpt_vision_gateway.get_markdown_for_page(page_content, max_tokens)
+            if checkpoint is not None:
+                await checkpoint.write_stage(page_number, page_number, JobCheckpointStage.RawMarkdown, initial_markdown_string)
+
+        return await self._get_fixedup_page_markdown(initial_markdown_string, markdown_string_without_markers, page_number, checkpoint)
+
+    async def _read_page_markdown_checkpoint(self, page_number: int, checkpoint: JobCheckpointGateway | None) -> PageMarkdown | None:
+        if checkpoint is None:
+            return None
+        checkpointed_markdown: str | None = await checkpoint.read_stage(page_number, page_number, JobCheckpointStage.FixedupMarkdown)
+        if checkpointed_markdown is None:
+            return None
+        return checkpointed_markdown, await checkpoint.read_toc_from_content(page_number, page_number)
+
+    async def _get_fixedup_page_markdown(
+        self, initial_markdown_string: str, markdown_string_without_markers: str | None, page_number: int, checkpoint: JobCheckpointGateway | None
+    ) -> PageMarkdown:
+        """Runs the markdown the model generated for a page through marker cleanup, fix-up and TOC extraction."""
+        if markdown_string_without_markers is None:
+            with self.telemetry_gateway.measure("marker_cleanup", measure_cpu_time=True):
+                markdown_string_without_markers = MarkdownCustomMarkesCleaner.clean_up_markers(initial_markdown_string)
+
+        if not MarkdownCustomMarkesCleaner.has_maaningful_content(markdown_string_without_markers):
+            return None, None
 
-                with Path(f"batch-markdown-without-markers{batch_start + 1}.md").open("w", encoding="utf-8") as batch_markdown_file:
-                    batch_markdown_file.write(markdown_string_without_markers)
+        if checkpoint is not None:
+            await checkpoint.write_stage(page_number, page_number, JobCheckpointStage.MarkdownWithoutMarkers, markdown_string_without_markers)
 
-                initial_fixedup_and_clean_markdown: str = await self.gpt_vision_gateway.fixup_and_clean_markdown(
-                    markdown_string_without_markers, self.markdown_fixup_clean_prompt
+        fixedup_markdown: str
+        toc_from_page_content: list[str] | None
+        if self.skip_fixup_for_clean_pages and not MarkdownLintChecker.needs_fixup(initial_markdown_string):
+            fixedup_markdown = markdown_string_without_markers
+            with self.telemetry_gateway.measure("marker_cleanup", measure_cpu_time=True):
+                toc_from_page_content = MarkdownCustomMarkesCleaner.extract_toc_from_headings(fixedup_markdown)
+        else:
+            fixup_max_tokens: int | None = (
+                CompletionTokenEstimator.get_max_tokens(
+                    CompletionTokenEstimator.estimate_markdown_tokens(markdown_string_without_markers), self.azure_openai_config.max_tokens
                 )
-                fixedup_markdown: str
-                toc_from_page_content: list[str]
+                if self.adaptive_max_tokens
+                else None
+            )
+            initial_fixedup_and_clean_markdown: str = await self.gpt_vision_gateway.fixup_and_clean_markdown(
+                markdown_string_without_markers, self.markdown_fixup_clean_prompt, fixup_max_tokens
+            )
+            with self.telemetry_gateway.measure("marker_cleanup", measure_cpu_time=True):
                 fixedup_markdown, toc_from_page_content = MarkdownCustomMarkesCleaner.clean_markers_and_extract_toc(
                     initial_fixedup_and_clean_markdown
                 )
-                if toc_from_page_content:
-                    toc_from_content[batch_start + 1] = toc_from_page_content
 
-                if not fixedup_markdown.endswith("\n-----\n"):
-                    fixedup_markdown += "\n-----\n"
+        if not fixedup_markdown.endswith("\n-----\n"):
+            fixedup_markdown += "\n-----\n"
 
-                with Path(f"batch-markdown-fixed{batch_start + 1}.md").open("w", encoding="utf-8") as batch_markdown_file:
-                    batch_markdown_file.write(fixedup_markdown)
+        if checkpoint is not None:
+            # The TOC is written first, a page only counts as completed once its fixed-up markdown exists
+            await checkpoint.write_toc_from_content(page_number, page_number, toc_from_page_content)
+            await checkpoint.write_stage(page_number, page_number, JobCheckpointStage.FixedupMarkdown, fixedup_markdown)
 
-                markdown_pages.append(fixedup_markdown)
+        return fixedup_markdown, toc_from_page_content
 
-            print(f"Completed processing pages {batch_start + 1} to {batch_end} of {total_pages}")
+    async def _stream_markdown_for_page(self, page_image: bytes, max_tokens: int | None) -> tuple[str, str]:
+        """
+        Returns the markdown of the page as generated and with its markers cleaned up. The cleanup happens while
+        the completion streams in, so the cleaned markdown is complete as soon as the generation is.
+        """
+        stream_cleaner: MarkdownCustomMarkersStreamCleaner = MarkdownCustomMarkersStreamCleaner()
+        markdown_chunks: list[str] = []
+        cleaned_markdown_chunks: list[str] = []
+        start_time: float = time.perf_counter()
+        async for markdown_chunk in self.gpt_vision_gateway.stream_markdown_for_page(page_image, max_tokens):
+            markdown_chunks.append(markdown_chunk)
+            cleaned_markdown_chunk: str = stream_cleaner.feed(markdown_chunk)
+            if cleaned_markdown_chunk:
+                if not cleaned_markdown_chunks:
+                    self.telemetry_gateway.record_first_markdown(time.perf_counter() - start_time)
+                cleaned_markdown_chunks.append(cleaned_markdown_chunk)
+        cleaned_markdown_chunks.append(stream_cleaner.finish())
 
-        return "".join(markdown_pages)
+        return "".join(markdown_chunks), "".join(cleaned_markdown_chunks)
 
     # async def get_markdown_for_pdf_document_using_plain_text(self, pdf_path: str, batch_size: int = 1) -> str:
     #     pdf_document: fitz.Document = fitz.open(pdf_path)
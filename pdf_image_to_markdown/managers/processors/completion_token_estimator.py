@@ -0,0 +1,44 @@
+import math
+
+
+class CompletionTokenEstimator:
+    """
+    Estimates how many tokens the completion of a request will take, from what is known about its input, so that
+    its max_tokens can be set to not much more than that. Azure OpenAI counts the max_tokens of every request
+    against the deployment's tokens-per-minute quota, so requests that all reserve the deployment's whole
+    max_tokens leave room for far fewer of them at a time than short pages need.
+
+    The estimates err on the high side. A completion that still outgrows its max_tokens is continued.
+    """
+
+    CHARACTERS_PER_TOKEN: int = 4
+    # Square points (1/72 inch) of ink per character of text, measured on 10-12pt body text (14 to 17, rounded down).
+    # Pictures have far more ink than any text they hold, which only overestimates their pages.
+    INK_AREA_PER_CHARACTER: float = 12.0
+    # The markdown syntax (tables in particular), whitespace and custom markers, on top of the text of the page
+    MARKDOWN_OVERHEAD_RATIO: float = 1.3
+    SAFETY_MARGIN_RATIO: float = 1.5
+    # Short pages still get room for their markers and the odd misjudged figure caption
+    MIN_MAX_TOKENS: int = 1024
+
+    @staticmethod
+    def estimate_page_image_tokens(ink_area: float) -> int:
+        """Estimates the tokens of the markdown of a page image, from the area of the page covered by ink."""
+        character_count: float = ink_area / CompletionTokenEstimator.INK_AREA_PER_CHARACTER
+        return math.ceil(character_count * CompletionTokenEstimator.MARKDOWN_OVERHEAD_RATIO / CompletionTokenEstimator.CHARACTERS_PER_TOKEN)
+
+    @staticmethod
+    def estimate_text_tokens(text: str) -> int:
+        """Estimates the tokens of the markdown of a page's text (e.g. from its text layer)."""
+        return math.ceil(len(text) * CompletionTokenEstimator.MARKDOWN_OVERHEAD_RATIO / CompletionTokenEstimator.CHARACTERS_PER_TOKEN)
+
+    @staticmethod
+    def estimate_markdown_tokens(markdown_string: str) -> int:
+        """Estimates the tokens of markdown that is fixed up and cleaned, which comes back about as long as it went in."""
+        return math.ceil(len(markdown_string) / CompletionTokenEstimator.CHARACTERS_PER_TOKEN)
+
+    @staticmethod
+    def get_max_tokens(estimated_tokens: int, max_tokens: int) -> int:
+        """Returns the max_tokens for a completion estimated at `estimated_tokens`, at most `max_tokens`."""
+        reserved_tokens: int = math.ceil(estimated_tokens * CompletionTokenEstimator.SAFETY_MARGIN_RATIO)
+        return min(max(reserved_tokens, CompletionTokenEstimator.MIN_MAX_TOKENS), max_tokens)
@@ -0,0 +1,26 @@
+class MarkdownContinuationStitcher:
+    """
+    Stitches the continuations of a completion that was cut off at max_tokens onto it. Asked to continue exactly
+    where it stopped, the model mostly does, but now and then starts over with the line it was cut off in, or
+    repeats the last few words. That repeated overlap is dropped from the continuation.
+    """
+
+    # The longest overlap looked for, and hence how much of a streamed continuation is held back until it is known
+    MAX_OVERLAP_LENGTH: int = 400
+    # Shorter overlaps are only dropped when they are the whole line the content was cut off in, a few repeated
+    # characters (e.g. "| ") are as likely to be genuinely new content
+    MIN_OVERLAP_LENGTH: int = 16
+
+    @staticmethod
+    def stitch(content: str, continuation: str) -> str:
+        return content + MarkdownContinuationStitcher.get_continuation_without_overlap(content, continuation)
+
+    @staticmethod
+    def get_continuation_without_overlap(content: str, continuation: str) -> str:
+        last_line_start: int = content.rfind("\n") + 1
+        for overlap_length in range(min(len(content), len(continuation), MarkdownContinuationStitcher.MAX_OVERLAP_LENGTH), 0, -1):
+            if not content.endswith(continuation[:overlap_length]):
+                continue
+            if overlap_length >= MarkdownContinuationStitcher.MIN_OVERLAP_LENGTH or len(content) - overlap_length == last_line_start:
+                return continuation[overlap_length:]
+        return continuation
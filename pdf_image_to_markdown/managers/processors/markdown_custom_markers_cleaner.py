@@ -1,3 +1,4 @@
+import re
 from typing import Optional
 
 
@@ -5,6 +6,9 @@ class MarkdownCustomMarkesCleaner:
     # The specific marker prefix to *always* ignore during the first pass cleanup
     # and target during the second pass extraction.
     EXTRACTION_MARKER_PREFIX: str = "TOC FROM CONTENT"
+    # Matches exactly what `"table of contents" in line.lower()` does, without a lowercased copy of every line
+    # (re.IGNORECASE would also match e.g. the long s "\u017f" for "s")
+    TABLE_OF_CONTENTS_PATTERN: re.Pattern[str] = re.compile("[Tt][Aa][Bb][Ll][Ee] [Oo][Ff] [Cc][Oo][Nn][Tt][Ee][Nn][Tt][Ss]")
 
     @staticmethod
     def _parse_tag(stripped_line: str) -> Optional[tuple[str, str]]:
@@ -23,57 +27,41 @@ class MarkdownCustomMarkesCleaner:
         return any(char != "-" and not char.isspace() for char in markdown_string)
 
     @staticmethod
-    def clean_up_markers(markdown_string: str) -> str:
-        input_lines: list[str] = markdown_string.splitlines()
-        output_lines: list[str] = []
-        is_inside_removal_block: bool = False
+    def extract_toc_from_headings(markdown_string: str) -> Optional[list[str]]:
+        """
+        Derives the same TOC the fix-up prompt generates in its `TOC FROM CONTENT` block (the markdown headings,
+        when there are at least two of them), for pages that skip the fix-up call.
+        """
+        headings: list[str] = []
+        is_inside_code_fence: bool = False
 
-        for current_line in input_lines:
+        for current_line in markdown_string.splitlines():
             stripped_line: str = current_line.strip()
-            tag_info = MarkdownCustomMarkesCleaner._parse_tag(stripped_line)
-
-            # --- Block Removal Logic (Ignoring Extraction Marker) ---
-            if tag_info:
-                marker_prefix, tag_type = tag_info
-
-                # Check if it's the special marker *before* general removal logic
-                if marker_prefix == MarkdownCustomMarkesCleaner.EXTRACTION_MARKER_PREFIX:
-                    # Always keep the extraction marker tags and content during this phase,
-                    # unless we are already inside a *different* removal block.
-                    pass  # Let it fall through to the "Keep Line" logic below
-                # It's a standard marker, apply removal logic
-                elif tag_type == "START":
-                    is_inside_removal_block = True
-                    continue  # Skip the start tag line
-                elif tag_type == "END":  # Assumes it matches the block we are in
-                    is_inside_removal_block = False
-                    continue  # Skip the end tag line
-
-            # If currently inside a standard removal block, skip the line
-            if is_inside_removal_block:
+            if stripped_line.startswith(("```", "~~~")):
+                is_inside_code_fence = not is_inside_code_fence
+                continue
+            if is_inside_code_fence:
                 continue
 
-            # --- Line-Specific Removal Logic ---
-            # Simple check for "TABLE OF CONTENTS" line (case-insensitive)
-            # Ensure this check doesn't remove lines inside the extraction block
-            # (which it won't because we only reach here if not inside a removal block)
-            if "table of contents" in current_line.lower():
-                continue  # Skip this line
+            heading_level: int = len(stripped_line) - len(stripped_line.lstrip("#"))
+            if 1 <= heading_level <= 6 and stripped_line[heading_level : heading_level + 1] == " ":
+                headings.append(stripped_line)
 
-            # --- Keep Line ---
-            # Keep lines that are not inside a removal block (or are part of the extraction block)
-            output_lines.append(current_line)
+        return headings if len(headings) >= 2 else None
 
-        cleaned_markdown_string: str = "\n".join(output_lines)
-        return cleaned_markdown_string
+    @staticmethod
+    def clean_up_markers(markdown_string: str) -> str:
+        stream_cleaner: MarkdownCustomMarkersStreamCleaner = MarkdownCustomMarkersStreamCleaner()
+        return stream_cleaner.feed(markdown_string) + stream_cleaner.finish()
 
     @staticmethod
-    def clean_markers_and_extract_toc(markdown_string: str) -> tuple[str, Optional[list[str]]]:  # <-- Updated Return Type Hint
+    def clean_markers_and_extract_toc(markdown_string: str) -> tuple[str, Optional[list[str]]]:
         """
         Performs a full cleanup and extracts content from the special block.
 
-        First calls `clean_up` to remove standard blocks, then processes
-        that result to find, extract, and remove the special extraction block.
+        In a single pass over the lines, removes the standard marker blocks and "table of contents" lines (as
+        `clean_up_markers` does), and then finds, extracts and removes the special extraction block from the
+        lines that remain.
 
         Args:
             markdown_string: The original input markdown string.
@@ -85,39 +73,111 @@ class MarkdownCustomMarkesCleaner:
               block if it was found and contained content, otherwise None
               (Optional[List[str]]).
         """
-        intermediate_cleaned_string = MarkdownCustomMarkesCleaner.clean_up_markers(markdown_string)
-
-        input_lines: list[str] = intermediate_cleaned_string.splitlines()
-        output_lines_final: list[str] = []
+        output_lines: list[str] = []
         extracted_lines: list[str] = []  # This will be returned if not empty
+        is_inside_removal_block: bool = False
         is_inside_extraction_block: bool = False
         extraction_block_found: bool = False
-
-        for current_line in input_lines:
-            stripped_line: str = current_line.strip()
-            tag_info = MarkdownCustomMarkesCleaner._parse_tag(stripped_line)
+        # The lines are only searched for "table of contents" when the text contains it at all
+        has_table_of_contents_lines: bool = MarkdownCustomMarkesCleaner.TABLE_OF_CONTENTS_PATTERN.search(markdown_string) is not None
+        # Where the last line kept by the marker cleanup went (None for extraction tags), see below
+        last_kept_line_destination: Optional[list[str]] = None
+
+        for current_line in markdown_string.splitlines():
+            # Only lines with "[[" can be tags, all others are not stripped and parsed
+            tag_info = MarkdownCustomMarkesCleaner._parse_tag(current_line.strip()) if "[[" in current_line else None
+
+            # --- Block Removal Logic (the extraction block is kept for the extraction below) ---
+            if tag_info and tag_info[0] != MarkdownCustomMarkesCleaner.EXTRACTION_MARKER_PREFIX:
+                is_inside_removal_block = tag_info[1] == "START"
+                continue
+            if is_inside_removal_block:
+                continue
+            if has_table_of_contents_lines and MarkdownCustomMarkesCleaner.TABLE_OF_CONTENTS_PATTERN.search(current_line):
+                continue
 
             # --- Extraction Block Handling ---
             if tag_info:
-                marker_prefix, tag_type = tag_info
-                if marker_prefix == MarkdownCustomMarkesCleaner.EXTRACTION_MARKER_PREFIX:
-                    if tag_type == "START":
-                        is_inside_extraction_block = True
-                        extraction_block_found = True
-                        continue
-                    if tag_type == "END":
-                        is_inside_extraction_block = False
-                        continue
-
-            # Collect content if inside the extraction block
-            if is_inside_extraction_block:
-                extracted_lines.append(current_line)
+                is_inside_extraction_block = tag_info[1] == "START"
+                extraction_block_found = extraction_block_found or is_inside_extraction_block
+                last_kept_line_destination = None
                 continue
 
-            # --- Keep Line ---
-            output_lines_final.append(current_line)
+            last_kept_line_destination = extracted_lines if is_inside_extraction_block else output_lines
+            last_kept_line_destination.append(current_line)
+
+        # The cleanup used to be a separate pass whose output was joined and split into lines again, which drops
+        # a trailing empty line. That is preserved, so the results are unchanged.
+        if last_kept_line_destination is not None and last_kept_line_destination[-1] == "":
+            last_kept_line_destination.pop()
 
-        final_cleaned_string: str = "\n".join(output_lines_final)
+        final_cleaned_string: str = "\n".join(output_lines)
         extracted_content_list: Optional[list[str]] = extracted_lines if extraction_block_found and extracted_lines else None
 
         return final_cleaned_string, extracted_content_list
+
+
+class MarkdownCustomMarkersStreamCleaner:
+    """
+    Removes the custom marker blocks from markdown as it is being generated (the `clean_up_markers` pass of
+    MarkdownCustomMarkesCleaner, which is implemented with it). Chunks of any size are fed in as they arrive
+    and every completed line is cleaned right away, so the concatenation of everything `feed` and `finish`
+    return is exactly what `clean_up_markers` returns for the whole text.
+    """
+
+    def __init__(self) -> None:
+        self.pending_text: str = ""
+        self.is_inside_removal_block: bool = False
+        self.has_output: bool = False
+
+    def feed(self, markdown_chunk: str) -> str:
+        self.pending_text += markdown_chunk
+        line_pieces: list[str] = self.pending_text.splitlines(keepends=True)
+        # The last piece is an incomplete line until its line break arrives. A trailing "\r" is held back as
+        # well, since it may be the first half of a "\r\n".
+        if line_pieces and (line_pieces[-1].splitlines()[0] == line_pieces[-1] or line_pieces[-1].endswith("\r")):
+            self.pending_text = line_pieces.pop()
+        else:
+            self.pending_text = ""
+        return "".join(self.__clean_line(line_piece.splitlines()[0]) for line_piece in line_pieces)
+
+    def finish(self) -> str:
+        remaining_lines: list[str] = self.pending_text.splitlines()
+        self.pending_text = ""
+        return "".join(self.__clean_line(current_line) for current_line in remaining_lines)
+
+    def __clean_line(self, current_line: str) -> str:
+        # Only lines with "[[" can be tags, all others are not stripped and parsed
+        tag_info = MarkdownCustomMarkesCleaner._parse_tag(current_line.strip()) if "[[" in current_line else None
+
+        # --- Block Removal Logic (Ignoring Extraction Marker) ---
+        if tag_info:
+            marker_prefix, tag_type = tag_info
+
+            # Check if it's the special marker *before* general removal logic
+            if marker_prefix == MarkdownCustomMarkesCleaner.EXTRACTION_MARKER_PREFIX:
+                # Always keep the extraction marker tags and content during this phase,
+                # unless we are already inside a *different* removal block.
+                pass  # Let it fall through to the "Keep Line" logic below
+            # It's a standard marker, apply removal logic
+            elif tag_type == "START":
+                self.is_inside_removal_block = True
+                return ""  # Skip the start tag line
+            elif tag_type == "END":  # Assumes it matches the block we are in
+                self.is_inside_removal_block = False
+                return ""  # Skip the end tag line
+
+        # If currently inside a standard removal block, skip the line
+        if self.is_inside_removal_block:
+            return ""
+
+        # --- Line-Specific Removal Logic ---
+        # Simple check for "TABLE OF CONTENTS" line (case-insensitive)
+        if MarkdownCustomMarkesCleaner.TABLE_OF_CONTENTS_PATTERN.search(current_line):
+            return ""  # Skip this line
+
+        # --- Keep Line ---
+        # Kept lines are joined with line breaks, without a trailing one (as "\n".join would)
+        kept_line: str = current_line if not self.has_output else f"\n{current_line}"
+        self.has_output = True
+        return kept_line
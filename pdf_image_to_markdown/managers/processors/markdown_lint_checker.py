@@ -0,0 +1,140 @@
+import re
+from typing import Optional
+
+from pdf_image_to_markdown.managers.processors.markdown_custom_markers_cleaner import MarkdownCustomMarkesCleaner
+
+
+class MarkdownLintChecker:
+    """
+    Cheap, local checks for the structural problems the fix-up prompt exists to repair. Pages whose vision
+    output passes every check can skip the fix-up LLM call.
+    """
+
+    _MARKER_TAG_PATTERN: re.Pattern[str] = re.compile(r"\[\[(.*?)\]\]")
+    _TABLE_SEPARATOR_CELL_PATTERN: re.Pattern[str] = re.compile(r"^\s*:?-+:?\s*$")
+    _TABLE_CELL_SEPARATOR_PATTERN: re.Pattern[str] = re.compile(r"(?<!\\)\|")
+    _ORPHAN_LIST_MARKER_PATTERN: re.Pattern[str] = re.compile(r"^(?:[-*+]|\d+[.)])$")
+    _CODE_FENCE_PREFIXES: tuple[str, str] = ("```", "~~~")
+
+    @staticmethod
+    def needs_fixup(markdown_string: str) -> bool:
+        return bool(MarkdownLintChecker.find_issues(markdown_string))
+
+    @staticmethod
+    def find_issues(markdown_string: str) -> list[str]:
+        """
+        Args:
+            markdown_string: The markdown returned by the vision model, before marker cleanup, so that marker
+                tags that would otherwise swallow content during cleanup are still visible.
+
+        Returns:
+            A description of every problem found, with 1-based line numbers. An empty list means the markdown
+            is clean.
+        """
+        lines: list[str] = markdown_string.splitlines()
+        issues: list[str] = []
+        issues.extend(MarkdownLintChecker._find_marker_tag_issues(lines))
+        issues.extend(MarkdownLintChecker._find_code_fence_issues(lines))
+        issues.extend(MarkdownLintChecker._find_table_issues(lines))
+        issues.extend(MarkdownLintChecker._find_orphan_list_marker_issues(lines))
+        return issues
+
+    @staticmethod
+    def _find_marker_tag_issues(lines: list[str]) -> list[str]:
+        issues: list[str] = []
+        open_marker: Optional[tuple[str, int]] = None
+
+        for line_number, line in enumerate(lines, start=1):
+            stripped_line: str = line.strip()
+            # The tags are parsed the same way the marker cleaner parses them
+            tag_info = MarkdownCustomMarkesCleaner._parse_tag(stripped_line)
+            if tag_info is None:
+                # Only tags on a line of their own are understood by the marker cleaner
+                if MarkdownLintChecker._MARKER_TAG_PATTERN.search(line):
+                    issues.append(f"Line {line_number}: marker tag embedded in text")
+                continue
+
+            marker_prefix, tag_type = tag_info
+            if tag_type == "START":
+                if open_marker is not None:
+                    issues.append(f"Line {line_number}: '{marker_prefix}' marker started inside '{open_marker[0]}' block")
+                open_marker = (marker_prefix, line_number)
+            elif open_marker is None or open_marker[0] != marker_prefix:
+                issues.append(f"Line {line_number}: '{marker_prefix}' end marker without a matching start marker")
+            else:
+                open_marker = None
+
+        if open_marker is not None:
+            issues.append(f"Line {open_marker[1]}: '{open_marker[0]}' marker is never closed")
+        return issues
+
+    @staticmethod
+    def _find_code_fence_issues(lines: list[str]) -> list[str]:
+        issues: list[str] = []
+        open_fence_line_number: Optional[int] = None
+
+        for line_number, line in enumerate(lines, start=1):
+            stripped_line: str = line.strip()
+            if not stripped_line.startswith(MarkdownLintChecker._CODE_FENCE_PREFIXES):
+                continue
+            if open_fence_line_number is None:
+                if stripped_line[3:].strip().lower() in ("markdown", "md"):
+                    issues.append(f"Line {line_number}: markdown wrapped in a code fence")
+                open_fence_line_number = line_number
+            else:
+                open_fence_line_number = None
+
+        if open_fence_line_number is not None:
+            issues.append(f"Line {open_fence_line_number}: code fence is never closed")
+        return issues
+
+    @staticmethod
+    def _find_table_issues(lines: list[str]) -> list[str]:
+        issues: list[str] = []
+        table_rows: list[tuple[int, str]] = []
+
+        # A trailing empty line flushes a table that ends on the last line
+        for line_number, line in enumerate([*lines, ""], start=1):
+            stripped_line: str = line.strip()
+            if stripped_line.startswith("|"):
+                table_rows.append((line_number, stripped_line))
+                continue
+            if table_rows:
+                issues.extend(MarkdownLintChecker._find_issues_in_table(table_rows))
+                table_rows = []
+        return issues
+
+    @staticmethod
+    def _find_issues_in_table(table_rows: list[tuple[int, str]]) -> list[str]:
+        first_line_number: int = table_rows[0][0]
+        if len(table_rows) < 2:
+            return [f"Line {first_line_number}: table row without a header separator"]
+
+        rows_cells: list[list[str]] = [MarkdownLintChecker._split_table_row(row) for _, row in table_rows]
+        if not all(MarkdownLintChecker._TABLE_SEPARATOR_CELL_PATTERN.match(cell) for cell in rows_cells[1]):
+            return [f"Line {table_rows[1][0]}: table header is not followed by a separator row"]
+
+        issues: list[str] = []
+        column_count: int = len(rows_cells[0])
+        for (line_number, _), row_cells in zip(table_rows, rows_cells):
+            if len(row_cells) != column_count:
+                issues.append(f"Line {line_number}: table row has {len(row_cells)} columns, expected {column_count}")
+        return issues
+
+    @staticmethod
+    def _split_table_row(stripped_row: str) -> list[str]:
+        cells: list[str] = MarkdownLintChecker._TABLE_CELL_SEPARATOR_PATTERN.split(stripped_row)
+        # The leading (and usually trailing) pipe produce empty cells that are not columns
+        if cells and not cells[0].strip():
+            cells = cells[1:]
+        if cells and not cells[-1].strip() and stripped_row.endswith("|") and not stripped_row.endswith("\\|"):
+            cells = cells[:-1]
+        return cells
+
+    @staticmethod
+    def _find_orphan_list_marker_issues(lines: list[str]) -> list[str]:
+        return [
+            f"Line {line_number}: list marker without an item"
+            for line_number, line in enumerate(lines, start=1)
+            if MarkdownLintChecker._ORPHAN_LIST_MARKER_PATTERN.match(line.strip())
+        ]
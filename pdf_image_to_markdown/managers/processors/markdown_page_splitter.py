@@ -0,0 +1,54 @@
+import re
+from typing import Optional
+
+
+class MarkdownPageSplitter:
+    """
+    Splits the markdown the vision model returns for several page images at once back into the markdown of
+    each page. The model is asked to start every page with a `[[ PAGE n ]]` marker line and to end the response
+    with a `[[ END OF PAGES ]]` line, so that a response that is missing pages, or was cut off, can be told apart
+    from a complete one.
+    """
+
+    END_OF_PAGES_MARKER: str = "[[ END OF PAGES ]]"
+    _PAGE_MARKER_PATTERN: re.Pattern[str] = re.compile(r"^[ \t]*\[\[[ \t]*(?:PAGE[ \t]+(\d+)|(END OF PAGES))[ \t]*\]\][ \t]*\r?$", re.MULTILINE)
+
+    @staticmethod
+    def get_page_marker(page_index: int) -> str:
+        return f"[[ PAGE {page_index} ]]"
+
+    @staticmethod
+    def split_pages(markdown_string: str, page_count: int) -> Optional[list[str]]:
+        """
+        Args:
+            markdown_string: The markdown of `page_count` pages, each starting with its page marker.
+            page_count: The number of page images the markdown was generated from.
+
+        Returns:
+            The markdown of each page, in page order and without the markers. None when the markers are not
+            exactly pages 1 to `page_count` followed by the end marker, e.g. because the response was truncated.
+        """
+        page_matches: list[re.Match[str]] = []
+        end_match: Optional[re.Match[str]] = None
+        for match in MarkdownPageSplitter._PAGE_MARKER_PATTERN.finditer(markdown_string):
+            if end_match is not None:
+                return None
+            if match.group(2):
+                end_match = match
+            else:
+                page_matches.append(match)
+
+        if end_match is None or not page_matches or [int(match.group(1)) for match in page_matches] != list(range(1, page_count + 1)):
+            return None
+
+        page_markdowns: list[str] = []
+        for page_index, page_match in enumerate(page_matches):
+            page_end: int = page_matches[page_index + 1].start() if page_index + 1 < page_count else end_match.start()
+            page_markdowns.append(markdown_string[page_match.end() : page_end].strip("\r\n"))
+
+        # Anything before the first marker (the model occasionally starts the first page without it) is kept
+        leading_markdown: str = markdown_string[: page_matches[0].start()].strip()
+        if leading_markdown:
+            page_markdowns[0] = f"{leading_markdown}\n{page_markdowns[0]}"
+
+        return page_markdowns
@@ -0,0 +1,59 @@
+import numpy as np
+from PIL import Image
+
+from pdf_image_to_markdown.managers.models.page_hash import PageHash
+
+
+class PageImageHasher:
+    PHASH_IMAGE_SIZE: int = 32
+    PHASH_FREQUENCY_COUNT: int = 8
+    DHASH_SIZE: int = 16
+    # The dHash has four times the bits of the pHash, so it is allowed four times the distance
+    DHASH_DISTANCE_FACTOR: int = 4
+
+    @staticmethod
+    def get_page_hash(image: Image.Image) -> PageHash:
+        grayscale_image: Image.Image = image.convert("L")
+        return PageHash(PageImageHasher.get_phash(grayscale_image), PageImageHasher.get_dhash(grayscale_image))
+
+    @staticmethod
+    def get_phash(image: Image.Image) -> int:
+        image_size: int = PageImageHasher.PHASH_IMAGE_SIZE
+        pixels: np.ndarray = np.asarray(image.convert("L").resize((image_size, image_size), Image.Resampling.BOX), dtype=np.float64)
+        dct_matrix: np.ndarray = PageImageHasher._get_dct_matrix(image_size)
+        # The lowest frequencies of the 2D DCT capture the layout of the page rather than its fine detail
+        frequency_count: int = PageImageHasher.PHASH_FREQUENCY_COUNT
+        low_frequencies: np.ndarray = (dct_matrix @ pixels @ dct_matrix.T)[:frequency_count, :frequency_count].flatten()
+        # The DC coefficient is the average brightness, which would skew the median
+        return PageImageHasher._bits_to_int(low_frequencies > np.median(low_frequencies[1:]))
+
+    @staticmethod
+    def get_dhash(image: Image.Image) -> int:
+        hash_size: int = PageImageHasher.DHASH_SIZE
+        pixels: np.ndarray = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BOX), dtype=np.int16)
+        return PageImageHasher._bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+    @staticmethod
+    def is_same_page(page_hash: PageHash, other_page_hash: PageHash, max_hash_distance: int) -> bool:
+        return (
+            PageImageHasher.get_hash_distance(page_hash.phash, other_page_hash.phash) <= max_hash_distance
+            and PageImageHasher.get_hash_distance(page_hash.dhash, other_page_hash.dhash)
+            <= max_hash_distance * PageImageHasher.DHASH_DISTANCE_FACTOR
+        )
+
+    @staticmethod
+    def get_hash_distance(first_hash: int, second_hash: int) -> int:
+        return (first_hash ^ second_hash).bit_count()
+
+    @staticmethod
+    def _get_dct_matrix(size: int) -> np.ndarray:
+        # Orthonormal DCT-II basis, so that the 2D transform is a pair of matrix products
+        frequencies: np.ndarray = np.arange(size)[:, np.newaxis]
+        positions: np.ndarray = np.arange(size)[np.newaxis, :]
+        dct_matrix: np.ndarray = np.cos(np.pi * (2 * positions + 1) * frequencies / (2 * size)) * np.sqrt(2 / size)
+        dct_matrix[0] /= np.sqrt(2)
+        return dct_matrix
+
+    @staticmethod
+    def _bits_to_int(bits: np.ndarray) -> int:
+        return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
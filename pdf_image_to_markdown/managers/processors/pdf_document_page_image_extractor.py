@@ -1,26 +1,332 @@
+import asyncio
+import numpy as np
 import pypdfium2 as pdfium
-from PIL import Image
+from PIL import Image, ImageChops
 import io
+import multiprocessing
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from pdf_image_to_markdown.managers.models.page_image import PageImage
+from pdf_image_to_markdown.managers.models.page_image_options import PageImageOptions
+from pdf_image_to_markdown.managers.processors.page_image_hasher import PageImageHasher
+
+# A PDF document is either held in memory or read from a file. pdfium reads files on demand, so large
+# documents (e.g. streamed from blob storage into a temporary file) never need to be held in memory.
+PdfSource = bytes | Path
+
 
 class PdfDocumentPageImageExtractor:
+    VISION_MAX_LONGEST_SIDE: int = 2048
+    VISION_MAX_SHORTEST_SIDE: int = 768
+    MONOCHROME_CHANNEL_TOLERANCE: int = 16
+    MONOCHROME_MAX_COLORED_PIXEL_RATIO: float = 0.001
+    # A pixel is ink when its darkest channel is below this value, which leaves the off-white background of
+    # scanned pages and light fills out
+    INK_THRESHOLD: int = 200
+    # Pages with less ink than this (scanner speckle) are blank
+    MAX_BLANK_INK_RATIO: float = 0.0002
+    # Pages whose ink is thinner than this, relative to the page, only hold a separator rule
+    MAX_SEPARATOR_THICKNESS_RATIO: float = 0.005
+    CROP_PADDING_POINTS: float = 12
+    # The document rendered by a worker process, set once when the worker starts rather than sent with every chunk
+    _worker_pdf_source: PdfSource | None = None
+
     @staticmethod
-    def extract_images(pdf_bytes: bytes) -> list[bytes]:
-        pdf_document: pdfium.PdfDocument = pdfium.PdfDocument(io.BytesIO(pdf_bytes))
-        page_count: int = len(pdf_document)
-        png_images: list[bytes] = []
-        for page_number in range(page_count):
-            page: pdfium.PdfPage = pdf_document.get_page(page_number)
-            bitmap: pdfium.Bitmap = page.render(
-                scale=2,
-                rotation=0,
-            )
-            image: Image.Image = bitmap.to_pil()
-            output: io.BytesIO = io.BytesIO()
-            image.save(output, format="PNG")
-            png_bytes: bytes = output.getvalue()
-            png_images.append(png_bytes)
-            page.close()
-            bitmap.close()
+    def open_document(pdf_source: PdfSource) -> pdfium.PdfDocument:
+        return pdfium.PdfDocument(pdf_source if isinstance(pdf_source, Path) else io.BytesIO(pdf_source))
 
+    @staticmethod
+    def get_page_count(pdf_source: PdfSource) -> int:
+        pdf_document: pdfium.PdfDocument = PdfDocumentPageImageExtractor.open_document(pdf_source)
+        page_count: int = len(pdf_document)
         pdf_document.close()
-        return png_images
\ No newline at end of file
+        return page_count
+
+    @staticmethod
+    async def stream_images(
+        pdf_source: PdfSource,
+        max_workers: int = 1,
+        pages_per_chunk: int = 4,
+        page_numbers: Iterable[int] | None = None,
+        page_image_options: PageImageOptions | None = None,
+        compute_page_hashes: bool = False,
+        measure_ink: bool = False,
+    ) -> AsyncIterator[PageImage]:
+        """
+        Yields the page images, in page order and with 1-based page numbers, as soon as each page has been
+        rendered (`image_bytes` is None for blank pages, when those are skipped), so callers can start working
+        on the first pages while later ones are still being rasterized. Rendering only runs ahead of the
+        consumer by a bounded amount, so memory use does not grow with the size of the document.
+
+        Only the pages in `page_numbers` are rendered, when given. With `measure_ink`, the area of every page
+        covered by ink is measured, from which the length of its markdown can be estimated.
+        """
+        if page_numbers is None:
+            page_numbers = range(1, PdfDocumentPageImageExtractor.get_page_count(pdf_source) + 1)
+
+        if max_workers <= 1:
+            async for page_image in PdfDocumentPageImageExtractor._stream_images_in_thread(
+                pdf_source, page_numbers, page_image_options, compute_page_hashes, measure_ink
+            ):
+                yield page_image
+            return
+
+        async for page_image in PdfDocumentPageImageExtractor._stream_images_in_processes(
+            pdf_source, page_numbers, max_workers, pages_per_chunk, page_image_options, compute_page_hashes, measure_ink
+        ):
+            yield page_image
+
+    @staticmethod
+    def iter_images(
+        pdf_source: PdfSource,
+        page_numbers: Iterable[int] | None = None,
+        page_image_options: PageImageOptions | None = None,
+        compute_page_hashes: bool = False,
+        measure_ink: bool = False,
+    ) -> Iterator[PageImage]:
+        page_image_options = page_image_options or PageImageOptions()
+        pdf_document: pdfium.PdfDocument = PdfDocumentPageImageExtractor.open_document(pdf_source)
+        try:
+            for page_number in range(1, len(pdf_document) + 1) if page_numbers is None else page_numbers:
+                yield PdfDocumentPageImageExtractor._render_page(pdf_document, page_number, page_image_options, compute_page_hashes, measure_ink)
+        finally:
+            pdf_document.close()
+
+    @staticmethod
+    async def _stream_images_in_thread(
+        pdf_source: PdfSource,
+        page_numbers: Iterable[int],
+        page_image_options: PageImageOptions | None,
+        compute_page_hashes: bool,
+        measure_ink: bool,
+    ) -> AsyncIterator[PageImage]:
+        # A dedicated thread keeps every pdfium call on the same thread and off the event loop.
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        page_iterator: Iterator[PageImage] = PdfDocumentPageImageExtractor.iter_images(
+            pdf_source, page_numbers, page_image_options, compute_page_hashes, measure_ink
+        )
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                while (page_image := await loop.run_in_executor(executor, next, page_iterator, None)) is not None:
+                    yield page_image
+            finally:
+                await loop.run_in_executor(executor, page_iterator.close)
+
+    @staticmethod
+    async def _stream_images_in_processes(
+        pdf_source: PdfSource,
+        page_numbers: Iterable[int],
+        max_workers: int,
+        pages_per_chunk: int,
+        page_image_options: PageImageOptions | None,
+        compute_page_hashes: bool,
+        measure_ink: bool,
+    ) -> AsyncIterator[PageImage]:
+        page_number_list: list[int] = list(page_numbers)
+        chunks: Iterator[list[int]] = (
+            page_number_list[chunk_start : chunk_start + pages_per_chunk] for chunk_start in range(0, len(page_number_list), pages_per_chunk)
+        )
+        # At most two chunks per worker are queued or rendered ahead of the consumer.
+        max_pending_chunks: int = max_workers * 2
+        pending_chunks: deque[Future[list[PageImage]]] = deque()
+
+        # pdfium is not thread-safe, so rendering is parallelised across processes. The document (its bytes or its
+        # path) is handed to every worker once, and every worker opens its own PdfDocument for each chunk of pages.
+        # The workers are spawned rather than forked, the event loop's process already runs threads (to_thread, the
+        # SQLite caches, the blob SDK) whose locks a fork could copy while held.
+        executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=PdfDocumentPageImageExtractor._initialize_worker,
+            initargs=(pdf_source,),
+        )
+        try:
+            while True:
+                while len(pending_chunks) < max_pending_chunks and (chunk := next(chunks, None)) is not None:
+                    pending_chunks.append(
+                        executor.submit(
+                            PdfDocumentPageImageExtractor._render_worker_pages, chunk, page_image_options, compute_page_hashes, measure_ink
+                        )
+                    )
+
+                if not pending_chunks:
+                    break
+
+                chunk_page_images: list[PageImage] = await asyncio.wrap_future(pending_chunks.popleft())
+                for page_image in chunk_page_images:
+                    yield page_image
+        finally:
+            # Waiting for the chunks being rendered would block the event loop when the consumer stops early or is
+            # cancelled, the workers exit once they are done with them instead
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _initialize_worker(pdf_source: PdfSource) -> None:
+        PdfDocumentPageImageExtractor._worker_pdf_source = pdf_source
+
+    @staticmethod
+    def _render_worker_pages(
+        page_numbers: list[int], page_image_options: PageImageOptions | None, compute_page_hashes: bool, measure_ink: bool
+    ) -> list[PageImage]:
+        pdf_source: PdfSource | None = PdfDocumentPageImageExtractor._worker_pdf_source
+        assert pdf_source is not None
+        return PdfDocumentPageImageExtractor._render_pages(pdf_source, page_numbers, page_image_options, compute_page_hashes, measure_ink)
+
+    @staticmethod
+    def _render_pages(
+        pdf_source: PdfSource,
+        page_numbers: list[int],
+        page_image_options: PageImageOptions | None = None,
+        compute_page_hashes: bool = False,
+        measure_ink: bool = False,
+    ) -> list[PageImage]:
+        return list(PdfDocumentPageImageExtractor.iter_images(pdf_source, page_numbers, page_image_options, compute_page_hashes, measure_ink))
+
+    @staticmethod
+    def _render_page(
+        pdf_document: pdfium.PdfDocument, page_number: int, page_image_options: PageImageOptions, compute_page_hashes: bool, measure_ink: bool
+    ) -> PageImage:
+        render_start_time: float = time.perf_counter()
+        render_start_cpu_time: float = time.thread_time()
+        page: pdfium.PdfPage = pdf_document.get_page(page_number - 1)
+        page_size: tuple[float, float] = page.get_size()
+        scale: float = PdfDocumentPageImageExtractor._get_render_scale(page_size, page_image_options)
+        bitmap: pdfium.PdfBitmap = page.render(
+            scale=scale,
+            rotation=0,
+        )
+        image: Image.Image = bitmap.to_pil()
+
+        if page_image_options.skip_blank_pages or page_image_options.crop_margins:
+            # The bitmap is inspected in place, without copying it out of pdfium's buffer
+            content_box: tuple[int, int, int, int] | None = PdfDocumentPageImageExtractor._find_content_box(bitmap.to_numpy())
+            if content_box is None and page_image_options.skip_blank_pages:
+                page.close()
+                bitmap.close()
+                return PageImage(
+                    page_number,
+                    None,
+                    render_seconds=time.perf_counter() - render_start_time,
+                    render_cpu_seconds=time.thread_time() - render_start_cpu_time,
+                )
+            if content_box is not None and page_image_options.crop_margins:
+                image = PdfDocumentPageImageExtractor._crop_to_content(page, page_size, scale, image, content_box, page_image_options)
+        ink_area: float | None = PdfDocumentPageImageExtractor._get_ink_area(bitmap.to_numpy(), scale) if measure_ink else None
+        if page_image_options.grayscale_monochrome_pages and PdfDocumentPageImageExtractor._is_monochrome(image):
+            image = image.convert("L")
+
+        encode_start_time: float = time.perf_counter()
+        encode_start_cpu_time: float = time.thread_time()
+        output: io.BytesIO = io.BytesIO()
+        if page_image_options.image_format == "PNG":
+            image.save(output, format="PNG", compress_level=page_image_options.png_compress_level)
+        else:
+            image.save(output, format=page_image_options.image_format, quality=page_image_options.quality)
+        image_bytes: bytes = output.getvalue()
+        page.close()
+        bitmap.close()
+        encode_end_time: float = time.perf_counter()
+        encode_end_cpu_time: float = time.thread_time()
+        # Pages are hashed as they are sent to the model, i.e. after cropping
+        return PageImage(
+            page_number,
+            image_bytes,
+            PageImageHasher.get_page_hash(image) if compute_page_hashes else None,
+            render_seconds=encode_start_time - render_start_time,
+            encode_seconds=encode_end_time - encode_start_time,
+            render_cpu_seconds=encode_start_cpu_time - render_start_cpu_time,
+            encode_cpu_seconds=encode_end_cpu_time - encode_start_cpu_time,
+            width=image.width,
+            height=image.height,
+            ink_area=ink_area,
+        )
+
+    @staticmethod
+    def _get_ink_area(pixels: np.ndarray, scale: float) -> float:
+        """Returns the area of the page covered by ink in square points, i.e. independent of the render resolution."""
+        # Comparing the channels one at a time is several times faster than taking their minimum first
+        ink_threshold: int = PdfDocumentPageImageExtractor.INK_THRESHOLD
+        ink: np.ndarray = (pixels[:, :, 0] < ink_threshold) | (pixels[:, :, 1] < ink_threshold) | (pixels[:, :, 2] < ink_threshold)
+        return np.count_nonzero(ink) / (scale * scale)
+
+    @staticmethod
+    def _find_content_box(pixels: np.ndarray) -> tuple[int, int, int, int] | None:
+        """
+        Returns the `(left, top, right, bottom)` pixel box around the ink on the page, or None when the page has
+        no content: it is blank, or only holds a separator rule.
+        """
+        # pdfium bitmaps are BGR(A), the darkest color channel decides whether a pixel is ink
+        ink: np.ndarray = pixels[:, :, :3].min(axis=2) < PdfDocumentPageImageExtractor.INK_THRESHOLD
+        if np.count_nonzero(ink) <= ink.size * PdfDocumentPageImageExtractor.MAX_BLANK_INK_RATIO:
+            return None
+
+        ink_rows: np.ndarray = np.flatnonzero(ink.any(axis=1))
+        ink_columns: np.ndarray = np.flatnonzero(ink.any(axis=0))
+        top, bottom = int(ink_rows[0]), int(ink_rows[-1]) + 1
+        left, right = int(ink_columns[0]), int(ink_columns[-1]) + 1
+        height, width = ink.shape
+        if min((bottom - top) / height, (right - left) / width) < PdfDocumentPageImageExtractor.MAX_SEPARATOR_THICKNESS_RATIO:
+            return None
+
+        return left, top, right, bottom
+
+    @staticmethod
+    def _crop_to_content(
+        page: pdfium.PdfPage,
+        page_size: tuple[float, float],
+        scale: float,
+        image: Image.Image,
+        content_box: tuple[int, int, int, int],
+        page_image_options: PageImageOptions,
+    ) -> Image.Image:
+        # Crop amounts (left, bottom, right, top) in PDF points, PDF y coordinates run from the bottom of the page
+        page_width, page_height = page_size
+        left, top, right, bottom = content_box
+        padding: float = PdfDocumentPageImageExtractor.CROP_PADDING_POINTS
+        crop: tuple[float, float, float, float] = (
+            max(left / scale - padding, 0),
+            max(page_height - bottom / scale - padding, 0),
+            max(page_width - right / scale - padding, 0),
+            max(top / scale - padding, 0),
+        )
+        cropped_size: tuple[float, float] = (page_width - crop[0] - crop[2], page_height - crop[1] - crop[3])
+
+        # With the image size capped, the smaller cropped page can be rendered at a higher resolution
+        cropped_scale: float = PdfDocumentPageImageExtractor._get_render_scale(cropped_size, page_image_options)
+        if cropped_scale > scale:
+            cropped_bitmap: pdfium.PdfBitmap = page.render(scale=cropped_scale, rotation=0, crop=crop)
+            cropped_image: Image.Image = cropped_bitmap.to_pil()
+            cropped_bitmap.close()
+            return cropped_image
+
+        return image.crop(
+            (round(crop[0] * scale), round(crop[3] * scale), image.width - round(crop[2] * scale), image.height - round(crop[1] * scale))
+        )
+
+    @staticmethod
+    def _get_render_scale(page_size: tuple[float, float], page_image_options: PageImageOptions) -> float:
+        # pdfium renders one pixel per PDF point at a scale of 1, i.e. at 72 DPI
+        longest_side: float = max(page_size)
+        shortest_side: float = min(page_size)
+        scale: float = page_image_options.dpi / 72
+        if page_image_options.max_longest_side is not None:
+            scale = min(scale, page_image_options.max_longest_side / longest_side)
+        if page_image_options.fit_to_vision_tiles:
+            # The vision model scales every image to fit within 2048 x 2048 and then so that its shortest side is
+            # at most 768 pixels, so anything rendered beyond that is uploaded only to be thrown away.
+            scale = min(scale, PdfDocumentPageImageExtractor.VISION_MAX_LONGEST_SIDE / longest_side)
+            scale = min(scale, PdfDocumentPageImageExtractor.VISION_MAX_SHORTEST_SIDE / shortest_side)
+        return scale
+
+    @staticmethod
+    def _is_monochrome(image: Image.Image) -> bool:
+        # Anti-aliased black text on white has (nearly) equal channels; a handful of colored pixels (e.g. a small
+        # logo) is tolerated so that otherwise grey pages are still encoded as a single channel.
+        red, green, blue = image.convert("RGB").split()
+        channel_difference: Image.Image = ImageChops.lighter(ImageChops.difference(red, green), ImageChops.difference(green, blue))
+        colored_pixel_count: int = sum(channel_difference.histogram()[PdfDocumentPageImageExtractor.MONOCHROME_CHANNEL_TOLERANCE + 1 :])
+        return colored_pixel_count <= image.width * image.height * PdfDocumentPageImageExtractor.MONOCHROME_MAX_COLORED_PIXEL_RATIO
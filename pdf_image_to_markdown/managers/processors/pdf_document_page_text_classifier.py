@@ -0,0 +1,76 @@
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+
+from pdf_image_to_markdown.managers.processors.pdf_document_page_image_extractor import PdfDocumentPageImageExtractor, PdfSource
+
+
+class PdfDocumentPageTextClassifier:
+    """
+    Decides, per page, whether the PDF's embedded text layer is good enough to convert from text instead of
+    rasterizing the page and sending it to the vision model. Digitally generated pages have plenty of
+    extractable characters and few or no images, scanned pages are (mostly) one big image.
+    """
+
+    MIN_CHARACTER_COUNT: int = 200
+    MIN_TEXT_COVERAGE: float = 0.02
+    MAX_IMAGE_AREA_RATIO: float = 0.5
+    MAX_UNMAPPED_CHARACTER_RATIO: float = 0.05
+
+    @staticmethod
+    def get_text_layer_pages(pdf_source: PdfSource) -> dict[int, str]:
+        """
+        Returns:
+            The extracted text of every page with a usable text layer, keyed by 1-based page number. Pages that
+            are missing from the result should be converted from their image.
+        """
+        pdf_document: pdfium.PdfDocument = PdfDocumentPageImageExtractor.open_document(pdf_source)
+        text_layer_pages: dict[int, str] = {}
+        try:
+            for page_index in range(len(pdf_document)):
+                page: pdfium.PdfPage = pdf_document.get_page(page_index)
+                page_text: str | None = PdfDocumentPageTextClassifier._get_usable_page_text(page)
+                if page_text is not None:
+                    text_layer_pages[page_index + 1] = page_text
+                page.close()
+        finally:
+            pdf_document.close()
+        return text_layer_pages
+
+    @staticmethod
+    def _get_usable_page_text(page: pdfium.PdfPage) -> str | None:
+        page_width, page_height = page.get_size()
+        page_area: float = page_width * page_height
+        if page_area <= 0:
+            return None
+
+        image_area: float = sum(
+            PdfDocumentPageTextClassifier._get_area(image_object.get_pos())
+            for image_object in page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_IMAGE])
+        )
+        if image_area / page_area > PdfDocumentPageTextClassifier.MAX_IMAGE_AREA_RATIO:
+            return None
+
+        text_page: pdfium.PdfTextPage = page.get_textpage()
+        try:
+            page_text: str = text_page.get_text_bounded().replace("\r\n", "\n")
+            text_area: float = sum(PdfDocumentPageTextClassifier._get_area(text_page.get_rect(index)) for index in range(text_page.count_rects()))
+        finally:
+            text_page.close()
+
+        visible_characters: list[str] = [char for char in page_text if not char.isspace()]
+        if len(visible_characters) < PdfDocumentPageTextClassifier.MIN_CHARACTER_COUNT:
+            return None
+        if text_area / page_area < PdfDocumentPageTextClassifier.MIN_TEXT_COVERAGE:
+            return None
+
+        # Fonts without a unicode mapping extract as replacement or control characters
+        unmapped_character_count: int = sum(1 for char in visible_characters if char == "\ufffd" or not char.isprintable())
+        if unmapped_character_count / len(visible_characters) > PdfDocumentPageTextClassifier.MAX_UNMAPPED_CHARACTER_RATIO:
+            return None
+
+        return page_text
+
+    @staticmethod
+    def _get_area(bounds: tuple[float, float, float, float]) -> float:
+        left, bottom, right, top = bounds
+        return abs(right - left) * abs(top - bottom)